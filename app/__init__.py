@@ -10,27 +10,60 @@
 # @brief Файл инициализации пакета.
 #
 # @section desctiption_init Description
-# В данном файле производится инициализация приложения и базы данных. Отсюда приложение app можеть быть импортировано и дополнено/запущено в любом другом файле.
+# В данном файле объявляются расширения db и manager и фабрика приложения create_app. Импорт пакета не имеет побочных
+# эффектов: не читает конфигурацию, не подключается к БД и не запускает фоновых потоков. Схема БД создается и
+# обновляется командой `flask --app main migrate`, начальные данные заполняются командой `flask --app main seed`.
 
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 
-from app.config import config
+from app.config import load_config, project_path
+from app.database import RoutingSession, READ_BIND
 
-app = Flask(__name__)
-app.secret_key = config["SITE"]["secret_key"]
-app.config['SQLALCHEMY_DATABASE_URI'] = config["DATABASE"]["uri"]
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = config["SITE"]["upload_folder"]
-db = SQLAlchemy(app)
-manager = LoginManager(app)
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+manager = LoginManager()
 
-from app import models, routes
-from app import logic
 
-with app.app_context():
-    db.create_all()
-    logic.init_db()
-    
+def create_app(ini=None):
+    """! Создать и настроить приложение.
+    @param ini Путь к ini файлу конфигурации или готовый ConfigParser. По умолчанию используется config.ini.
 
+    @returns Объект Flask
+    """
+    from app import database, routes, api, media, commands, profiling
+    from app.cache import make_cache, UserCache
+
+    ini = load_config(ini)
+    app = Flask(__name__)
+    app.secret_key = ini["SITE"]["secret_key"]
+    app.config['INI'] = ini
+    app.config['SQLALCHEMY_DATABASE_URI'] = ini["DATABASE"]["uri"]
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = database.engine_options(ini["DATABASE"])
+    read_options = database.read_engine_options(ini["DATABASE"])
+    if read_options:
+        app.config['SQLALCHEMY_BINDS'] = {READ_BIND: read_options}
+    app.config['UPLOAD_FOLDER'] = project_path(ini["SITE"]["upload_folder"])
+    app.config['USE_X_SENDFILE'] = ini.has_section("MEDIA") and ini["MEDIA"].get("x_sendfile", "0") != "0"
+
+    db.init_app(app)
+    manager.init_app(app)
+    app.register_blueprint(routes.bp)
+    app.register_blueprint(api.bp)
+    app.add_template_global(media.image_src)
+    app.add_template_global(media.image_srcset)
+    cache_section = ini["CACHE"] if ini.has_section("CACHE") else {}
+    app.extensions["canvas_cache"] = make_cache(cache_section)
+    app.extensions["user_cache"] = UserCache(int(cache_section.get("user_max_size", 10000)),
+                                             int(cache_section.get("user_ttl", 60)),
+                                             float(cache_section.get("user_sync_interval", 1)))
+    commands.register(app)
+    database.init_routing(app, db, ini["DATABASE"])
+    profiling.init_profiling(app)
+
+    with app.app_context():
+        database.setup_sqlite(db.engine, ini["DATABASE"])
+        if READ_BIND in db.engines:
+            database.setup_sqlite(db.engines[READ_BIND], ini["DATABASE"], read_only=True)
+    return app
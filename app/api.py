@@ -0,0 +1,471 @@
+##
+# @file
+#
+# @brief Файл JSON API версии 1.
+#
+# @section desctiption_api Description
+# Эндпоинты /api/v1/tours/<id> для получения и изменения путеводителя в формате JSON. Блоки передаются по столбцам:
+# {"id": [...], "name": [...], ...} - имена полей не повторяются для каждого блока, поэтому ответ для путеводителя
+# с тысячей блоков в несколько раз меньше, чем HTML блоков или форма редактора. Изменение (PUT) частичное:
+# передаются только измененные блоки и только нужные столбцы, удаляемые блоки перечисляются в deleted.
+# Ответы сжимаются brotli (если установлен пакет brotli) или gzip в зависимости от заголовка Accept-Encoding.
+# /api/v1/jobs показывает модераторам состояние очереди фоновых задач (см. jobs.py) и позволяет перезапустить
+# задачи, у которых закончились попытки; /api/v1/jobs/<id> - состояние одной задачи для ее создателя.
+# /api/v1/moderation - очередь модерации по порядку постановки, /api/v1/moderation/claim закрепляет за модератором
+# следующие путеводители очереди (см. moderation.py); решения принимает /api/moderate.
+# /api/v1/export отдает путеводители архивом tar.gz по частям, /api/v1/import принимает такой архив (см. bundles.py).
+# PATCH принимает короткие операции автосохранения редактора (перемещение, изменение размера и полей, добавление
+# и удаление блока) вместе с версией путеводителя: если путеводитель уже сохранили в другом окне, ответ - 409.
+
+import datetime
+import gzip
+import json
+import os
+
+from flask import Blueprint, current_app, request, jsonify, abort, make_response, Response, stream_with_context
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+
+from app import db
+from app.models import Tour, TourBlock, User, Job, JOB_QUEUED, JOB_FAILED
+from app.logic import apply_tour_patch, apply_tour_ops, TourVersionConflict
+from app.storage import is_content_addressed, save_file
+from app.jobs import wakeup
+from app.moderation import claim, pending_page, moderation_setting
+from app.bundles import export_tours, import_archive, user_tour_ids, bundle_setting
+
+try:
+    import brotli
+except ImportError:  # brotli - необязательная зависимость, без нее ответы сжимаются gzip
+    brotli = None
+
+bp = Blueprint("api_v1", __name__, url_prefix="/api/v1")
+
+## Столбцы блоков в ответе GET в порядке следования
+BLOCK_COLUMNS = ["id", "name", "text", "content_path", "content_variants", "type", "show_on_map", "latitude",
+                 "longitude", "column", "row", "height", "width"]
+
+## Столбцы блоков, которые можно передать в PUT, и допустимые типы значений
+WRITABLE_BLOCK_COLUMNS = {
+    "id": (int, type(None)),
+    "name": (str, type(None)),
+    "text": (str, type(None)),
+    "content_path": (str,),
+    "type": (int,),
+    "show_on_map": (bool,),
+    "latitude": (int, float, type(None)),
+    "longitude": (int, float, type(None)),
+    "column": (int,),
+    "row": (int,),
+    "height": (int,),
+    "width": (int,),
+}
+
+## Ограничения строковых столбцов блоков (длина столбца в БД)
+MAX_LENGTHS = {"name": 50, "content_path": 50}
+
+## Операции автосохранения и столбцы блока, которые они могут изменить
+OP_COLUMNS = {
+    "add": set(WRITABLE_BLOCK_COLUMNS) - {"id"},
+    "move": {"row", "column"},
+    "resize": {"row", "column", "height", "width"},
+    "edit": {"name", "text", "content_path", "type", "show_on_map", "latitude", "longitude"},
+    "remove": set(),
+}
+
+## Наибольшее количество операций в одном запросе PATCH
+MAX_OPS = 1000
+
+## Наибольшая длина временного ключа нового блока
+MAX_BLOCK_KEY_LENGTH = 20
+
+## Количество задач в ответе /api/v1/jobs
+JOBS_PAGE_SIZE = 50
+
+## Ответы меньше этого размера (в байтах) не сжимаются
+MIN_COMPRESS_SIZE = 512
+
+
+def serialize_tour(tour, blocks):
+    """! Сформировать JSON представление путеводителя с блоками по столбцам.
+    @param tour Путеводитель.
+    @param blocks Строки блоков со столбцами BLOCK_COLUMNS.
+    """
+    columns = list(zip(*blocks)) if blocks else [()] * len(BLOCK_COLUMNS)
+    return {
+        "id": tour.id,
+        "name": tour.name,
+        "canvas_height": tour.canvas_height,
+        "canvas_width": tour.canvas_width,
+        "version": tour.version,
+        "last_updated_at": tour.last_updated_at.isoformat(),
+        "created_by": tour.created_by_id,
+        "tags": [tag.id for tag in tour.tags],
+        "blocks": {name: list(values) for name, values in zip(BLOCK_COLUMNS, columns)},
+    }
+
+
+def check_block_value(name, value):
+    """! Проверить значение столбца блока, переданное клиентом.
+    @param name Имя столбца из WRITABLE_BLOCK_COLUMNS.
+    @param value Значение из разобранного JSON.
+    """
+    types = WRITABLE_BLOCK_COLUMNS[name]
+    # bool - подкласс int, поэтому в числовых столбцах он проверяется отдельно
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in types):
+        raise ValueError(f"invalid value in column {name}: {value!r}")
+    if name in MAX_LENGTHS and value is not None and len(value) > MAX_LENGTHS[name]:
+        raise ValueError(f"value in column {name} is too long")
+    if name == "content_path" and value and not (
+            is_content_addressed(value)
+            and os.path.isfile(os.path.join(current_app.config["UPLOAD_FOLDER"], value))):
+        raise ValueError(f"unknown file: {value}")
+
+
+def parse_block_columns(columns):
+    """! Преобразовать блоки, переданные по столбцам, в список словарей значений столбцов TourBlock.
+    @param columns Словарь {<столбец>: [<значения>]}, все списки одной длины.
+
+    @returns список словарей; у словаря есть только переданные столбцы
+    """
+    if not isinstance(columns, dict):
+        raise ValueError("blocks must be an object of columns")
+    unknown = set(columns) - set(WRITABLE_BLOCK_COLUMNS)
+    if unknown:
+        raise ValueError(f"unknown block columns: {', '.join(sorted(unknown))}")
+    lengths = {len(values) if isinstance(values, list) else -1 for values in columns.values()}
+    if len(lengths) > 1 or -1 in lengths:
+        raise ValueError("block columns must be lists of the same length")
+    for name, values in columns.items():
+        for value in values:
+            check_block_value(name, value)
+    names = list(columns)
+    return [dict(zip(names, row)) for row in zip(*columns.values())]
+
+
+def parse_tour_patch(payload):
+    """! Проверить и разобрать тело запроса PUT.
+    @param payload Разобранный JSON: {"version"?, "name"?, "tags"?, "blocks"?, "deleted"?}.
+
+    @returns словарь для logic.apply_tour_patch
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("request body must be a JSON object")
+    patch = {}
+    if "version" in payload:
+        if type(payload["version"]) is not int:
+            raise ValueError("version must be an integer")
+        patch["version"] = payload["version"]
+    if "name" in payload:
+        if not isinstance(payload["name"], str) or not 0 < len(payload["name"]) <= 50:
+            raise ValueError("name must be a non-empty string of at most 50 characters")
+        patch["name"] = payload["name"]
+    for key in ("tags", "deleted"):
+        if key in payload:
+            if not isinstance(payload[key], list) or not all(type(value) is int for value in payload[key]):
+                raise ValueError(f"{key} must be a list of integers")
+            patch[key] = payload[key]
+    if "blocks" in payload:
+        patch["blocks"] = parse_block_columns(payload["blocks"])
+    return patch
+
+
+def parse_tour_ops(payload):
+    """! Проверить и разобрать тело запроса PATCH.
+    @param payload Разобранный JSON: {"version": <версия>, "ops": [{"op": <операция>, "id": <блок>, <столбцы>...}]}.
+    Операция tour изменяет name и/или tags путеводителя, add добавляет блок с временным строковым ключом id,
+    остальные операции (OP_COLUMNS) изменяют или удаляют блок с числовым id или ключом блока, добавленного раньше.
+
+    @returns версия, список словарей {"op", "id", "values"} для logic.apply_tour_ops
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("request body must be a JSON object")
+    if type(payload.get("version")) is not int:
+        raise ValueError("version must be an integer")
+    if not isinstance(payload.get("ops"), list) or len(payload["ops"]) > MAX_OPS:
+        raise ValueError(f"ops must be a list of at most {MAX_OPS} operations")
+    ops = []
+    for op in payload["ops"]:
+        if not isinstance(op, dict) or op.get("op") not in OP_COLUMNS and op.get("op") != "tour":
+            raise ValueError(f"unknown operation: {op!r}")
+        kind = op["op"]
+        values = {key: value for key, value in op.items() if key not in ("op", "id")}
+        if kind == "tour":
+            if set(values) - {"name", "tags"}:
+                raise ValueError("tour operation changes only name and tags")
+            ops.append({"op": kind, "values": parse_tour_patch(values)})
+            continue
+        block_id = op.get("id")
+        is_key = isinstance(block_id, str) and 0 < len(block_id) <= MAX_BLOCK_KEY_LENGTH
+        if not (is_key or kind != "add" and type(block_id) is int):
+            raise ValueError(f"invalid block id in {kind} operation: {block_id!r}")
+        unknown = set(values) - OP_COLUMNS[kind]
+        if unknown:
+            raise ValueError(f"{kind} operation does not change {', '.join(sorted(unknown))}")
+        for name, value in values.items():
+            check_block_value(name, value)
+        ops.append({"op": kind, "id": block_id, "values": values})
+    return payload["version"], ops
+
+
+@bp.errorhandler(HTTPException)
+def json_error(error):
+    """! Ошибки API возвращаются в формате JSON."""
+    return jsonify(error=error.description), error.code
+
+
+@bp.after_request
+def compress(response):
+    """! Сжать ответ brotli или gzip, если клиент их поддерживает."""
+    if (response.direct_passthrough or response.status_code != 200 or "Content-Encoding" in response.headers
+            or response.content_length is None or response.content_length < MIN_COMPRESS_SIZE):
+        return response
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        encoding, data = "br", brotli.compress(response.get_data(), quality=5)
+    elif accepted["gzip"]:
+        encoding, data = "gzip", gzip.compress(response.get_data(), compresslevel=6)
+    else:
+        return response
+    response.set_data(data)
+    response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def get_tour_or_404(tour_id):
+    tour = db.session.get(Tour, tour_id)
+    if tour is None or tour.archived:
+        abort(404, "tour not found")
+    return tour
+
+
+def get_own_tour(tour_id):
+    """! Получить путеводитель для изменения текущим пользователем или прервать запрос с кодом 401/403/404."""
+    if current_user.is_anonymous:
+        abort(401, "login required")
+    tour = get_tour_or_404(tour_id)
+    if tour.created_by_id != current_user.id:
+        abort(403, "only the author can edit the tour")
+    return tour
+
+
+def version_conflict(tour_id):
+    """! Ответ 409 с текущей версией путеводителя."""
+    db.session.rollback()
+    version = db.session.query(Tour.version).filter(Tour.id == tour_id).scalar()
+    return jsonify(error="the tour was changed by another save", version=version), 409
+
+
+@bp.route("/tours/<int:tour_id>", methods=["get"])
+def get_tour(tour_id):
+    """! Эндпоинт получения путеводителя с блоками. Поддерживает условные запросы по ETag/Last-Modified."""
+    tour = get_tour_or_404(tour_id)
+    response = make_response()
+    # слабый ETag: сжатые и несжатые ответы для одной версии путеводителя равнозначны
+    response.set_etag(f"{tour.id}-{tour.version}-{tour.media_version}", weak=True)
+    response.last_modified = tour.last_updated_at
+    response.cache_control.no_cache = True
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+    blocks = (db.session.query(*[getattr(TourBlock, name) for name in BLOCK_COLUMNS])
+              .filter(TourBlock.tour_id == tour.id)
+              .order_by(TourBlock.id)
+              .all())
+    response.set_data(json.dumps(serialize_tour(tour, blocks), ensure_ascii=False, separators=(",", ":")))
+    response.mimetype = "application/json"
+    return response
+
+
+@bp.route("/tours/<int:tour_id>", methods=["put"])
+def put_tour(tour_id):
+    """! Эндпоинт частичного изменения путеводителя автором.
+    Возвращает новую версию, время изменения и идентификаторы вставленных блоков в порядке их следования в запросе.
+    Если передана версия и путеводитель с тех пор изменился, возвращает 409."""
+    tour = get_own_tour(tour_id)
+    try:
+        patch = parse_tour_patch(request.get_json(silent=True))
+        inserted = apply_tour_patch(tour, patch)
+    except TourVersionConflict:
+        return version_conflict(tour_id)
+    except ValueError as error:
+        db.session.rollback()
+        abort(400, str(error))
+    return jsonify(id=tour.id, version=tour.version, last_updated_at=tour.last_updated_at.isoformat(),
+                   inserted=inserted or [])
+
+
+@bp.route("/tours/<int:tour_id>", methods=["patch"])
+def patch_tour(tour_id):
+    """! Эндпоинт автосохранения редактора: применяет операции над блоками одной транзакцией.
+    Возвращает новую версию и идентификаторы добавленных блоков по временным ключам клиента,
+    при несовпадении версии - 409 с текущей версией."""
+    tour = get_own_tour(tour_id)
+    try:
+        version, ops = parse_tour_ops(request.get_json(silent=True))
+        ids = apply_tour_ops(tour, version, ops)
+    except TourVersionConflict:
+        return version_conflict(tour_id)
+    except ValueError as error:
+        db.session.rollback()
+        abort(400, str(error))
+    return jsonify(version=tour.version, ids=ids)
+
+
+@bp.route("/media", methods=["post"])
+def upload_media():
+    """! Эндпоинт загрузки файла блока. Возвращает имя файла для столбца content_path."""
+    if current_user.is_anonymous:
+        abort(401, "login required")
+    file = request.files.get("file")
+    if file is None or not file.filename:
+        abort(400, "file is required")
+    return jsonify(content_path=save_file(file))
+
+
+def serialize_job(job):
+    """! JSON представление фоновой задачи."""
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "error": job.error,
+        "created_at": job.created_at.isoformat(),
+        "run_at": job.run_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def serialize_moderation_item(item):
+    """! JSON представление элемента очереди модерации."""
+    return {
+        "tour_id": item.tour_id,
+        "queued_at": item.queued_at.isoformat(),
+        "claimed_by": item.claimed_by_id,
+        "claimed_until": item.claimed_until.isoformat() if item.claimed_until else None,
+    }
+
+
+def require_moderator():
+    if current_user.is_anonymous:
+        abort(401, "login required")
+    if not current_user.is_moderator:
+        abort(403, "moderators only")
+
+
+@bp.route("/jobs", methods=["get"])
+def list_jobs():
+    """! Эндпоинт состояния очереди задач для модераторов: количество задач по состоянию и последние задачи,
+    необязательно отфильтрованные по состоянию (аргумент status)."""
+    require_moderator()
+    counts = dict(db.session.query(Job.status, db.func.count()).group_by(Job.status).all())
+    query = db.session.query(Job)
+    if request.args.get("status"):
+        query = query.filter(Job.status == request.args["status"])
+    jobs = query.order_by(Job.id.desc()).limit(JOBS_PAGE_SIZE).all()
+    return jsonify(counts=counts, jobs=[serialize_job(job) for job in jobs])
+
+
+@bp.route("/jobs/<int:job_id>", methods=["get"])
+def get_job(job_id):
+    """! Эндпоинт состояния задачи. Доступен пользователю, по запросу которого создана задача, и модераторам."""
+    if current_user.is_anonymous:
+        abort(401, "login required")
+    job = db.session.get(Job, job_id)
+    if job is None or job.created_by_id != current_user.id and not current_user.is_moderator:
+        abort(404, "job not found")
+    return jsonify(serialize_job(job))
+
+
+@bp.route("/jobs/<int:job_id>/retry", methods=["post"])
+def retry_job(job_id):
+    """! Эндпоинт повторного запуска задачи, у которой закончились попытки. Только для модераторов."""
+    require_moderator()
+    job = db.session.get(Job, job_id)
+    if job is None:
+        abort(404, "job not found")
+    if job.status != JOB_FAILED:
+        abort(409, "only failed jobs can be retried")
+    job.status = JOB_QUEUED
+    job.attempts = 0
+    job.run_at = datetime.datetime.now()
+    job.finished_at = None
+    db.session.commit()
+    wakeup.set()
+    return jsonify(serialize_job(job))
+
+
+@bp.route("/moderation", methods=["get"])
+def list_moderation():
+    """! Эндпоинт очереди модерации для модераторов: ожидающие проверки путеводители в порядке очереди, по limit
+    на странице (не больше claim_size). Следующая страница запрашивается с курсором next_cursor (аргумент cursor)."""
+    require_moderator()
+    limit = min(request.args.get("limit", moderation_setting("claim_size", 20), type=int),
+                moderation_setting("max_decisions", 500))
+    if limit <= 0:
+        abort(400, "limit must be positive")
+    items, next_cursor = pending_page(request.args.get("cursor"), limit)
+    return jsonify(items=[serialize_moderation_item(item) for item in items], next_cursor=next_cursor)
+
+
+@bp.route("/moderation/claim", methods=["post"])
+def claim_moderation():
+    """! Эндпоинт получения путеводителей на проверку: первые в очереди путеводители, которые не проверяет другой
+    модератор, закрепляются за текущим модератором на lease секунд. Необязательное поле JSON limit."""
+    require_moderator()
+    body = request.get_json(silent=True) or {}
+    limit = body.get("limit") if isinstance(body, dict) else None
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0):
+        abort(400, "limit must be a positive integer")
+    limit = min(limit or moderation_setting("claim_size", 20), moderation_setting("max_decisions", 500))
+    return jsonify(tours=claim(current_user.id, limit), lease=moderation_setting("lease", 900))
+
+
+@bp.route("/export", methods=["get"])
+def export_bundle():
+    """! Эндпоинт экспорта путеводителей архивом tar.gz (см. bundles.py): путеводители tours и все путеводители
+    пользователей users (списки через запятую: идентификаторы и логины). Пользователь может экспортировать только свои
+    путеводители, модератор - любые. Архив передается по частям по мере формирования."""
+    if current_user.is_anonymous:
+        abort(401, "login required")
+    try:
+        tour_ids = [int(value) for value in request.args.get("tours", "").split(",") if value]
+    except ValueError:
+        abort(400, "tours must be a comma separated list of ids")
+    logins = [value for value in request.args.get("users", "").split(",") if value]
+    if logins:
+        tour_ids += user_tour_ids(row[0] for row in db.session.query(User.id).filter(User.login.in_(logins)))
+    if not tour_ids:
+        abort(400, "nothing to export")
+    if not current_user.is_moderator and db.session.query(Tour.id).filter(
+            Tour.id.in_(tour_ids), Tour.created_by_id != current_user.id).first() is not None:
+        abort(403, "only own tours can be exported")
+    return Response(stream_with_context(export_tours(tour_ids)), mimetype="application/gzip",
+                    headers={"Content-Disposition": "attachment; filename=tours.tar.gz"})
+
+
+@bp.route("/import", methods=["post"])
+def import_bundle():
+    """! Эндпоинт импорта архива путеводителей (тело запроса - tar или tar.gz из /api/v1/export), читаемого по мере
+    получения. Все путеводители архива получает текущий пользователь и они ставятся в очередь модерации; у модератора
+    путеводители, опубликованные в исходной БД, сразу публикуются от его имени. Возвращает новые идентификаторы
+    путеводителей. Путеводители архива вставляются группами, поэтому при ошибке (400) уже вставленные группы остаются.
+    Категории, которых нет в БД, создает только модератор, у остальных пользователей они пропускаются. Размер тела
+    запроса и распакованного архива ограничен параметрами max_import_size и max_unpacked_size секции BUNDLES."""
+    if current_user.is_anonymous:
+        abort(401, "login required")
+    if request.content_length is None:
+        abort(411, "Content-Length required")
+    if request.content_length > bundle_setting("max_import_size", 256 * 2 ** 20):
+        abort(413, "archive is too large")
+    try:
+        result = import_archive(request.stream, owner_id=current_user.id,
+                                moderator_id=current_user.id if current_user.is_moderator else None,
+                                keep_authors=False, create_tags=current_user.is_moderator,
+                                max_unpacked_size=bundle_setting("max_unpacked_size", 2 ** 30))
+    except ValueError as error:
+        abort(400, str(error))
+    return jsonify(result)
@@ -0,0 +1,368 @@
+##
+# @file
+#
+# @brief Файл экспорта и импорта путеводителей архивами.
+#
+# @section desctiption_bundles Description
+# Архив путеводителей - tar (необязательно сжатый gzip), файлы которого идут в таком порядке: manifest.json (формат,
+# количество путеводителей и списки остальных файлов), media/<имя> - файлы блоков из UPLOAD_FOLDER и
+# tours/<номер>.json - путеводители группами по TOURS_PER_FILE с блоками по столбцам, как в JSON API.
+# Экспорт формирует архив частями (генератор bytes): в памяти находятся только одна группа путеводителей и одна часть
+# файла. Импорт читает архив последовательно, не распаковывая его: файлы сохраняются в хранилище под именем из хэша
+# содержимого, поэтому уже имеющиеся файлы не дублируются, а путеводители каждой группы вставляются пакетными
+# запросами INSERT в одной транзакции. Ограничения размера импортируемых архивов задаются секцией BUNDLES файла
+# config.ini.
+
+import datetime
+import json
+import math
+import os
+import tarfile
+import time
+import zlib
+
+from flask import current_app
+from sqlalchemy import insert
+from werkzeug.utils import secure_filename
+
+from app import db, search
+from app.config import config
+from app.models import Tour, TourBlock, TourTag, User, ModerationItem, tours_to_tags_association, \
+    TOUR_BLOCK_IMAGE_TYPE, MODERATION_PENDING
+from app.logic import rebuild_ratings, rebuild_user_summaries, NEW_BLOCK_DEFAULTS
+from app.storage import save_stream, CHUNK_SIZE
+from app.media import queue_variants
+
+def bundle_setting(key, default):
+    """! Параметр секции BUNDLES файла config.ini (целое число)."""
+    return int(config["BUNDLES"].get(key, default)) if config.has_section("BUNDLES") else int(default)
+
+
+## Название формата в manifest.json
+BUNDLE_FORMAT = "tourspoon-tours"
+## Версия формата архива
+BUNDLE_VERSION = 1
+## Количество путеводителей в одном файле tours/<номер>.json
+TOURS_PER_FILE = 500
+## Размер частей, которыми отдается архив
+OUTPUT_CHUNK_SIZE = 64 * 1024
+## Уровень сжатия gzip
+GZIP_LEVEL = 6
+
+## Столбцы блоков в архиве в порядке следования
+BLOCK_COLUMNS = ["name", "text", "content_path", "type", "show_on_map", "latitude", "longitude", "column", "row",
+                 "height", "width"]
+
+
+def tar_member(name, size, chunks):
+    """! Части записи tar: заголовок, содержимое и дополнение нулями до границы блока.
+    @param name Имя файла в архиве.
+    @param size Размер содержимого в байтах.
+    @param chunks Части содержимого.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(time.time())
+    info.mode = 0o644
+    yield info.tobuf(format=tarfile.PAX_FORMAT)
+    yield from chunks
+    if size % tarfile.BLOCKSIZE:
+        yield tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE)
+
+
+def json_member(name, value):
+    """! Части записи tar с JSON представлением значения."""
+    data = json.dumps(value, ensure_ascii=False).encode()
+    return tar_member(name, len(data), [data])
+
+
+def file_chunks(path):
+    """! Содержимое файла частями по CHUNK_SIZE байт."""
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            yield chunk
+
+
+def buffered(chunks, size=OUTPUT_CHUNK_SIZE):
+    """! Объединить мелкие части (заголовки tar, дополнения) в части не меньше size байт."""
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def gzip_chunks(chunks):
+    """! Сжать поток частей в формат gzip, не собирая его в памяти."""
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if data := compressor.compress(chunk):
+            yield data
+    yield compressor.flush()
+
+
+def user_tour_ids(user_ids):
+    """! Идентификаторы не удаленных путеводителей пользователей."""
+    return [row[0] for row in db.session.query(Tour.id)
+            .filter(Tour.created_by_id.in_(list(user_ids)), Tour.archived == False).order_by(Tour.id)]
+
+
+def visible_tour_ids(tour_ids):
+    """! Отобрать из идентификаторов существующие не удаленные путеводители.
+
+    @returns список идентификаторов по возрастанию
+    """
+    tour_ids, visible = sorted(set(tour_ids)), []
+    for start in range(0, len(tour_ids), TOURS_PER_FILE):
+        visible += [row[0] for row in db.session.query(Tour.id)
+                    .filter(Tour.id.in_(tour_ids[start:start + TOURS_PER_FILE]), Tour.archived == False)]
+    return sorted(visible)
+
+
+def media_names(tour_ids):
+    """! Имена файлов блоков путеводителей без повторов, в порядке имен."""
+    names = set()
+    for start in range(0, len(tour_ids), TOURS_PER_FILE):
+        names.update(row[0] for row in db.session.query(TourBlock.content_path).distinct()
+                     .filter(TourBlock.tour_id.in_(tour_ids[start:start + TOURS_PER_FILE]),
+                             TourBlock.content_path != None, TourBlock.content_path != ""))
+    return sorted(names)
+
+
+def serialize_tours(tour_ids):
+    """! JSON представление группы путеводителей: свойства, логин автора, названия категорий и блоки по столбцам.
+    Загружается тремя запросами на группу."""
+    tags, blocks = {}, {}
+    for tour_id, name in (db.session.query(tours_to_tags_association.c.tour_id, TourTag.name)
+                          .join(TourTag, TourTag.id == tours_to_tags_association.c.tag_id)
+                          .filter(tours_to_tags_association.c.tour_id.in_(tour_ids))):
+        tags.setdefault(tour_id, []).append(name)
+    for row in (db.session.query(TourBlock.tour_id, *[getattr(TourBlock, column) for column in BLOCK_COLUMNS])
+                .filter(TourBlock.tour_id.in_(tour_ids))
+                .order_by(TourBlock.tour_id, TourBlock.id)):
+        columns = blocks.setdefault(row[0], {column: [] for column in BLOCK_COLUMNS})
+        for column, value in zip(BLOCK_COLUMNS, row[1:]):
+            columns[column].append(value)
+    tours = (db.session.query(Tour.id, Tour.name, Tour.canvas_height, Tour.canvas_width, Tour.last_updated_at,
+                              Tour.moderated_by_id, User.login)
+             .join(User, User.id == Tour.created_by_id)
+             .filter(Tour.id.in_(tour_ids))
+             .order_by(Tour.id))
+    return [{
+        "id": tour.id,
+        "name": tour.name,
+        "author": tour.login,
+        "published": tour.moderated_by_id is not None,
+        "canvas_height": tour.canvas_height,
+        "canvas_width": tour.canvas_width,
+        "last_updated_at": tour.last_updated_at.isoformat(),
+        "tags": tags.get(tour.id, []),
+        "blocks": blocks.get(tour.id, {column: [] for column in BLOCK_COLUMNS}),
+    } for tour in tours]
+
+
+def export_tours(tour_ids, compress=True):
+    """! Экспортировать путеводители архивом (удаленные путеводители пропускаются). Список файлов определяется сразу,
+    а путеводители загружаются группами по мере чтения архива, поэтому генератор нужно читать в контексте приложения.
+    Файлы, которых нет в хранилище, перечисляются в manifest.json в missing_media.
+    @param tour_ids Идентификаторы путеводителей.
+    @param compress Сжать архив gzip.
+
+    @returns генератор частей архива (bytes)
+    """
+    tour_ids = visible_tour_ids(tour_ids)
+    folder = current_app.config['UPLOAD_FOLDER']
+    media, missing = [], []
+    for name in media_names(tour_ids):
+        path = os.path.join(folder, name)
+        (media if name == secure_filename(name) and os.path.isfile(path) else missing).append(name)
+    tour_files = [f"tours/{index:06d}.json" for index in range(math.ceil(len(tour_ids) / TOURS_PER_FILE))]
+    manifest = {"format": BUNDLE_FORMAT, "version": BUNDLE_VERSION,
+                "exported_at": datetime.datetime.now().isoformat(timespec="seconds"),
+                "tours": len(tour_ids), "tour_files": tour_files, "media": media, "missing_media": missing}
+
+    def members():
+        yield from json_member("manifest.json", manifest)
+        for name in media:
+            path = os.path.join(folder, name)
+            yield from tar_member("media/" + name, os.path.getsize(path), file_chunks(path))
+        for index, tour_file in enumerate(tour_files):
+            chunk = tour_ids[index * TOURS_PER_FILE:(index + 1) * TOURS_PER_FILE]
+            yield from json_member(tour_file, {"tours": serialize_tours(chunk)})
+        # конец архива - два пустых блока
+        yield tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+
+    chunks = buffered(members())
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def parse_tour(tour, stored):
+    """! Проверить путеводитель из архива. Имена файлов блоков заменяются именами в хранилище, файлы, которых
+    не было в архиве, у блоков убираются.
+    @param tour Путеводитель из файла tours/<номер>.json.
+    @param stored Словарь {<имя файла в архиве>: <имя файла в хранилище>}.
+
+    @returns словарь свойств путеводителя с блоками в виде списка словарей значений столбцов
+    """
+    from app.api import parse_block_columns
+    if not isinstance(tour, dict):
+        raise ValueError("tour must be an object")
+    if not isinstance(tour.get("name"), str) or not 0 < len(tour["name"]) <= 50:
+        raise ValueError("tour name must be a non-empty string of at most 50 characters")
+    if not isinstance(tour.get("author"), str):
+        raise ValueError("tour author must be a login")
+    if not isinstance(tour.get("last_updated_at"), str):
+        raise ValueError("last_updated_at must be an ISO date")
+    for key in ("canvas_height", "canvas_width"):
+        if type(tour.get(key)) is not int or tour[key] <= 0:
+            raise ValueError(f"{key} must be a positive integer")
+    tags = tour.get("tags", [])
+    if not isinstance(tags, list) or not all(isinstance(tag, str) and 0 < len(tag) <= 50 for tag in tags):
+        raise ValueError("tags must be a list of category names")
+    blocks = tour.get("blocks", {})
+    if isinstance(blocks, dict) and isinstance(blocks.get("content_path"), list):
+        blocks = {**blocks, "content_path": [stored.get(name, "") if isinstance(name, str) or name is None else name
+                                             for name in blocks["content_path"]]}
+    blocks = parse_block_columns(blocks)
+    if any("id" in block for block in blocks):
+        raise ValueError("blocks of an archive have no ids")
+    return {"name": tour["name"], "author": tour["author"], "published": tour.get("published") is True,
+            "canvas_height": tour["canvas_height"], "canvas_width": tour["canvas_width"],
+            "last_updated_at": datetime.datetime.fromisoformat(tour["last_updated_at"]),
+            "tags": tags, "blocks": blocks}
+
+
+def tag_ids_by_name(names, create=True):
+    """! Идентификаторы категорий по названиям.
+    @param names Названия категорий.
+    @param create Создать недостающие категории; False - названия, которых нет в БД, пропускаются.
+    """
+    found = {name: tag_id for tag_id, name in db.session.query(TourTag.id, TourTag.name)
+             .filter(TourTag.name.in_(list(names)))}
+    if not create:
+        return found
+    for name in set(names) - set(found):
+        tag = TourTag(name)
+        db.session.add(tag)
+        db.session.flush()
+        found[name] = tag.id
+    return found
+
+
+def import_tours(tours, stored, owner_id=None, moderator_id=None, keep_authors=True, create_tags=True):
+    """! Вставить группу путеводителей из архива пакетными запросами и зафиксировать транзакцию.
+    @param tours Путеводители из файла tours/<номер>.json.
+    @param stored Словарь {<имя файла в архиве>: <имя файла в хранилище>}.
+    @param owner_id Владелец путеводителей, автора которых нет в БД; None - такие путеводители пропускаются.
+    @param moderator_id Модератор, от имени которого сразу публикуются путеводители, опубликованные в исходной БД;
+    None - все путеводители ставятся в очередь модерации.
+    @param keep_authors Искать авторов по логину; False - все путеводители получает owner_id.
+    @param create_tags Создавать категории, которых нет в БД; False - такие категории у путеводителей не сохраняются.
+
+    @returns идентификаторы вставленных путеводителей, количество пропущенных путеводителей
+    """
+    if not isinstance(tours, list):
+        raise ValueError("tours must be a list")
+    tours = [parse_tour(tour, stored) for tour in tours]
+    authors = {}
+    if keep_authors:
+        authors = dict(db.session.query(User.login, User.id)
+                       .filter(User.login.in_({tour["author"] for tour in tours})))
+    rows = [(tour, authors.get(tour["author"], owner_id)) for tour in tours]
+    rows = [(tour, author_id) for tour, author_id in rows if author_id is not None]
+    skipped = len(tours) - len(rows)
+    if not rows:
+        return [], skipped
+    tag_ids = tag_ids_by_name({name for tour, _ in rows for name in tour["tags"]}, create_tags)
+    # строки одного INSERT получают возрастающие id в порядке следования
+    tour_ids = sorted(db.session.execute(insert(Tour).returning(Tour.id), [
+        {"name": tour["name"], "canvas_height": tour["canvas_height"], "canvas_width": tour["canvas_width"],
+         "last_updated_at": tour["last_updated_at"], "archived": False, "version": 1, "created_by_id": author_id,
+         "moderated_by_id": moderator_id if tour["published"] else None}
+        for tour, author_id in rows]).scalars())
+    blocks, links, queued, images = [], [], [], set()
+    now = datetime.datetime.now()
+    for tour_id, (tour, _) in zip(tour_ids, rows):
+        for block in tour["blocks"]:
+            values = {**NEW_BLOCK_DEFAULTS, **block, "tour_id": tour_id, "content_variants": None}
+            values["content_path"] = values["content_path"] or ""
+            if values["type"] == TOUR_BLOCK_IMAGE_TYPE and values["content_path"]:
+                images.add(values["content_path"])
+            blocks.append(values)
+        links += [{"tour_id": tour_id, "tag_id": tag_ids[name]} for name in set(tour["tags"]) if name in tag_ids]
+        if not (moderator_id and tour["published"]):
+            queued.append({"tour_id": tour_id, "status": MODERATION_PENDING, "queued_at": now})
+    if blocks:
+        # пакетная вставка ORM разбивает пакет на строки с None в столбцах со значением по умолчанию,
+        # вставка в таблицу выполняет один executemany
+        db.session.execute(insert(TourBlock.__table__), blocks)
+    if links:
+        db.session.execute(insert(tours_to_tags_association), links)
+    if queued:
+        db.session.execute(insert(ModerationItem), queued)
+    rebuild_ratings(tour_ids)
+    search.index_tours(tour_ids)
+    rebuild_user_summaries({author_id for _, author_id in rows})
+    db.session.commit()
+    queue_variants(images)
+    return tour_ids, skipped
+
+
+def import_archive(fileobj, owner_id=None, moderator_id=None, keep_authors=True, create_tags=True,
+                   max_unpacked_size=None):
+    """! Импортировать путеводители из архива export_tours, читая его последовательно (tar или tar.gz).
+    Путеводители получают новые идентификаторы; автор определяется по логину (см. import_tours).
+    Группы путеводителей фиксируются по отдельности, поэтому при ошибке в архиве уже импортированные группы остаются.
+    @param fileobj Файловый объект архива, открытый для чтения в двоичном режиме.
+    @param owner_id Владелец путеводителей, автора которых нет в БД.
+    @param moderator_id Модератор, от имени которого публикуются опубликованные в исходной БД путеводители.
+    @param keep_authors Искать авторов по логину; False - все путеводители получает owner_id.
+    @param create_tags Создавать категории, которых нет в БД.
+    @param max_unpacked_size Наибольший суммарный размер файлов архива в байтах; None - без ограничения.
+
+    @returns словарь {"tours": [<новые идентификаторы>], "skipped": <пропущено путеводителей>,
+    "media": <сохранено файлов>}
+    """
+    result = {"tours": [], "skipped": 0, "media": 0}
+    manifest, stored, unpacked = None, {}, 0
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile():
+                    continue
+                unpacked += member.size
+                if max_unpacked_size is not None and unpacked > max_unpacked_size:
+                    raise ValueError("archive is too large")
+                stream = archive.extractfile(member)
+                if manifest is None:
+                    if member.name != "manifest.json":
+                        raise ValueError("manifest.json must be the first file of the archive")
+                    manifest = json.load(stream)
+                    if not isinstance(manifest, dict) or manifest.get("format") != BUNDLE_FORMAT \
+                            or manifest.get("version") != BUNDLE_VERSION:
+                        raise ValueError("unsupported archive format")
+                    media, tour_files = set(manifest.get("media", [])), set(manifest.get("tour_files", []))
+                elif member.name.startswith("media/") and member.name[len("media/"):] in media:
+                    name = member.name[len("media/"):]
+                    stored[name] = save_stream(stream, name)
+                    result["media"] += 1
+                elif member.name in tour_files:
+                    data = json.load(stream)
+                    tour_ids, skipped = import_tours(data.get("tours") if isinstance(data, dict) else None, stored,
+                                                     owner_id, moderator_id, keep_authors, create_tags)
+                    result["tours"] += tour_ids
+                    result["skipped"] += skipped
+                else:
+                    raise ValueError(f"unexpected file in the archive: {member.name}")
+    except (tarfile.TarError, EOFError, zlib.error) as error:
+        db.session.rollback()
+        raise ValueError(f"damaged archive: {error}")
+    except ValueError:
+        db.session.rollback()
+        raise
+    if manifest is None:
+        raise ValueError("archive has no manifest.json")
+    return result
@@ -0,0 +1,208 @@
+##
+# @file
+#
+# @brief Файл с кэшем отрисованных фрагментов.
+#
+# @section desctiption_cache Description
+# Содержит LRU кэш, хранящийся в памяти процесса, и кэш в локальном файле SQLite, который может использоваться
+# совместно несколькими процессами-обработчиками. Нужный вариант выбирается в секции CACHE файла config.ini.
+# Поля пользователей сессий кэшируются в памяти процесса на короткое время (UserCache). Изменения пользователя
+# записываются в таблицу user_invalidations в транзакции изменения, а каждый процесс не чаще раза в user_sync_interval
+# секунд читает новые записи и удаляет поля этих пользователей из своего кэша.
+
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+from werkzeug.local import LocalProxy
+
+from app.config import project_path
+
+
+class LRUCache:
+    """! Кэш в памяти процесса с вытеснением давно не использованных элементов"""
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """! Получить значение по ключу или None, если его нет в кэше."""
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def set(self, key, value):
+        """! Сохранить значение, вытеснив самые старые элементы при превышении размера."""
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        """! Удалить значение по ключу, если оно есть."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class TTLCache(LRUCache):
+    """! Кэш в памяти процесса с вытеснением давно не использованных элементов, элементы которого устаревают
+    через ttl секунд после сохранения. При ttl 0 кэш ничего не хранит."""
+
+    def __init__(self, max_size=1000, ttl=60):
+        super().__init__(max_size)
+        self.ttl = ttl
+
+    def get(self, key):
+        item = super().get(key)
+        if item is None or item[0] < time.monotonic():
+            return None
+        return item[1]
+
+    def set(self, key, value):
+        if self.ttl > 0:
+            super().set(key, (time.monotonic() + self.ttl, value))
+
+
+class UserCache(TTLCache):
+    """! Кэш полей пользователей сессий в памяти процесса, синхронизируемый с остальными процессами через таблицу
+    user_invalidations (см. invalidate_user)."""
+
+    def __init__(self, max_size=10000, ttl=60, sync_interval=1):
+        super().__init__(max_size, ttl)
+        self.sync_interval = sync_interval
+        self._next_sync = 0
+        self._last_id = None
+
+    def sync(self):
+        """! Удалить из кэша поля пользователей, измененных после предыдущей синхронизации, если с нее прошло больше
+        sync_interval секунд. Выполняет не больше одного запроса к БД."""
+        from app import db
+        from app.models import UserInvalidation
+        now = time.monotonic()
+        if now < self._next_sync:
+            return
+        self._next_sync = now + self.sync_interval
+        if self._last_id is None:
+            # кэш только что создан и пуст, достаточно запомнить последнюю запись
+            self._last_id = db.session.query(db.func.max(UserInvalidation.id)).scalar() or 0
+            return
+        rows = (db.session.query(UserInvalidation.id, UserInvalidation.user_id)
+                .filter(UserInvalidation.id > self._last_id)
+                .order_by(UserInvalidation.id)
+                .all())
+        for row in rows:
+            self.delete(user_cache_key(row.user_id))
+        if rows:
+            self._last_id = rows[-1].id
+
+
+class SqliteCache:
+    """! Кэш в локальном файле SQLite, общий для всех процессов на одной машине. Значения сериализуются в JSON.
+    Время последнего использования, по которому вытесняются элементы, обновляется при чтении не чаще раза
+    в touch_interval секунд, чтобы чтение из кэша почти никогда не требовало блокировки файла на запись."""
+
+    def __init__(self, path, max_size=1000, touch_interval=60):
+        self.path = path
+        self.max_size = max_size
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, accessed_at REAL NOT NULL)")
+        self._connection().execute("CREATE INDEX IF NOT EXISTS ix_cache_accessed_at ON cache (accessed_at)")
+
+    def _connection(self):
+        # соединения sqlite3 нельзя передавать между потоками, поэтому у каждого потока свое
+        if not hasattr(self._local, "connection"):
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return self._local.connection
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute("SELECT value, accessed_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > self.touch_interval:
+            connection.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        connection = self._connection()
+        connection.execute("INSERT OR REPLACE INTO cache (key, value, accessed_at) VALUES (?, ?, ?)",
+                           (key, json.dumps(value), time.time()))
+        connection.execute("DELETE FROM cache WHERE key IN "
+                           "(SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_size,))
+
+    def delete(self, key):
+        self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+
+
+## Доступные реализации кэша, ключ - значение параметра backend в секции CACHE
+CACHE_BACKENDS = {
+    "memory": lambda section: LRUCache(int(section.get("max_size", 1000))),
+    "sqlite": lambda section: SqliteCache(project_path(section.get("path", "cache.db")),
+                                          int(section.get("max_size", 1000)),
+                                          int(section.get("touch_interval", 60))),
+}
+
+
+def make_cache(section):
+    """! Создать кэш по параметрам секции конфигурации.
+    @param section Секция конфигурации с параметрами backend, max_size, path (для sqlite, относительно корня
+    проекта) и touch_interval (для sqlite).
+
+    @returns объект кэша с методами get, set, delete, clear
+    """
+    return CACHE_BACKENDS[section.get("backend", "memory")](section)
+
+
+## Кэш отрисованных блоков путеводителей (tour_canvas.html) текущего приложения, создается в create_app
+canvas_cache = LocalProxy(lambda: current_app.extensions["canvas_cache"])
+
+
+def canvas_cache_key(tour_id):
+    """! Ключ кэша отрисованных блоков путеводителя."""
+    return f"canvas:{tour_id}"
+
+
+def invalidate_tour_canvas(tour_id):
+    """! Удалить из кэша отрисованные блоки путеводителя. Вызывается при любом изменении или удалении путеводителя."""
+    canvas_cache.delete(canvas_cache_key(tour_id))
+
+
+## Кэш полей пользователей сессий (models.SESSION_USER_FIELDS) текущего приложения, создается в create_app.
+# Хранится в памяти процесса, изменения, сделанные в другом процессе, видны не позже чем через user_sync_interval секунд
+user_cache = LocalProxy(lambda: current_app.extensions["user_cache"])
+
+
+def user_cache_key(user_id):
+    """! Ключ кэша полей пользователя."""
+    return f"user:{user_id}"
+
+
+def invalidate_user(user_id):
+    """! Удалить из кэша поля пользователя во всех процессах. Вызывается при изменении логина, пароля, прав или удалении
+    пользователя до фиксации транзакции: запись в user_invalidations становится видна остальным процессам вместе
+    с изменением, поэтому они не загрузят старые поля повторно."""
+    from app import db
+    from app.models import UserInvalidation
+    user_cache.delete(user_cache_key(user_id))
+    db.session.add(UserInvalidation(user_id))
@@ -0,0 +1,139 @@
+##
+# @file
+#
+# @brief Файл команд командной строки.
+#
+# @section desctiption_commands Description
+# Команды обслуживания БД, выполняемые явно до запуска сервера, а не при каждом импорте приложения:
+# `flask --app main migrate` создает и обновляет схему, `flask --app main seed` заполняет начальные данные.
+# `flask --app main worker` выполняет фоновые задачи в отдельном процессе (см. jobs.py).
+# `flask --app main delete-users` удаляет пользователей вместе с их путеводителями наборными запросами.
+# `flask --app main rebuild-summaries` проверяет сводки пользователей и пересчитывает их.
+# `flask --app main export-tours` и `import-tours` выгружают путеводители с файлами в архив и загружают их из архива.
+
+import click
+from flask import current_app
+
+
+@click.command("migrate")
+def migrate_command():
+    """Create missing tables and apply migrations."""
+    from app.migrations import upgrade
+    upgrade()
+    click.echo("Database is up to date")
+
+
+@click.command("seed")
+def seed_command():
+    """Add initial data (tour tags) if it is missing."""
+    from app.logic import init_db
+    init_db()
+    click.echo("Initial data is in place")
+
+
+@click.command("worker")
+@click.option("--threads", type=int, help="Number of worker threads (see the JOBS section of config.ini).")
+def worker_command(threads):
+    """Run background jobs until interrupted."""
+    from app.jobs import start_workers
+    stop, workers = start_workers(current_app._get_current_object(), threads)
+    click.echo(f"Running {len(workers)} job worker threads, press Ctrl+C to stop")
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop.set()
+
+
+@click.command("delete-users")
+@click.argument("logins", nargs=-1, required=True)
+def delete_users_command(logins):
+    """Delete users by login together with their tours and reactions."""
+    from app import db
+    from app.models import User
+    from app.logic import delete_users
+    user_ids = [row[0] for row in db.session.query(User.id).filter(User.login.in_(logins))]
+    if not user_ids:
+        raise click.ClickException("No such users")
+    deleted = delete_users(user_ids)
+    click.echo(f"Deleted {len(user_ids)} users and {deleted} tours")
+
+
+@click.command("rebuild-summaries")
+@click.option("--check", is_flag=True, help="Only report inconsistent summaries, do not rebuild them.")
+def rebuild_summaries_command(check):
+    """Check per-user summaries against tours and reactions and rebuild them in bulk."""
+    from app import db
+    from app.logic import check_user_summaries, rebuild_user_summaries
+    inconsistent = check_user_summaries()
+    click.echo(f"{inconsistent} user summaries are missing or out of date")
+    if not check:
+        rebuild_user_summaries()
+        db.session.commit()
+        click.echo("User summaries rebuilt")
+
+
+@click.command("export-tours")
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--tour", "tour_ids", type=int, multiple=True, help="Tour id to export (repeatable).")
+@click.option("--user", "logins", multiple=True, help="Export all tours of this login (repeatable).")
+@click.option("--all", "all_tours", is_flag=True, help="Export every tour.")
+def export_tours_command(path, tour_ids, logins, all_tours):
+    """Export tours with their media into a .tar.gz archive (plain .tar if PATH ends with .tar, - for stdout)."""
+    from app import db
+    from app.models import Tour, User
+    from app.bundles import export_tours, user_tour_ids
+    tour_ids = list(tour_ids)
+    if logins:
+        tour_ids += user_tour_ids(row[0] for row in db.session.query(User.id).filter(User.login.in_(logins)))
+    if all_tours:
+        tour_ids = [row[0] for row in db.session.query(Tour.id).filter(Tour.archived == False)]
+    if not tour_ids:
+        raise click.ClickException("Nothing to export: pass --tour, --user or --all")
+    with click.open_file(path, "wb") as file:
+        for chunk in export_tours(tour_ids, compress=not path.endswith(".tar")):
+            file.write(chunk)
+    click.echo(f"Exported {len(set(tour_ids))} tours to {path}", err=path == "-")
+
+
+@click.command("import-tours")
+@click.argument("path", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--owner", help="Login that receives tours whose author does not exist here; "
+                              "without it such tours are skipped.")
+@click.option("--publish-as", help="Moderator login that publishes tours published in the source; "
+                                   "without it all tours go to the moderation queue.")
+def import_tours_command(path, owner, publish_as):
+    """Import tours and media from an archive made by export-tours."""
+    from app import db
+    from app.models import User
+    from app.bundles import import_archive
+
+    def user_id(login, moderator=False):
+        if login is None:
+            return None
+        query = db.session.query(User.id).filter(User.login == login)
+        if moderator:
+            query = query.filter(User.is_moderator == True)
+        found = query.scalar()
+        if found is None:
+            raise click.ClickException(f"No such {'moderator' if moderator else 'user'}: {login}")
+        return found
+
+    with click.open_file(path, "rb") as file:
+        try:
+            result = import_archive(file, owner_id=user_id(owner), moderator_id=user_id(publish_as, moderator=True))
+        except ValueError as error:
+            raise click.ClickException(str(error))
+    click.echo(f"Imported {len(result['tours'])} tours and {result['media']} files, "
+               f"skipped {result['skipped']} tours without an author")
+
+
+def register(app):
+    """! Зарегистрировать команды в приложении."""
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(seed_command)
+    app.cli.add_command(worker_command)
+    app.cli.add_command(delete_users_command)
+    app.cli.add_command(rebuild_summaries_command)
+    app.cli.add_command(export_tours_command)
+    app.cli.add_command(import_tours_command)
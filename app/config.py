@@ -4,13 +4,41 @@
 # @brief Файл чтения конфигурации.
 #
 # @section desctiption_config Description
-# В данном файле производится чтение конфигурационных данных из файла config.ini. Отсюда объект config можеть быть импортирован и использован в любом другом файле.
+# В данном файле производится чтение конфигурационных данных из файла config.ini. Объект config можеть быть
+# импортирован в любом другом файле и указывает на конфигурацию текущего приложения (см. create_app).
 
 import configparser
+import os
 
-## Путь к файлу конфигурации. Использует формат ini.
-INI_FILE_PATH = "config.ini"
+from flask import current_app
+from werkzeug.local import LocalProxy
 
-config = configparser.ConfigParser()
+## Корень проекта (директория, содержащая пакет app)
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
-config.read(INI_FILE_PATH)
+## Путь к файлу конфигурации. Использует формат ini. Может быть переопределен переменной окружения TOURSPOON_CONFIG.
+INI_FILE_PATH = os.environ.get("TOURSPOON_CONFIG", os.path.join(PROJECT_ROOT, "config.ini"))
+
+
+def load_config(source=None):
+    """! Прочитать конфигурацию.
+    @param source Путь к ini файлу, готовый ConfigParser или None для файла по умолчанию (INI_FILE_PATH).
+
+    @returns ConfigParser
+    """
+    if isinstance(source, configparser.ConfigParser):
+        return source
+    config = configparser.ConfigParser()
+    path = source or os.environ.get("TOURSPOON_CONFIG", INI_FILE_PATH)
+    if not config.read(path):
+        raise FileNotFoundError(f"Configuration file not found: {path}")
+    return config
+
+
+def project_path(path):
+    """! Преобразовать путь из конфигурации, заданный относительно корня проекта, в абсолютный."""
+    return path if os.path.isabs(path) else os.path.join(PROJECT_ROOT, path)
+
+
+## Конфигурация текущего приложения
+config = LocalProxy(lambda: current_app.config["INI"])
@@ -0,0 +1,158 @@
+##
+# @file
+#
+# @brief Файл настройки соединений с базой данных.
+#
+# @section desctiption_database Description
+# Параметры пула соединений и PRAGMA для SQLite берутся из секции DATABASE файла config.ini. PRAGMA выполняются
+# для каждого нового соединения: WAL позволяет читать во время записи, busy_timeout заставляет ждать освобождения
+# блокировки вместо немедленной ошибки "database is locked".
+# Если read_routing = 1, для чтения создается отдельный движок (bind READ_BIND) с собственным пулом: read_uri или,
+# для SQLite, тот же файл, открытый только для чтения (режим URI mode=ro). Сессия RoutingSession направляет в него
+# запросы GET и HEAD, пока они ничего не записывают; первая запись переводит сессию на основной движок до конца
+# запроса. После запроса с записью клиент sticky_seconds секунд читает из основного движка (read-your-writes), чтобы
+# увидеть свои изменения даже при отстающей реплике.
+
+import time
+
+from flask import request, session as client_session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.dml import UpdateBase
+
+## Параметры пула соединений SQLAlchemy, которые можно задать в секции DATABASE, и их типы
+POOL_OPTIONS = {"pool_size": int, "max_overflow": int, "pool_timeout": float, "pool_recycle": int}
+
+## PRAGMA, которые можно задать в секции DATABASE, и их значения по умолчанию
+SQLITE_PRAGMAS = {"journal_mode": "wal", "synchronous": "normal", "busy_timeout": "5000", "mmap_size": "268435456"}
+
+## PRAGMA, которые меняют файл БД и не выполняются для соединений только для чтения
+SQLITE_WRITE_PRAGMAS = ("journal_mode", "synchronous")
+
+## Ключ движка чтения в SQLALCHEMY_BINDS
+READ_BIND = "read"
+
+## Методы запросов, которые читают из движка чтения
+READ_METHODS = ("GET", "HEAD")
+
+## Ключ в cookie сессии клиента со временем его последней записи в БД
+WRITTEN_AT_KEY = "db_written_at"
+
+
+def engine_options(section):
+    """! Параметры create_engine для SQLALCHEMY_ENGINE_OPTIONS.
+    @param section Секция DATABASE конфигурации.
+    """
+    options = {}
+    if ":memory:" not in section["uri"]:
+        for key, type_ in POOL_OPTIONS.items():
+            if section.get(key):
+                options[key] = type_(section[key])
+    if section["uri"].startswith("sqlite"):
+        # соединения берутся из пула разными потоками, но никогда не используются двумя потоками одновременно
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+def read_only_uri(uri):
+    """! URI соединения только для чтения с тем же файлом SQLite или None, если БД не в файле SQLite."""
+    url = make_url(uri)
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    if url.query.get("uri"):
+        return str(url.update_query_dict({"mode": "ro"}))
+    return str(url.set(database="file:" + url.database).update_query_dict({"mode": "ro", "uri": "true"}))
+
+
+def read_engine_options(section):
+    """! Параметры движка чтения для SQLALCHEMY_BINDS: read_uri или read_only_uri(uri) и параметры пула с префиксом
+    read_ (например, read_pool_size), по умолчанию те же, что у основного движка.
+    @param section Секция DATABASE конфигурации.
+
+    @returns словарь параметров или None, если чтение не выделено
+    """
+    if section.get("read_routing", "0") == "0":
+        return None
+    uri = section.get("read_uri") or read_only_uri(section["uri"])
+    if not uri:
+        return None
+    options = {"url": uri}
+    for key, type_ in POOL_OPTIONS.items():
+        value = section.get("read_" + key) or section.get(key)
+        if value:
+            options[key] = type_(value)
+    if uri.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+def is_write(clause):
+    """! Меняет ли запрос данные: INSERT/UPDATE/DELETE или текстовый запрос, который не начинается с SELECT/WITH."""
+    if isinstance(clause, UpdateBase):
+        return True
+    if isinstance(clause, TextClause):
+        return not clause.text.lstrip().upper().startswith(("SELECT", "WITH"))
+    return False
+
+
+class RoutingSession(Session):
+    """! Сессия Flask-SQLAlchemy, которая выполняет чтение запросов GET и HEAD через движок READ_BIND.
+    Чтение разрешает init_routing (info["read_only"]), запись или flush запрещают его до конца сессии."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get("read_only"):
+            if self._flushing or is_write(clause):
+                self.info["read_only"] = False
+                self.info["wrote"] = True
+            elif READ_BIND in self._db.engines:
+                return self._db.engines[READ_BIND]
+        elif bind is None and (self._flushing or is_write(clause)):
+            self.info["wrote"] = True
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def init_routing(app, db, section):
+    """! Направлять чтение запросов GET и HEAD в движок READ_BIND, если он настроен.
+    @param app Приложение Flask.
+    @param db Объект Flask-SQLAlchemy, созданный с RoutingSession.
+    @param section Секция DATABASE конфигурации.
+    """
+    if READ_BIND not in app.config.get("SQLALCHEMY_BINDS", {}):
+        return
+    sticky_seconds = float(section.get("sticky_seconds", 5))
+
+    @app.before_request
+    def route_reads():
+        written_at = client_session.get(WRITTEN_AT_KEY, 0)
+        db.session.info["read_only"] = request.method in READ_METHODS and time.time() - written_at > sticky_seconds
+
+    @app.after_request
+    def remember_write(response):
+        if db.session.info.get("wrote"):
+            client_session[WRITTEN_AT_KEY] = time.time()
+        return response
+
+
+def setup_sqlite(engine, section, read_only=False):
+    """! Выполнять PRAGMA из конфигурации для каждого нового соединения с SQLite.
+    @param engine Engine SQLAlchemy.
+    @param section Секция DATABASE конфигурации.
+    @param read_only Соединения только для чтения: PRAGMA, меняющие файл БД, не выполняются, а query_only
+    запрещает запись.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+    pragmas = {key: section.get(key, default) for key, default in SQLITE_PRAGMAS.items()
+               if not (read_only and key in SQLITE_WRITE_PRAGMAS)}
+    if read_only:
+        pragmas["query_only"] = "1"
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            if value:
+                cursor.execute(f"PRAGMA {key} = {value}")
+        cursor.close()
@@ -0,0 +1,220 @@
+##
+# @file
+#
+# @brief Файл персональной ленты путеводителей.
+#
+# @section desctiption_feed Description
+# Персональная лента упорядочивает путеводители по рангу: оценка свежести и сводной оценки путеводителя (score)
+# плюс tag_weight за каждую категорию путеводителя из любимых категорий пользователя (User.favourite_tags), но не
+# больше чем за max_tag_bonus категорий. Для каждой категории в таблице tag_feed хранится список ее путеводителей
+# с их score, упорядоченный индексом (tag_id, score). Строки путеводителя обновляются при его сохранении и при
+# изменении его оценки, поэтому для страницы ленты читаются только начала списков любимых категорий, а не все
+# путеводители этих категорий (см. get_personal_feed_page).
+
+from sqlalchemy import text, literal
+from sqlalchemy.orm import aliased
+
+from app import db
+from app.config import config
+from app.models import Tour, tag_feed, users_to_tags_association
+
+## Во сколько раз увеличивается количество строк, читаемых из начала списка каждой категории, если среди
+# прочитанных путеводителей не хватает прошедших фильтры ленты на страницу
+CANDIDATES_GROWTH = 4
+## Количество путеводителей в одном запросе проверки фильтров ленты
+VISIBILITY_CHUNK = 500
+
+
+def feed_setting(key, default):
+    """! Параметр секции FEED файла config.ini (число)."""
+    return float(config["FEED"].get(key, default)) if config.has_section("FEED") else float(default)
+
+
+def score_sql():
+    """! Выражение score путеводителя на SQL: время изменения в днях плюс rating_weight дней за оценку 10 из 10.
+    Для столбцов используются таблицы tours и tour_ratings."""
+    if db.engine.dialect.name == "sqlite":
+        days = "julianday(tours.last_updated_at)"
+    else:
+        days = "extract(epoch from tours.last_updated_at) / 86400.0"
+    return f"{days} + {feed_setting('rating_weight', 7)} * coalesce(tour_ratings.overall_avg, 0) / 10.0"
+
+
+def index_rows_sql(tour_ids=None):
+    """! Запрос, вставляющий в tag_feed строки путеводителей (по одной на каждую категорию путеводителя).
+    @param tour_ids Идентификаторы путеводителей или None для всех путеводителей.
+    """
+    where = ""
+    if tour_ids is not None:
+        where = "AND tours.id IN ({})".format(", ".join(str(int(tour_id)) for tour_id in tour_ids))
+    return f"""
+    INSERT INTO tag_feed (tag_id, tour_id, score)
+    SELECT tours_to_tags_association.tag_id, tours.id, {score_sql()}
+    FROM tours
+    JOIN tours_to_tags_association ON tours_to_tags_association.tour_id = tours.id
+    LEFT JOIN tour_ratings ON tour_ratings.tour_id = tours.id
+    WHERE NOT tours.archived {where}
+    """
+
+
+def index_tours(tour_ids=None):
+    """! Обновить строки tag_feed путеводителей в текущей транзакции. Изменения путеводителей, их категорий и оценок
+    должны быть уже отправлены в БД (db.session.flush()).
+    @param tour_ids Идентификаторы путеводителей или None, чтобы перестроить таблицу целиком.
+    """
+    if tour_ids is None:
+        db.session.execute(tag_feed.delete())
+    elif not tour_ids:
+        return
+    else:
+        remove_tours(tour_ids)
+    db.session.execute(text(index_rows_sql(tour_ids)))
+
+
+def remove_tours(tour_ids):
+    """! Удалить путеводители из tag_feed в текущей транзакции."""
+    if tour_ids:
+        db.session.execute(tag_feed.delete().where(tag_feed.c.tour_id.in_(list(tour_ids))))
+
+
+def favourite_tag_ids(user_id):
+    """! Идентификаторы любимых категорий пользователя."""
+    return [row[0] for row in db.session.query(users_to_tags_association.c.tag_id)
+            .filter(users_to_tags_association.c.user_id == user_id)]
+
+
+def encode_cursor(rank, tour_id):
+    """! Курсор персональной ленты, указывающий на позицию сразу после путеводителя с рангом rank."""
+    return f"{rank!r}_{tour_id}"
+
+
+def decode_cursor(cursor):
+    """! Разобрать курсор из encode_cursor.
+
+    @returns кортеж (ранг, id) или None, если курсор некорректен
+    """
+    try:
+        rank, tour_id = cursor.rsplit("_", 1)
+        return float(rank), int(tour_id)
+    except (ValueError, AttributeError):
+        return None
+
+
+def rank_rows(rows, tag_weight, max_bonus, position):
+    """! Упорядочить путеводители по рангу.
+    @param rows Строки (id путеводителя, score, количество любимых категорий путеводителя).
+    @param position Кортеж (ранг, id) последнего показанного путеводителя или None.
+
+    @returns список (ранг, id) по убыванию, только после position
+    """
+    ranked = sorted(((score + tag_weight * min(overlap, max_bonus), tour_id) for tour_id, score, overlap in rows),
+                    reverse=True)
+    return [item for item in ranked if item < position] if position else ranked
+
+
+def visible_ids(query, tour_ids):
+    """! Отобрать путеводители, проходящие фильтры query. Фильтры проверяются подзапросом для каждого путеводителя
+    по первичному ключу: условие tours.id IN (...) в самом query планировщик SQLite может не использовать, выбрав
+    индекс по условиям ленты (например, ix_tours_moderation) и просмотрев все путеводители.
+
+    @returns множество идентификаторов
+    """
+    candidate = aliased(Tour)
+    passes = query.with_entities(literal(1)).filter(Tour.id == candidate.id).exists()
+    return {row[0] for row in db.session.query(candidate.id).filter(candidate.id.in_(tour_ids), passes)}
+
+
+def visible_ranked(query, ranked, count):
+    """! Отобрать из упорядоченных путеводителей первые count, проходящие фильтры query. Фильтры проверяются
+    частями по порядку ранга, пока не наберется count путеводителей."""
+    result = []
+    for start in range(0, len(ranked), VISIBILITY_CHUNK):
+        chunk = ranked[start:start + VISIBILITY_CHUNK]
+        visible = visible_ids(query, [tour_id for _, tour_id in chunk])
+        result += [item for item in chunk if item[1] in visible]
+        if len(result) >= count:
+            return result[:count]
+    return result
+
+
+def head_rows(tag_ids, max_score, limit):
+    """! Прочитать начала списков категорий.
+    @param max_score Наибольший score читаемых строк или None.
+    @param limit Количество строк, читаемых из списка каждой категории.
+
+    @returns строки (id путеводителя, score, количество любимых категорий путеводителя); все ли списки прочитаны
+    """
+    condition = "AND score <= :max_score" if max_score is not None else ""
+    heads = [f"SELECT * FROM (SELECT tag_id, tour_id, score FROM tag_feed WHERE tag_id = {int(tag_id)} {condition} "
+             f"ORDER BY score DESC, tour_id DESC LIMIT {int(limit)})" for tag_id in tag_ids]
+    params = {"max_score": max_score} if max_score is not None else {}
+    rows = db.session.execute(text(" UNION ALL ".join(heads)), params).all()
+    scores = {tour_id: score for _, tour_id, score in rows}
+    if not scores:
+        return [], True
+    # список прочитан целиком, если из него получено меньше limit строк; один короткий список не означает,
+    # что прочитаны остальные
+    read = {}
+    for tag_id, _, _ in rows:
+        read[tag_id] = read.get(tag_id, 0) + 1
+    # категории путеводителя могли не попасть в прочитанные части списков, поэтому пересечение с любимыми
+    # категориями считается по tag_feed для всех найденных путеводителей
+    overlap = dict(db.session.execute(text(
+        "SELECT tour_id, count(*) FROM tag_feed WHERE tour_id IN ({}) AND tag_id IN ({}) GROUP BY tour_id".format(
+            ", ".join(str(int(tour_id)) for tour_id in scores), ", ".join(str(int(tag_id)) for tag_id in tag_ids)))
+    ).all())
+    return [(tour_id, score, overlap[tour_id]) for tour_id, score in scores.items()], \
+        all(count < limit for count in read.values())
+
+
+def range_rows(tag_ids, min_score, max_score):
+    """! Все путеводители любимых категорий со score в диапазоне. Все строки путеводителя в tag_feed имеют один
+    score, поэтому количество любимых категорий путеводителя считается по строкам диапазона точно.
+
+    @returns строки (id путеводителя, score, количество любимых категорий путеводителя)
+    """
+    condition = "AND score <= :max_score" if max_score is not None else ""
+    return db.session.execute(text(
+        "SELECT tour_id, max(score), count(*) FROM tag_feed WHERE tag_id IN ({}) AND score >= :min_score {} "
+        "GROUP BY tour_id".format(", ".join(str(int(tag_id)) for tag_id in tag_ids), condition)),
+        {"min_score": min_score, "max_score": max_score}).all()
+
+
+def get_personal_feed_page(query, tag_ids, cursor=None, page_size=20):
+    """! Получить одну страницу персональной ленты в два шага. Сначала из начал списков любимых категорий
+    находятся page_size + 1 путеводителей, проходящих фильтры query; ранг последнего из них R - нижняя граница ранга
+    путеводителей страницы. Ранг путеводителя не больше score + tag_weight * max_tag_bonus, поэтому затем читаются
+    только строки списков со score не меньше R - tag_weight * max_tag_bonus, а не все путеводители категорий.
+    @param query Запрос к Tour с уже наложенными фильтрами (опции загрузки не используются).
+    @param tag_ids Любимые категории пользователя.
+    @param cursor Курсор, полученный на предыдущей странице, или None для первой страницы.
+    @param page_size Количество путеводителей на странице.
+
+    @returns список путеводителей страницы, курсор следующей страницы (None, если страница последняя)
+    """
+    from app.logic import feed_eager_options
+    tag_weight = feed_setting("tag_weight", 3)
+    max_bonus = int(feed_setting("max_tag_bonus", 3))
+    position = decode_cursor(cursor) if cursor else None
+    # у путеводителя из списка хотя бы одна любимая категория, поэтому его ранг не меньше score + tag_weight
+    max_score = position[0] - tag_weight if position else None
+    limit = page_size + 1
+    while True:
+        rows, finished = head_rows(tag_ids, max_score, limit)
+        page = visible_ranked(query, rank_rows(rows, tag_weight, max_bonus, position), page_size + 1)
+        if len(page) > page_size or finished:
+            break
+        limit *= CANDIDATES_GROWTH
+    if not finished:
+        rows = range_rows(tag_ids, page[-1][0] - tag_weight * min(max_bonus, len(tag_ids)), max_score)
+        page = visible_ranked(query, rank_rows(rows, tag_weight, max_bonus, position), page_size + 1)
+    next_cursor = None
+    if len(page) > page_size:
+        page = page[:page_size]
+        next_cursor = encode_cursor(*page[-1])
+    tours = {}
+    if page:
+        tours = {tour.id: tour for tour in db.session.query(Tour)
+                 .filter(Tour.id.in_([tour_id for _, tour_id in page]))
+                 .options(*feed_eager_options())}
+    return [tours[tour_id] for _, tour_id in page if tour_id in tours], next_cursor
@@ -0,0 +1,151 @@
+##
+# @file
+#
+# @brief Файл поиска путеводителей по местоположению.
+#
+# @section desctiption_geo Description
+# Точки блоков, отображаемых на карте, хранятся в пространственном индексе SQLite R*Tree block_points (id = TourBlock.id).
+# Индекс поддерживается триггерами на таблице tour_blocks, поэтому он всегда соответствует блокам, как бы они ни
+# сохранялись. Для других СУБД запросы выполняются напрямую по столбцам latitude/longitude таблицы tour_blocks.
+
+import math
+
+from sqlalchemy import text
+
+from app import db
+from app.models import TOUR_BLOCK_MAP_POINT_TYPE
+
+## Условие попадания блока в индекс; NEW - строка tour_blocks в триггере
+POINT_CONDITION = (f"(NEW.show_on_map OR NEW.type = {TOUR_BLOCK_MAP_POINT_TYPE}) "
+                   "AND NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL")
+
+## Запросы, создающие индекс, триггеры и заполняющие индекс существующими блоками
+CREATE_INDEX_SQL = [
+    "CREATE VIRTUAL TABLE block_points USING rtree(id, min_lat, max_lat, min_lon, max_lon)",
+    f"""CREATE TRIGGER block_points_insert AFTER INSERT ON tour_blocks WHEN {POINT_CONDITION}
+    BEGIN
+        INSERT INTO block_points VALUES (NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude);
+    END""",
+    f"""CREATE TRIGGER block_points_update AFTER UPDATE OF show_on_map, type, latitude, longitude ON tour_blocks
+    BEGIN
+        DELETE FROM block_points WHERE id = OLD.id;
+        INSERT INTO block_points SELECT NEW.id, NEW.latitude, NEW.latitude, NEW.longitude, NEW.longitude
+        WHERE {POINT_CONDITION};
+    END""",
+    """CREATE TRIGGER block_points_delete AFTER DELETE ON tour_blocks
+    BEGIN
+        DELETE FROM block_points WHERE id = OLD.id;
+    END""",
+    f"""INSERT INTO block_points SELECT id, latitude, latitude, longitude, longitude FROM tour_blocks AS NEW
+    WHERE {POINT_CONDITION}""",
+]
+
+## Средний радиус Земли в километрах
+EARTH_RADIUS_KM = 6371.0
+## Длина одного градуса широты в километрах
+KM_PER_DEGREE = 111.32
+
+
+def rtree_enabled():
+    """! Используется ли индекс R*Tree (только для SQLite)."""
+    return db.engine.dialect.name == "sqlite"
+
+
+def create_geo_index():
+    """! Создать индекс точек и триггеры, если их еще нет."""
+    if not rtree_enabled():
+        return
+    with db.engine.begin() as connection:
+        if connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'block_points'")).first():
+            return
+        for statement in CREATE_INDEX_SQL:
+            connection.execute(text(statement))
+
+
+def drop_geo_index():
+    """! Удалить индекс точек и триггеры. Используется перед массовой вставкой блоков: индекс, созданный заново
+    create_geo_index, заполняется одним запросом быстрее, чем триггером для каждой строки."""
+    if not rtree_enabled():
+        return
+    with db.engine.begin() as connection:
+        for trigger in ("block_points_insert", "block_points_update", "block_points_delete"):
+            connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        connection.execute(text("DROP TABLE IF EXISTS block_points"))
+
+
+def points_in_bbox(min_lat, min_lon, max_lat, max_lon, visibility_sql="", limit=1000, near=None):
+    """! Найти точки блоков в прямоугольнике одним запросом.
+    @param min_lat, min_lon, max_lat, max_lon Границы прямоугольника в градусах.
+    @param visibility_sql Дополнительное условие на таблицу tours (например, отбор только опубликованных).
+    @param limit Максимальное количество точек.
+    @param near Точка (широта, долгота): до применения limit точки сортируются по приближенному расстоянию до нее
+    (квадрат разности координат, долгота масштабируется косинусом широты); None - без сортировки.
+
+    @returns список строк (tour_id, block_id, latitude, longitude)
+    """
+    params = {"min_lat": min_lat, "max_lat": max_lat, "min_lon": min_lon, "max_lon": max_lon, "limit": limit,
+              "archived": False}
+    if rtree_enabled():
+        source = ("block_points JOIN tour_blocks ON tour_blocks.id = block_points.id "
+                  "WHERE block_points.min_lat >= :min_lat AND block_points.max_lat <= :max_lat "
+                  "AND block_points.min_lon >= :min_lon AND block_points.max_lon <= :max_lon")
+    else:
+        source = (f"tour_blocks WHERE (tour_blocks.show_on_map OR tour_blocks.type = {TOUR_BLOCK_MAP_POINT_TYPE}) "
+                  "AND tour_blocks.latitude BETWEEN :min_lat AND :max_lat "
+                  "AND tour_blocks.longitude BETWEEN :min_lon AND :max_lon")
+    sql = (f"SELECT tour_blocks.tour_id, tour_blocks.id, tour_blocks.latitude, tour_blocks.longitude FROM {source} "
+           f"AND tour_blocks.tour_id IN (SELECT tours.id FROM tours WHERE tours.archived = :archived {visibility_sql}) ")
+    if near is not None:
+        params.update({"near_lat": near[0], "near_lon": near[1],
+                       "lon_scale": max(math.cos(math.radians(near[0])), 1e-6)})
+        sql += ("ORDER BY (tour_blocks.latitude - :near_lat) * (tour_blocks.latitude - :near_lat) + "
+                "(tour_blocks.longitude - :near_lon) * (tour_blocks.longitude - :near_lon) * :lon_scale * :lon_scale ")
+    sql += "LIMIT :limit"
+    return db.session.execute(text(sql), params).all()
+
+
+def bbox_around(latitude, longitude, radius_km):
+    """! Прямоугольник, описанный вокруг круга заданного радиуса.
+
+    @returns кортеж (min_lat, min_lon, max_lat, max_lon)
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    dlon = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6))
+    return (max(latitude - dlat, -90), max(longitude - dlon, -180),
+            min(latitude + dlat, 90), min(longitude + dlon, 180))
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """! Расстояние между двумя точками по формуле гаверсинусов."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def points_near(latitude, longitude, radius_km, visibility_sql="", limit=1000):
+    """! Найти точки блоков в радиусе от заданной точки, отсортированные по расстоянию.
+    Кандидаты отбираются по индексу в описанном прямоугольнике и сортируются по приближенному расстоянию до limit,
+    затем отсеиваются и сортируются по точному расстоянию.
+
+    @returns список кортежей (tour_id, block_id, latitude, longitude, distance_km)
+    """
+    # прямоугольник примерно на треть больше круга, а приближенное расстояние может немного отличаться от точного,
+    # поэтому ближайших кандидатов берется с запасом
+    rows = points_in_bbox(*bbox_around(latitude, longitude, radius_km), visibility_sql=visibility_sql,
+                          limit=limit * 2, near=(latitude, longitude))
+    points = [(*row, distance_km(latitude, longitude, row[2], row[3])) for row in rows]
+    return sorted((point for point in points if point[4] <= radius_km), key=lambda point: point[4])[:limit]
+
+
+def group_by_tour(points):
+    """! Сгруппировать точки по путеводителям, сохраняя порядок первого появления путеводителя.
+
+    @returns список словарей {"id": <id путеводителя>, "points": [...]} для ответа API
+    """
+    tours = {}
+    for point in points:
+        entry = {"block_id": point[1], "latitude": point[2], "longitude": point[3]}
+        if len(point) > 4:
+            entry["distance_km"] = round(point[4], 3)
+        tours.setdefault(point[0], []).append(entry)
+    return [{"id": tour_id, "points": tour_points} for tour_id, tour_points in tours.items()]
@@ -0,0 +1,189 @@
+##
+# @file
+#
+# @brief Файл фоновых задач.
+#
+# @section desctiption_jobs Description
+# Задачи хранятся в таблице jobs той же БД, поэтому отдельный брокер не нужен, а задача, поставленная в очередь
+# в транзакции запроса, появляется в очереди только вместе с остальными изменениями этой транзакции.
+# Задачи выполняют потоки-обработчики: в процессе сервера (main.py, один процесс-обработчик gunicorn, см. server.py)
+# или в отдельном процессе `flask --app main worker`. Поток забирает задачу одним запросом UPDATE и получает ее
+# в аренду: если процесс завершится, не закончив задачу, по истечении аренды ее заберет другой поток.
+# Задача, завершившаяся исключением, повторяется с экспоненциально растущей задержкой, после max_attempts попыток
+# она помечается как failed. Функции задач регистрируются декоратором handler и получают параметры задачи
+# как именованные аргументы. Параметры задаются секцией JOBS файла config.ini.
+
+import datetime
+import json
+import threading
+
+from sqlalchemy import select, update, delete, or_, and_
+
+from app import db
+from app.config import config
+from app.models import Job, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+## Функции задач по виду задачи
+HANDLERS = {}
+
+## Событие, которым enqueue будит потоки-обработчики этого процесса, не дожидаясь очередного опроса
+wakeup = threading.Event()
+
+
+def jobs_setting(key, default):
+    """! Получить числовой параметр секции JOBS файла config.ini."""
+    if config.has_section("JOBS"):
+        return int(config["JOBS"].get(key, default))
+    return default
+
+
+def handler(kind):
+    """! Декоратор, регистрирующий функцию как обработчик задач вида kind."""
+    def register(func):
+        HANDLERS[kind] = func
+        return func
+    return register
+
+
+def enqueue(kind, created_by_id=None, delay=0, **params):
+    """! Поставить задачу в очередь. Задача добавляется в текущую сессию и попадет в очередь после db.session.commit().
+    @param kind Вид задачи (имя, зарегистрированное декоратором handler).
+    @param created_by_id Пользователь, по запросу которого создана задача (может смотреть ее состояние).
+    @param delay Задержка перед выполнением в секундах.
+    @param params Параметры функции задачи, сериализуемые в JSON.
+
+    @returns объект задачи
+    """
+    job = Job(kind, json.dumps(params), datetime.datetime.now() + datetime.timedelta(seconds=delay),
+              jobs_setting("max_attempts", 5), created_by_id)
+    db.session.add(job)
+    wakeup.set()
+    return job
+
+
+def claim():
+    """! Забрать из очереди одну задачу, время выполнения которой наступило, или задачу с истекшей арендой.
+    Выбор и захват задачи выполняются одним запросом, поэтому одну задачу не заберут два потока.
+
+    @returns строка (id, kind, params, attempts, max_attempts) или None, если задач нет
+    """
+    now = datetime.datetime.now()
+    next_job = (select(Job.id)
+                .where(or_(and_(Job.status == JOB_QUEUED, Job.run_at <= now),
+                           and_(Job.status == JOB_RUNNING, Job.locked_until < now)))
+                .order_by(Job.run_at, Job.id)
+                .limit(1)
+                .scalar_subquery())
+    row = db.session.execute(update(Job)
+                             .where(Job.id == next_job)
+                             .values(status=JOB_RUNNING, attempts=Job.attempts + 1, started_at=now,
+                                     locked_until=now + datetime.timedelta(seconds=jobs_setting("lease", 300)))
+                             .returning(Job.id, Job.kind, Job.params, Job.attempts, Job.max_attempts)
+                             .execution_options(synchronize_session=False)).first()
+    db.session.commit()
+    return row
+
+
+def run_next(logger):
+    """! Выполнить одну задачу из очереди.
+    @param logger Журнал для ошибок задач.
+
+    @returns True, если задача была выполнена (успешно или нет), False, если очередь пуста
+    """
+    job = claim()
+    if job is None:
+        return False
+    try:
+        if job.kind not in HANDLERS:
+            raise LookupError(f"no handler for job kind {job.kind}")
+        HANDLERS[job.kind](**json.loads(job.params))
+        values = {"status": JOB_DONE, "error": None}
+    except Exception as error:
+        db.session.rollback()
+        logger.exception("Job %s (%s) failed, attempt %d of %d", job.id, job.kind, job.attempts, job.max_attempts)
+        values = {"status": JOB_FAILED, "error": f"{type(error).__name__}: {error}"}
+        if job.attempts < job.max_attempts:
+            delay = jobs_setting("retry_delay", 10) * 2 ** (job.attempts - 1)
+            values.update(status=JOB_QUEUED, run_at=datetime.datetime.now() + datetime.timedelta(seconds=delay))
+    now = datetime.datetime.now()
+    db.session.execute(update(Job)
+                       .where(Job.id == job.id)
+                       .values(locked_until=None, finished_at=None if values["status"] == JOB_QUEUED else now,
+                               **values)
+                       .execution_options(synchronize_session=False))
+    if values["status"] != JOB_QUEUED and job.kind in recurring_jobs():
+        schedule(job.kind, recurring_jobs()[job.kind])
+    db.session.commit()
+    return True
+
+
+def recurring_jobs():
+    """! Периодические задачи и их периоды в секундах; период 0 в конфигурации отключает задачу."""
+    from app.storage import storage_setting
+    intervals = {"sweep_orphans": storage_setting("sweep_interval", 3600),
+                 "purge_jobs": jobs_setting("purge_interval", 3600),
+                 "purge_archived": jobs_setting("purge_interval", 3600),
+                 "purge_user_invalidations": jobs_setting("purge_interval", 3600)}
+    return {kind: interval for kind, interval in intervals.items() if interval > 0}
+
+
+def schedule(kind, interval):
+    """! Поставить в очередь периодическую задачу через interval секунд, если она еще не ожидает выполнения."""
+    waiting = (db.session.query(Job.id)
+               .filter(Job.kind == kind, Job.status.in_([JOB_QUEUED, JOB_RUNNING]))
+               .first())
+    if waiting is None:
+        enqueue(kind, delay=interval)
+
+
+@handler("purge_jobs")
+def purge_jobs():
+    """! Удалить завершенные задачи старше keep_finished секунд."""
+    deadline = datetime.datetime.now() - datetime.timedelta(seconds=jobs_setting("keep_finished", 7 * 24 * 3600))
+    db.session.execute(delete(Job).where(Job.status.in_([JOB_DONE, JOB_FAILED]), Job.finished_at < deadline))
+    db.session.commit()
+
+
+def work(app, stop):
+    """! Цикл потока-обработчика: выполнять задачи, пока они есть, затем ждать новых до poll_interval секунд."""
+    with app.app_context():
+        poll_interval = jobs_setting("poll_interval", 1)
+    while not stop.is_set():
+        with app.app_context():
+            try:
+                busy = run_next(app.logger)
+            except Exception:
+                app.logger.exception("Job worker failed")
+                busy = False
+        if not busy:
+            wakeup.wait(poll_interval)
+            wakeup.clear()
+
+
+def start_embedded_workers(app):
+    """! Запустить потоки-обработчики в процессе сервера, если это не отключено параметром embedded секции JOBS
+    (например, потому что задачи выполняет отдельный процесс `flask --app main worker`)."""
+    with app.app_context():
+        if not jobs_setting("embedded", 1):
+            return None
+    return start_workers(app)
+
+
+def start_workers(app, workers=None):
+    """! Запустить потоки-обработчики задач и поставить в очередь периодические задачи.
+    @param app Приложение, в контексте которого выполняются задачи.
+    @param workers Количество потоков, по умолчанию параметр workers секции JOBS.
+
+    @returns событие, установка которого останавливает потоки, и список потоков
+    """
+    with app.app_context():
+        workers = jobs_setting("workers", 2) if workers is None else workers
+        for kind, interval in recurring_jobs().items():
+            schedule(kind, interval)
+        db.session.commit()
+    stop = threading.Event()
+    threads = [threading.Thread(target=work, args=(app, stop), name=f"job-worker-{i}", daemon=True)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return stop, threads
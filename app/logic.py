@@ -7,17 +7,26 @@
 # В этот файл необходимо переносить все функции, логика которых слишком объемна для размещения в непосредственно в эндпоинтах routes.py, или может быть использована неоднократно.
 
 import datetime
-import uuid
-import os
 
 
+from sqlalchemy import tuple_, insert, update, delete, select, case, cast, Float, text, literal
+from sqlalchemy.orm import selectinload, contains_eager
+from sqlalchemy.orm.attributes import set_committed_value
+
 from app import db
+from app.config import config
 from app import models
-from app import app
-from app.models import Tour, User, TourTag, TourReaction, TourBlock
+from app.models import Tour, User, TourTag, TourReaction, TourBlock, TourRating, UserSummary, Job, ModerationItem, \
+    UserInvalidation, REACTION_CRITERIA, MODERATION_PENDING, tours_to_tags_association, users_to_tags_association
+from app.cache import canvas_cache, canvas_cache_key, invalidate_tour_canvas, invalidate_user
+from app.storage import save_file
+from app.media import queue_variants
+from app.jobs import handler, jobs_setting
+from app import search
+from app import feed
+from app import moderation
 
-from werkzeug.utils import secure_filename
-from werkzeug.datastructures import FileStorage
+from flask import render_template
 
 
 def init_db():
@@ -32,6 +41,8 @@ def init_db():
         
 def process_tour(form, id, user, files):
     """! Обработать данные формы запроса при добавлении/изменении путеводителя добавить/изменить путеводитель в базу данных.
+    Блоки формы сравниваются с уже сохраненными по идентификатору: новые вставляются, измененные обновляются,
+    отсутствующие в форме удаляются, каждая группа - одним пакетным запросом, все в одной транзакции.
     @param form Форма запроса в формате, используемом Flask.
     @param id Идентификатор изменяемого путеводителя
     @param user Пользователь, вносящий изменения
@@ -45,23 +56,24 @@ def process_tour(form, id, user, files):
         key = key.split(":")[0]
         if file[0].content_type != 'application/octet-stream':
             files_dict[key] = file[0]
-
-    for file in files_dict.values():
-        file: FileStorage
-        print(type(file.content_type))
                  
     if id == "create":
         tour_obj = Tour(user.id, tour["tour_name"], 50)
         db.session.add(tour_obj)
         db.session.flush()
+        db.session.add(TourRating(tour_obj.id))
+        update_user_summary(user.id, tours_count=1)
     else:
         tour_obj = db.session.query(Tour).filter(Tour.id == id).first()
         tour_obj.name = tour["tour_name"]
         tour_obj.last_updated_at = datetime.datetime.now()
-        for block in tour_obj.blocks:
-            db.session.delete(block)
-        db.session.commit()
     
+    existing = {row.id: row._asdict() for row in
+                db.session.query(*[getattr(TourBlock, field) for field in TOUR_BLOCK_FIELDS])
+                .filter(TourBlock.tour_id == tour_obj.id)}
+    inserts, updates = [], []
+    kept_ids = set()
+    new_images = []
     max_row = 0    
     for id, block in blocks.items():
         
@@ -72,37 +84,357 @@ def process_tour(form, id, user, files):
         
         if "old_content_path" in block and not content_path:
             content_path = block["old_content_path"]    
-        if (this_max_row:=int(block["row"]) + int(block["height"])) > max_row:
+        values = block_form_values(block, content_path, tour_obj.id)
+        if id in files_dict and values["type"] == models.TOUR_BLOCK_IMAGE_TYPE:
+            new_images.append(content_path)
+        if (this_max_row:=values["row"] + values["height"]) > max_row:
             max_row = this_max_row
-        db.session.add(
-            TourBlock(block["name"], block["text"], content_path, block["type_"], block["show_on_map"],
-                  block["latitude"], block["longitude"], block["column"], block["row"], block["height"],
-                  block["width"], tour_obj.id)
-        )
-    if "tags" in tour:
-        for tag_id in tour["tags"]:
-            if (tag:=db.session.query(TourTag).filter(TourTag.id == tag_id).first()) not in tour_obj.tags:
-                tour_obj.tags.append(tag)
+        
+        if id.isdigit() and int(id) in existing:
+            values["id"] = int(id)
+            kept_ids.add(values["id"])
+            if values != existing[values["id"]]:
+                if values["content_path"] != existing[values["id"]]["content_path"]:
+                    values["content_variants"] = None
+                updates.append(values)
+        else:
+            inserts.append(values)
+    
+    tag_ids = form.getlist("tags")
+    tour_obj.tags = db.session.query(TourTag).filter(TourTag.id.in_(tag_ids)).all() if tag_ids else []
     tour_obj.canvas_height = max_row - 1
-    db.session.commit()
+    write_tour_blocks(tour_obj, set(existing) - kept_ids, updates, inserts)
+    queue_variants(new_images)
     return tour_obj.id
+
+
+class TourVersionConflict(Exception):
+    """! Путеводитель был изменен после того, как клиент получил версию, к которой относятся его изменения"""
+
+
+def write_tour_blocks(tour_obj, deleted_ids, updates, inserts, return_ids=False, fit_canvas=False,
+                      expected_version=None):
+    """! Записать изменения блоков путеводителя пакетными запросами (удаление, обновление, вставка), обновить индекс
+    поиска, зафиксировать транзакцию и сбросить кэш отрисованных блоков путеводителя.
+    Версия путеводителя увеличивается первым запросом транзакции: он же проверяет expected_version и блокирует
+    запись в БД, поэтому из двух одновременных сохранений одной версии второе получит TourVersionConflict.
+    @param tour_obj Изменяемый путеводитель.
+    @param deleted_ids Идентификаторы удаляемых блоков.
+    @param updates Список словарей значений столбцов изменяемых блоков (с id).
+    @param inserts Список словарей значений столбцов новых блоков (без id).
+    @param return_ids Вернуть идентификаторы вставленных блоков.
+    @param fit_canvas Пересчитать высоту поля путеводителя по сохраненным блокам.
+    @param expected_version Версия путеводителя, которую изменяет клиент; None - без проверки.
+
+    @returns список идентификаторов вставленных блоков в порядке inserts (если return_ids) или None
+    """
+    condition = [Tour.version == expected_version] if expected_version is not None else []
+    version = db.session.execute(update(Tour)
+                                 .where(Tour.id == tour_obj.id, *condition)
+                                 .values(version=Tour.version + 1)
+                                 .returning(Tour.version)
+                                 .execution_options(synchronize_session=False)).scalar()
+    if version is None:
+        db.session.rollback()
+        raise TourVersionConflict(tour_obj.id)
+    set_committed_value(tour_obj, "version", version)
+    if deleted_ids:
+        db.session.execute(delete(TourBlock).where(TourBlock.id.in_(deleted_ids)))
+    # пакетное обновление требует одинакового набора столбцов у всех строк пакета
+    for columns in {tuple(sorted(values)) for values in updates}:
+        db.session.execute(update(TourBlock), [values for values in updates if tuple(sorted(values)) == columns])
+    inserted_ids = None
+    if inserts and return_ids:
+        # строки одного INSERT получают возрастающие id в порядке следования
+        inserted_ids = sorted(db.session.execute(insert(TourBlock).returning(TourBlock.id), inserts).scalars())
+    elif inserts:
+        db.session.execute(insert(TourBlock), inserts)
+    if fit_canvas:
+        bottom = (db.session.query(db.func.max(TourBlock.row + TourBlock.height))
+                  .filter(TourBlock.tour_id == tour_obj.id).scalar())
+        tour_obj.canvas_height = max(1, (bottom or 2) - 1)
+    if tour_obj.moderated_by_id is None:
+        moderation.submit(tour_obj.id)
+    db.session.flush()
+    search.index_tours([tour_obj.id])
+    feed.index_tours([tour_obj.id])
+    db.session.commit()
+    invalidate_tour_canvas(tour_obj.id)
+    return inserted_ids
+
+
+def delete_rows_in_batches(table, condition, batch_size):
+    """! Удалить строки таблицы, удовлетворяющие условию, частями по batch_size строк. Транзакция фиксируется после
+    каждой части, чтобы не держать блокировку записи БД долго.
+    @param table Таблица с первичным ключом id.
+    @param condition Условие отбора удаляемых строк.
+    @param batch_size Количество строк в одной части.
+
+    @returns количество удаленных строк
+    """
+    deleted = 0
+    while True:
+        batch = select(table.c.id).where(condition).limit(batch_size)
+        count = db.session.execute(delete(table).where(table.c.id.in_(batch))).rowcount
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def purge_tours(tour_ids, batch_size=None):
+    """! Удалить путеводители вместе с блоками, комментариями, сводными оценками, категориями и записями индекса поиска
+    пакетными запросами DELETE ... WHERE tour_id IN (...), не загружая строки в сессию ORM.
+    Путеводители удаляются группами по batch_size, блоки и комментарии - частями по batch_size строк в отдельных
+    транзакциях, поэтому путеводители должны быть уже скрыты (archived): частично удаленный путеводитель не виден.
+    @param tour_ids Идентификаторы путеводителей.
+    @param batch_size Размер группы и части, по умолчанию параметр purge_batch_size секции JOBS.
+
+    @returns количество удаленных путеводителей
+    """
+    batch_size = batch_size or jobs_setting("purge_batch_size", 1000)
+    tour_ids = list(tour_ids)
+    deleted = 0
+    for start in range(0, len(tour_ids), batch_size):
+        chunk = tour_ids[start:start + batch_size]
+        delete_rows_in_batches(TourBlock.__table__, TourBlock.tour_id.in_(chunk), batch_size)
+        delete_rows_in_batches(TourReaction.__table__, TourReaction.tour_id.in_(chunk), batch_size)
+        search.remove_tours(chunk)
+        feed.remove_tours(chunk)
+        moderation.remove(chunk)
+        db.session.execute(delete(TourRating).where(TourRating.tour_id.in_(chunk))
+                           .execution_options(synchronize_session=False))
+        db.session.execute(delete(tours_to_tags_association).where(tours_to_tags_association.c.tour_id.in_(chunk)))
+        deleted += db.session.execute(delete(Tour).where(Tour.id.in_(chunk))
+                                      .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        for tour_id in chunk:
+            invalidate_tour_canvas(tour_id)
+    return deleted
+
+
+@handler("delete_tour")
+def delete_tour(tour_id):
+    """! Фоновая задача удаления путеводителя, скрытого (archived) эндпоинтом удаления.
+    @param tour_id Идентификатор путеводителя.
+    """
+    purge_tours([tour_id])
+
+
+@handler("purge_archived")
+def purge_archived():
+    """! Фоновая задача удаления всех скрытых (archived) путеводителей, например путеводителей удаленных пользователей.
+    Также выполняется периодически, поэтому путеводители, задача удаления которых была потеряна, тоже удаляются.
+
+    @returns количество удаленных путеводителей
+    """
+    return purge_tours([row[0] for row in db.session.query(Tour.id).filter(Tour.archived == True)])
+
+
+@handler("purge_user_invalidations")
+def purge_user_invalidations():
+    """! Удалить записи об изменениях пользователей, которые уже не нужны: поля пользователей, закэшированные
+    до изменения, к этому времени устарели (user_ttl), а работающие процессы прочитали записи при синхронизации."""
+    keep = max(int(config["CACHE"].get("user_ttl", 60)) if config.has_section("CACHE") else 60, 3600)
+    deadline = datetime.datetime.now() - datetime.timedelta(seconds=keep)
+    db.session.execute(delete(UserInvalidation).where(UserInvalidation.created_at < deadline))
+    db.session.commit()
+
+
+def delete_users(user_ids):
+    """! Удалить пользователей наборными запросами вместо каскадного удаления через ORM.
+    Путеводители пользователей сначала скрываются одним запросом UPDATE, затем удаляются purge_tours, комментарии
+    пользователей удаляются частями, оценки прокомментированных путеводителей пересчитываются. Путеводители,
+    проверенные пользователями, остаются без модератора, как при удалении через ORM. Строки пользователей удаляются
+    последними, поэтому ни одна строка не ссылается на удаленного пользователя; если удаление прервется, скрытые
+    путеводители удалит периодическая задача purge_archived.
+    @param user_ids Идентификаторы пользователей.
+
+    @returns количество удаленных путеводителей
+    """
+    user_ids = list(user_ids)
+    batch_size = jobs_setting("purge_batch_size", 1000)
+    db.session.execute(update(Tour).where(Tour.created_by_id.in_(user_ids)).values(archived=True)
+                       .execution_options(synchronize_session=False))
+    rated_tour_ids = [row[0] for row in db.session.query(TourReaction.tour_id)
+                      .join(Tour, Tour.id == TourReaction.tour_id)
+                      .filter(TourReaction.created_by_id.in_(user_ids), Tour.archived == False)
+                      .distinct()]
+    unmoderated_authors = {row[0] for row in db.session.query(Tour.created_by_id)
+                           .filter(Tour.moderated_by_id.in_(user_ids), Tour.archived == False).distinct()}
+    # путеводители, проверенные удаленными модераторами, снова ждут проверки
+    db.session.execute(insert(ModerationItem).from_select(
+        ["tour_id", "status", "queued_at"],
+        select(Tour.id, literal(MODERATION_PENDING), literal(datetime.datetime.now()))
+        .where(Tour.moderated_by_id.in_(user_ids), Tour.archived == False)))
+    db.session.execute(update(Tour).where(Tour.moderated_by_id.in_(user_ids)).values(moderated_by_id=None)
+                       .execution_options(synchronize_session=False))
+    db.session.execute(update(ModerationItem).where(ModerationItem.claimed_by_id.in_(user_ids))
+                       .values(claimed_by_id=None, claimed_until=None).execution_options(synchronize_session=False))
+    db.session.execute(update(ModerationItem).where(ModerationItem.decided_by_id.in_(user_ids))
+                       .values(decided_by_id=None).execution_options(synchronize_session=False))
+    db.session.execute(delete(users_to_tags_association).where(users_to_tags_association.c.user_id.in_(user_ids)))
+    db.session.execute(update(Job).where(Job.created_by_id.in_(user_ids)).values(created_by_id=None)
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    deleted = purge_tours([row[0] for row in db.session.query(Tour.id).filter(Tour.created_by_id.in_(user_ids))],
+                          batch_size)
+    delete_rows_in_batches(TourReaction.__table__, TourReaction.created_by_id.in_(user_ids), batch_size)
+    if rated_tour_ids:
+        rebuild_ratings(rated_tour_ids)
+    db.session.execute(delete(UserSummary).where(UserSummary.user_id.in_(user_ids)))
+    db.session.execute(delete(User).where(User.id.in_(user_ids)).execution_options(synchronize_session=False))
+    # у авторов изменились количество комментариев и, если их путеводители проверил удаленный модератор,
+    # количество опубликованных путеводителей
+    affected_authors = {row[0] for row in db.session.query(Tour.created_by_id).filter(Tour.id.in_(rated_tour_ids))}
+    rebuild_user_summaries(affected_authors | unmoderated_authors)
+    for user_id in user_ids:
+        invalidate_user(user_id)
+    db.session.commit()
+    for tour_id in rated_tour_ids:
+        invalidate_tour_canvas(tour_id)
+    return deleted
+
+
+def apply_tour_patch(tour_obj, patch):
+    """! Применить к путеводителю частичное изменение, полученное через API (см. api.parse_tour_patch).
+    Изменяются только переданные поля, у существующих блоков - только переданные столбцы.
+    @param tour_obj Изменяемый путеводитель.
+    @param patch Словарь с необязательными ключами name, tags (список id категорий), blocks (список словарей
+    значений столбцов, у существующих блоков - с id), deleted (идентификаторы удаляемых блоков)
+    и version (версия путеводителя, к которой относится изменение).
+
+    @returns список идентификаторов вставленных блоков в порядке их следования в patch["blocks"]
+    """
+    if "name" in patch:
+        tour_obj.name = patch["name"]
+    if "tags" in patch:
+        tour_obj.tags = db.session.query(TourTag).filter(TourTag.id.in_(patch["tags"])).all() if patch["tags"] else []
+    tour_obj.last_updated_at = datetime.datetime.now()
+    existing = {row[0] for row in db.session.query(TourBlock.id).filter(TourBlock.tour_id == tour_obj.id)}
+    deleted_ids = set(patch.get("deleted", ())) & existing
+    updates, inserts = [], []
+    for block in patch.get("blocks", ()):
+        if block.get("id") is None:
+            inserts.append({**NEW_BLOCK_DEFAULTS, **{key: value for key, value in block.items() if key != "id"},
+                            "tour_id": tour_obj.id})
+        elif block["id"] in existing and block["id"] not in deleted_ids:
+            updates.append(dict(block, content_variants=None) if "content_path" in block else block)
+        else:
+            raise ValueError(f"block {block['id']} is not in tour {tour_obj.id}")
+    inserted_ids = write_tour_blocks(tour_obj, deleted_ids, updates, inserts, return_ids=True, fit_canvas=True,
+                                     expected_version=patch.get("version"))
+    queue_tour_images(tour_obj.id, updates + inserts)
+    return inserted_ids
+
+
+def apply_tour_ops(tour_obj, version, ops):
+    """! Применить к путеводителю операции автосохранения редактора (см. api.parse_tour_ops) одной транзакцией.
+    Несколько операций над одним блоком объединяются в одно изменение строки, операции над блоком, добавленным
+    в этом же пакете, - в значения его вставки.
+    @param tour_obj Изменяемый путеводитель.
+    @param version Версия путеводителя, к которой относятся операции.
+    @param ops Список словарей {"op", "id", "values"}; op - tour, add, move, resize, edit или remove.
+    id сохраненного блока - число, блока, добавленного операцией add, - временный строковый ключ клиента.
+
+    @returns словарь {<временный ключ>: <идентификатор вставленного блока>}
+    @throws TourVersionConflict если версия путеводителя уже не равна version
+    @throws ValueError если операция ссылается на блок не из этого путеводителя
+    """
+    existing = {row[0] for row in db.session.query(TourBlock.id).filter(TourBlock.tour_id == tour_obj.id)}
+    inserts, updates, deleted_ids = {}, {}, set()
+    for op in ops:
+        kind, block_id, values = op["op"], op.get("id"), op.get("values", {})
+        if kind == "tour":
+            if "name" in values:
+                tour_obj.name = values["name"]
+            if "tags" in values:
+                tour_obj.tags = (db.session.query(TourTag).filter(TourTag.id.in_(values["tags"])).all()
+                                 if values["tags"] else [])
+        elif kind == "add":
+            if block_id in inserts:
+                raise ValueError(f"block {block_id} is added twice")
+            inserts[block_id] = {**NEW_BLOCK_DEFAULTS, **values, "tour_id": tour_obj.id}
+        elif block_id in inserts:
+            if kind == "remove":
+                del inserts[block_id]
+            else:
+                inserts[block_id].update(values)
+        elif block_id in existing and block_id not in deleted_ids:
+            if kind == "remove":
+                deleted_ids.add(block_id)
+                updates.pop(block_id, None)
+            else:
+                updates.setdefault(block_id, {"id": block_id}).update(values)
+        else:
+            raise ValueError(f"block {block_id} is not in tour {tour_obj.id}")
+    for values in updates.values():
+        if "content_path" in values:
+            values["content_variants"] = None
+    tour_obj.last_updated_at = datetime.datetime.now()
+    inserted_ids = write_tour_blocks(tour_obj, deleted_ids, list(updates.values()), list(inserts.values()),
+                                     return_ids=True, fit_canvas=True, expected_version=version)
+    queue_tour_images(tour_obj.id, list(updates.values()) + list(inserts.values()))
+    return dict(zip(inserts, inserted_ids or []))
+
+
+def queue_tour_images(tour_id, changed):
+    """! Поставить в очередь на создание уменьшенных копий новые изображения блоков путеводителя.
+    @param tour_id Идентификатор путеводителя.
+    @param changed Словари значений столбцов измененных и вставленных блоков.
+    """
+    content_paths = {values["content_path"] for values in changed if values.get("content_path")}
+    if content_paths:
+        queue_variants([row[0] for row in db.session.query(TourBlock.content_path)
+                        .filter(TourBlock.tour_id == tour_id,
+                                TourBlock.type == models.TOUR_BLOCK_IMAGE_TYPE,
+                                TourBlock.content_path.in_(content_paths))
+                        .distinct()])
+
+
+## Значения столбцов нового блока, не переданные в изменении через API
+NEW_BLOCK_DEFAULTS = {"name": None, "text": None, "content_path": "", "type": models.TOUR_BLOCK_TEXT_TYPE,
+                      "show_on_map": False, "latitude": None, "longitude": None,
+                      "column": 1, "row": 1, "height": 1, "width": 1}
+
+
+## Поля TourBlock, сравниваемые при сохранении путеводителя
+TOUR_BLOCK_FIELDS = ["id", "name", "text", "content_path", "type", "show_on_map", "latitude", "longitude",
+                     "column", "row", "height", "width", "tour_id"]
+
+
+def block_form_values(block, content_path, tour_id):
+    """! Привести значения полей блока из формы к типам столбцов TourBlock.
+    @param block Словарь полей блока, полученный из process_flask_form.
+    @param content_path Имя файла содержимого блока.
+    @param tour_id Идентификатор путеводителя.
     
-def save_file(file):
-    """! Cохраняет файл и возвращает условно уникальное имя.
-    @param file файл формы, в формате используемом Flask.
-    
-    @return Условно уникальное имя файла в директории app/static/contents
-    """
-    filename = str(uuid.uuid4())
-    extenstion = file.filename.split(".")[-1]
-    filename = filename + "." + extenstion
-    filename = secure_filename(filename)
-    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(path)
-    return filename
-    
+    @returns словарь значений столбцов TourBlock (без id)
+    """
+    return {
+        "name": block.get("name"),
+        "text": block.get("text"),
+        "content_path": content_path,
+        "type": int(block["type_"]),
+        "show_on_map": block["show_on_map"],
+        "latitude": parse_float(block.get("latitude")),
+        "longitude": parse_float(block.get("longitude")),
+        "column": int(block["column"]),
+        "row": int(block["row"]),
+        "height": int(block["height"]),
+        "width": int(block["width"]),
+        "tour_id": tour_id,
+    }
+
+
+def parse_float(value):
+    """! Преобразовать значение поля формы в число или None, если поле пустое/некорректное."""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
     
-        
 def process_flask_form(form, checkboxes):
     """! Преобразует форму переданную в  формате, используемом Flask, где поля ввода атрибутов нескольких объектов описывались именами вида <id>:<имя атрибута>, в
     словарь словерей вида {<id>:{<имя атрибута1>:<значение>}}. Для полей ввода без <id>: формирует отдельный словарь вида {<имя атрибута>:<значение>}
@@ -127,4 +459,215 @@ def process_flask_form(form, checkboxes):
             obj[cb] = cb in obj.keys()
             
         
-    return multiples, main
\ No newline at end of file
+    return multiples, main
+
+
+## Варианты сортировки ленты: столбцы ключа пагинации (по убыванию), функция получения значения первого столбца
+## у путеводителя и функция разбора этого значения из курсора
+FEED_SORTS = {
+    "recent": {
+        "columns": (Tour.last_updated_at, Tour.id),
+        "value": lambda tour: tour.last_updated_at.isoformat(),
+        "parse": datetime.datetime.fromisoformat,
+    },
+    "top": {
+        "columns": (TourRating.overall_avg, TourRating.tour_id),
+        "value": lambda tour: repr(tour.rating.overall_avg),
+        "parse": float,
+    },
+}
+
+
+def encode_feed_cursor(tour, sort="recent"):
+    """! Сформировать курсор ленты, указывающий на позицию сразу после переданного путеводителя.
+    @param tour Последний путеводитель на текущей странице ленты.
+    @param sort Вариант сортировки ленты из FEED_SORTS.
+
+    @returns Строка вида <значение ключа сортировки>_<id>
+    """
+    return f"{FEED_SORTS[sort]['value'](tour)}_{tour.id}"
+
+
+def decode_feed_cursor(cursor, sort="recent"):
+    """! Разобрать курсор ленты, полученный из encode_feed_cursor.
+    @param cursor Строка курсора.
+    @param sort Вариант сортировки ленты из FEED_SORTS.
+
+    @returns Кортеж (значение ключа сортировки, id) или None, если курсор некорректен
+    """
+    try:
+        value, tour_id = cursor.rsplit("_", 1)
+        return FEED_SORTS[sort]["parse"](value), int(tour_id)
+    except (ValueError, AttributeError):
+        return None
+
+
+def feed_eager_options():
+    """! Опции загрузки путеводителей ленты: авторы и категории загружаются пачками на всю страницу."""
+    return selectinload(Tour.created_by), selectinload(Tour.tags)
+
+
+def get_feed_page(query, cursor=None, page_size=20, sort="recent"):
+    """! Получить одну страницу ленты путеводителей, используя пагинацию по ключу сортировки и id:
+    (last_updated_at, id) для новых или (средняя оценка, id) для лучших путеводителей.
+    Авторы и категории путеводителей страницы подгружаются пачками, отдельными запросами на всю страницу.
+    @param query Запрос к Tour с уже наложенными фильтрами.
+    @param cursor Курсор, полученный из encode_feed_cursor, или None для первой страницы.
+    @param page_size Количество путеводителей на странице.
+    @param sort Вариант сортировки ленты из FEED_SORTS.
+
+    @returns список путеводителей страницы, курсор следующей страницы (None, если страница последняя)
+    """
+    columns = FEED_SORTS[sort]["columns"]
+    if sort == "top":
+        query = query.join(Tour.rating).options(contains_eager(Tour.rating))
+    position = decode_feed_cursor(cursor, sort) if cursor else None
+    if position:
+        query = query.filter(tuple_(*columns) < position)
+    tours = (query
+             .options(*feed_eager_options())
+             .order_by(*[column.desc() for column in columns])
+             .limit(page_size + 1)
+             .all())
+    next_cursor = None
+    if len(tours) > page_size:
+        tours = tours[:page_size]
+        next_cursor = encode_feed_cursor(tours[-1], sort)
+    return tours, next_cursor
+
+
+def tour_canvas_version(tour):
+    """! Версия отрисованных блоков путеводителя: время изменения и версия уменьшенных копий изображений.
+    @param tour Путеводитель или строка запроса со столбцами last_updated_at и media_version.
+    """
+    return f"{tour.last_updated_at.isoformat()}/{tour.media_version}"
+
+
+def render_tour_canvases(versions):
+    """! Получить отрисованные блоки путеводителей, используя кэш. Запись кэша считается актуальной,
+    если она была создана для той же версии tour_canvas_version. Блоки путеводителей, которых нет в кэше,
+    загружаются одним запросом.
+    @param versions Словарь {<id путеводителя>: <tour_canvas_version>}.
+
+    @returns словарь {<id путеводителя>: <html>}
+    """
+    result = {}
+    missing = []
+    for tour_id, version in versions.items():
+        cached = canvas_cache.get(canvas_cache_key(tour_id))
+        if cached and cached["version"] == version:
+            result[tour_id] = cached["html"]
+        else:
+            missing.append(tour_id)
+    if missing:
+        tours = db.session.query(Tour).filter(Tour.id.in_(missing)).options(selectinload(Tour.blocks)).all()
+        for tour in tours:
+            html = render_template("tour_canvas.html", tour=tour)
+            canvas_cache.set(canvas_cache_key(tour.id), {"version": tour_canvas_version(tour), "html": html})
+            result[tour.id] = html
+    return result
+
+
+def update_rating(reaction, sign):
+    """! Учесть комментарий в сводной оценке путеводителя или убрать его оттуда одним запросом UPDATE.
+    Комментарий должен быть уже сохранен/удален в текущей транзакции (db.session.flush()).
+    @param reaction Добавленный или удаленный комментарий.
+    @param sign 1 при добавлении комментария, -1 при удалении.
+    """
+    count = TourRating.reactions_count + sign
+    values = {"reactions_count": count}
+    for criteria in REACTION_CRITERIA:
+        values[criteria + "_sum"] = getattr(TourRating, criteria + "_sum") + sign * (getattr(reaction, criteria + "_criteria") or 0)
+    values["overall_avg"] = case((count > 0, cast(values["overall_sum"], Float) / count), else_=0.0)
+    result = db.session.execute(update(TourRating).where(TourRating.tour_id == reaction.tour_id).values(**values))
+    if result.rowcount == 0:
+        rebuild_ratings([reaction.tour_id])
+    else:
+        feed.index_tours([reaction.tour_id])
+
+
+def rebuild_ratings(tour_ids=None):
+    """! Пересчитать сводные оценки путеводителей по всем их комментариям и обновить их строки персональной ленты.
+    @param tour_ids Идентификаторы путеводителей или None для всех путеводителей.
+    """
+    where = ""
+    if tour_ids is not None:
+        where = "WHERE tours.id IN ({})".format(", ".join(str(int(tour_id)) for tour_id in tour_ids))
+    sums = ", ".join(f"coalesce(sum(tour_reactions.{criteria}_criteria), 0)" for criteria in REACTION_CRITERIA)
+    columns = ", ".join(criteria + "_sum" for criteria in REACTION_CRITERIA)
+    db.session.execute(text(f"DELETE FROM tour_ratings WHERE tour_id IN (SELECT tours.id FROM tours {where})"))
+    db.session.execute(text(f"""
+        INSERT INTO tour_ratings (tour_id, reactions_count, {columns}, overall_avg)
+        SELECT tours.id, count(tour_reactions.id), {sums},
+               coalesce(avg(tour_reactions.overall_criteria), 0)
+        FROM tours LEFT JOIN tour_reactions ON tour_reactions.tour_id = tours.id
+        {where}
+        GROUP BY tours.id"""))
+    feed.index_tours(tour_ids)
+
+
+def summary_rows_sql(user_ids=None):
+    """! Запрос, вычисляющий сводки пользователей (user_id, tours_count, published_count, reactions_received)
+    по путеводителям и комментариям. Счетчики считаются подзапросами по индексам ix_tours_created_by
+    и ix_tour_reactions_tour_id, поэтому запрос годится и для одного пользователя, и для всех.
+    @param user_ids Идентификаторы пользователей или None для всех пользователей.
+    """
+    where = ""
+    if user_ids is not None:
+        where = "WHERE users.id IN ({})".format(", ".join(str(int(user_id)) for user_id in user_ids))
+    own_tours = "FROM tours WHERE tours.created_by_id = users.id AND NOT tours.archived"
+    return f"""
+    SELECT users.id,
+           (SELECT count(*) {own_tours}),
+           (SELECT count(*) {own_tours} AND tours.moderated_by_id IS NOT NULL),
+           (SELECT count(*) FROM tour_reactions WHERE tour_reactions.tour_id IN (SELECT tours.id {own_tours}))
+    FROM users {where}"""
+
+
+def rebuild_user_summaries(user_ids=None):
+    """! Пересчитать сводки пользователей по их путеводителям и комментариям к ним.
+    @param user_ids Идентификаторы пользователей или None для всех пользователей.
+    """
+    if user_ids is not None and not user_ids:
+        return
+    where = ""
+    if user_ids is not None:
+        where = "WHERE user_id IN ({})".format(", ".join(str(int(user_id)) for user_id in user_ids))
+    db.session.execute(text(f"DELETE FROM user_summaries {where}"))
+    db.session.execute(text("INSERT INTO user_summaries (user_id, tours_count, published_count, reactions_received) "
+                            + summary_rows_sql(user_ids)))
+
+
+def check_user_summaries():
+    """! Сравнить сохраненные сводки пользователей с пересчитанными.
+
+    @returns количество пользователей, сводка которых отсутствует или не совпадает с пересчитанной
+    """
+    return db.session.execute(text(f"""
+        SELECT count(*) FROM ({summary_rows_sql()}
+        EXCEPT SELECT user_id, tours_count, published_count, reactions_received FROM user_summaries)""")).scalar()
+
+
+def update_user_summary(user_id, **deltas):
+    """! Изменить счетчики сводки пользователя одним запросом UPDATE. Если сводки еще нет, она пересчитывается,
+    поэтому изменения путеводителей и комментариев должны быть уже отправлены в БД (db.session.flush()).
+    @param user_id Идентификатор пользователя.
+    @param deltas Изменения счетчиков UserSummary, например tours_count=1.
+    """
+    values = {name: getattr(UserSummary, name) + delta for name, delta in deltas.items() if delta}
+    if not values:
+        return
+    result = db.session.execute(update(UserSummary).where(UserSummary.user_id == user_id).values(**values))
+    if result.rowcount == 0:
+        rebuild_user_summaries([user_id])
+
+
+def update_author_summary(tour, sign):
+    """! Учесть путеводитель вместе с комментариями к нему в сводке автора или убрать его оттуда
+    (при скрытии путеводителя).
+    @param tour Путеводитель.
+    @param sign 1 при добавлении путеводителя, -1 при скрытии.
+    """
+    reactions = db.session.query(db.func.count(TourReaction.id)).filter(TourReaction.tour_id == tour.id).scalar()
+    update_user_summary(tour.created_by_id, tours_count=sign, reactions_received=sign * reactions,
+                        published_count=sign if tour.moderated_by_id is not None else 0)
@@ -0,0 +1,121 @@
+##
+# @file
+#
+# @brief Файл обработки загруженных изображений.
+#
+# @section desctiption_media Description
+# Для изображений блоков создаются уменьшенные копии нескольких ширин, чтобы в ленте и на странице путеводителя
+# не загружались исходные файлы в несколько мегабайт. Копии создаются фоновыми задачами (см. jobs.py) вне обработки
+# запроса, их ширины сохраняются в TourBlock.content_variants. Если Pillow не установлен, копии не создаются.
+# Pillow загружается при первой постановке изображения в очередь, а не при импорте.
+
+import os
+
+from flask import url_for, current_app
+from sqlalchemy import update
+
+from app import db
+from app.config import config
+from app.models import Tour, TourBlock
+from app.cache import invalidate_tour_canvas
+from app.storage import variant_name
+from app.jobs import handler, enqueue
+
+## Примерная ширина одного столбца сетки путеводителя в пикселях (tour.css: 4 столбца в main шириной от 1000px)
+GRID_COLUMN_PX = 300
+## Качество сжатия уменьшенных копий
+VARIANT_QUALITY = 80
+
+
+def media_setting(key, default):
+    """! Получить параметр секции MEDIA файла config.ini."""
+    return config["MEDIA"].get(key, default) if config.has_section("MEDIA") else default
+
+
+def variant_widths():
+    """! Ширины уменьшенных копий в пикселях по возрастанию."""
+    return sorted(int(width) for width in media_setting("variant_widths", "320,640,1280").split(",") if width)
+
+
+def pillow():
+    """! Модули Pillow (Image, ImageOps) или None, если Pillow не установлен."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:  # Pillow - необязательная зависимость
+        return None
+    return Image, ImageOps
+
+
+@handler("make_variants")
+def make_variants(content_path):
+    """! Создать уменьшенные копии изображения и сохранить их ширины во всех блоках, ссылающихся на него.
+    У затронутых путеводителей увеличивается Tour.media_version, поэтому отрисованные блоки, закэшированные любым
+    процессом, и ETag их ответов устаревают.
+    Копии, которые уже есть на диске, повторно не создаются.
+    @param content_path Имя исходного файла в директории UPLOAD_FOLDER.
+
+    @returns список ширин созданных копий
+    """
+    Image, ImageOps = pillow()
+    folder = current_app.config['UPLOAD_FOLDER']
+    widths = []
+    with Image.open(os.path.join(folder, content_path)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info else "RGB")
+        for width in variant_widths():
+            if width >= image.width:
+                break
+            path = os.path.join(folder, variant_name(content_path, width))
+            if not os.path.exists(path):
+                height = max(1, round(image.height * width / image.width))
+                image.resize((width, height), Image.LANCZOS).save(path, "WEBP", quality=VARIANT_QUALITY)
+            widths.append(width)
+    db.session.execute(update(TourBlock)
+                       .where(TourBlock.content_path == content_path)
+                       .values(content_variants=",".join(map(str, widths))))
+    tour_ids = [row[0] for row in db.session.query(TourBlock.tour_id).filter(TourBlock.content_path == content_path)
+                .distinct()]
+    if tour_ids:
+        db.session.execute(update(Tour).where(Tour.id.in_(tour_ids)).values(media_version=Tour.media_version + 1))
+    db.session.commit()
+    for tour_id in tour_ids:
+        invalidate_tour_canvas(tour_id)
+    return widths
+
+
+def queue_variants(content_paths):
+    """! Поставить изображения в очередь на создание уменьшенных копий и зафиксировать транзакцию.
+    Не ждет окончания обработки.
+    @param content_paths Имена исходных файлов.
+    """
+    if not content_paths or pillow() is None:
+        return
+    for content_path in set(content_paths):
+        enqueue("make_variants", content_path=content_path)
+    db.session.commit()
+
+
+def block_variant_widths(block):
+    """! Ширины уменьшенных копий изображения блока по возрастанию."""
+    return [int(width) for width in (block.content_variants or "").split(",") if width]
+
+
+def image_src(block):
+    """! Адрес наименьшей копии изображения блока, которая не уже блока на сетке; исходный файл, если такой нет."""
+    needed = block.width * GRID_COLUMN_PX
+    for width in block_variant_widths(block):
+        if width >= needed:
+            return content_url(variant_name(block.content_path, width))
+    return content_url(block.content_path)
+
+
+def image_srcset(block):
+    """! Значение атрибута srcset со всеми уменьшенными копиями изображения блока."""
+    return ", ".join(f"{content_url(variant_name(block.content_path, width))} {width}w"
+                     for width in block_variant_widths(block))
+
+
+def content_url(filename):
+    """! Адрес файла из директории UPLOAD_FOLDER."""
+    return url_for('main.media_file', filename=filename)
@@ -0,0 +1,130 @@
+##
+# @file
+#
+# @brief Файл с миграциями схемы базы данных.
+#
+# @section desctiption_migrations Description
+# db.create_all() создает только отсутствующие таблицы, поэтому изменения уже существующих таблиц описываются здесь.
+# Каждая миграция проверяет, нужна ли она, поэтому migrate() можно безопасно вызывать при каждом запуске.
+
+from sqlalchemy import inspect, text
+
+from app import db
+from app.models import MODERATION_PENDING
+
+
+def column_exists(table, column):
+    """! Проверить, есть ли в таблице столбец."""
+    return column in {col["name"] for col in inspect(db.engine).get_columns(table)}
+
+
+def add_column(table, column, ddl_type):
+    """! Добавить в таблицу столбец, если его еще нет.
+    @param table Имя таблицы.
+    @param column Имя столбца.
+    @param ddl_type Тип столбца в синтаксисе SQL, например VARCHAR(50).
+    """
+    if not column_exists(table, column):
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
+def add_tour_block_content_variants():
+    """! TourBlock.content_variants: ширины уменьшенных копий изображения."""
+    add_column("tour_blocks", "content_variants", "VARCHAR(50)")
+
+
+def add_tour_version():
+    """! Tour.version: номер версии для оптимистичной блокировки при сохранении."""
+    add_column("tours", "version", "INTEGER NOT NULL DEFAULT 1")
+
+
+def add_tour_media_version():
+    """! Tour.media_version: номер версии уменьшенных копий изображений блоков."""
+    add_column("tours", "media_version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def create_tour_search_index():
+    """! Таблица полнотекстового поиска tour_search (см. search.py)."""
+    from app.search import create_search_index
+    create_search_index()
+
+
+def create_block_points_index():
+    """! Пространственный индекс точек блоков block_points (см. geo.py)."""
+    from app.geo import create_geo_index
+    create_geo_index()
+
+
+def fill_tour_ratings():
+    """! Сводные оценки TourRating для путеводителей, у которых их еще нет."""
+    missing = db.session.execute(text(
+        "SELECT id FROM tours WHERE id NOT IN (SELECT tour_id FROM tour_ratings)")).scalars().all()
+    if missing:
+        from app.logic import rebuild_ratings
+        # для большого количества путеводителей проще пересчитать все оценки одним запросом
+        rebuild_ratings(missing if len(missing) < 1000 else None)
+        db.session.commit()
+
+
+def fill_tag_feed():
+    """! Списки путеводителей категорий tag_feed для персональной ленты (см. feed.py), если они еще не заполнены."""
+    if db.session.execute(text("SELECT 1 FROM tag_feed LIMIT 1")).first() is None:
+        from app import feed
+        feed.index_tours()
+        db.session.commit()
+
+
+def fill_user_summaries():
+    """! Сводки пользователей UserSummary, если они еще не заполнены."""
+    if db.session.execute(text("SELECT 1 FROM user_summaries LIMIT 1")).first() is None:
+        from app.logic import rebuild_user_summaries
+        rebuild_user_summaries()
+        db.session.commit()
+
+
+def fill_moderation_queue():
+    """! Очередь модерации для не проверенных путеводителей, которых в ней нет (например, созданных до ее появления)."""
+    db.session.execute(text(
+        "INSERT INTO moderation_queue (tour_id, status, queued_at) "
+        "SELECT id, :status, last_updated_at FROM tours WHERE moderated_by_id IS NULL AND NOT archived "
+        "AND id NOT IN (SELECT tour_id FROM moderation_queue)"), {"status": MODERATION_PENDING})
+    db.session.commit()
+
+
+def create_missing_indexes():
+    """! Индексы, объявленные в моделях, которых еще нет в существующих таблицах."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    with db.engine.begin() as connection:
+        if connection.dialect.name == "sqlite":
+            # обновить статистику, по которой планировщик выбирает индекс
+            connection.execute(text("PRAGMA optimize"))
+
+
+## Миграции в порядке применения
+MIGRATIONS = [
+    add_tour_block_content_variants,
+    create_tour_search_index,
+    create_block_points_index,
+    fill_tour_ratings,
+    add_tour_version,
+    fill_tag_feed,
+    fill_user_summaries,
+    fill_moderation_queue,
+    add_tour_media_version,
+    create_missing_indexes,
+]
+
+
+def migrate():
+    """! Применить все миграции, которые еще не были применены."""
+    for migration in MIGRATIONS:
+        migration()
+
+
+def upgrade():
+    """! Создать недостающие таблицы и применить миграции. Выполняется командой `flask --app main migrate`."""
+    db.create_all()
+    migrate()
@@ -12,13 +12,14 @@ import datetime
 from flask_login import UserMixin
 
 from app import db, manager
+from app.cache import user_cache, user_cache_key
 
 
 class User(db.Model, UserMixin):
     """! Класс пользователя"""
     __tablename__ = "users"
     id = db.Column(db.Integer, primary_key=True)
-    login = db.Column(db.String(50))  # login can be edited, so there is separate primary key
+    login = db.Column(db.String(50), index=True)  # login can be edited, so there is separate primary key
     password_hash = db.Column(db.String(32), nullable=False)
     is_moderator = db.Column(db.Boolean, nullable=False, default=False)
     created_at = db.Column(db.DateTime, nullable=False)
@@ -32,11 +33,6 @@ class User(db.Model, UserMixin):
     favourite_tags = db.relationship('TourTag', secondary='users_to_tags_association', lazy='dynamic', backref='users')
     reactions = db.relationship('TourReaction', back_populates='created_by', cascade="all, delete")
 
-    # cлужебные поля для модуля flask_login
-    is_authenticated = db.Column(db.Boolean)
-    is_active = True
-    is_anonymous = False
-
     def __init__(self, login, password_hash):
         self.login = login
         self.password_hash = password_hash
@@ -45,10 +41,48 @@ class User(db.Model, UserMixin):
     # служебная функция для flask login
     def get_id(self):
         return self.id
-    
+
+
+## Поля пользователя, доступные через current_user (используются шаблонами и проверками прав)
+SESSION_USER_FIELDS = ("id", "login", "is_moderator", "profile_photo_path")
+
+
+class SessionUser(UserMixin):
+    """! Пользователь текущей сессии (current_user): только поля SESSION_USER_FIELDS, без связи с сессией ORM.
+    Для изменения пользователя нужно загрузить объект User по id."""
+
+    def __init__(self, id, login, is_moderator, profile_photo_path):
+        self.id = id
+        self.login = login
+        self.is_moderator = is_moderator
+        self.profile_photo_path = profile_photo_path
+
+    # служебная функция для flask login
+    def get_id(self):
+        return self.id
+
+
 @manager.user_loader
 def load_user(id):
-    return db.session.query(User).filter(User.id == id).first()
+    """! Загрузить пользователя сессии. Поля пользователя кэшируются на user_ttl секунд (секция CACHE), поэтому
+    запрос к БД выполняется не на каждый запрос авторизованного пользователя; измененные пользователи удаляются
+    из кэша синхронизацией cache.UserCache.sync.
+    @param id Идентификатор пользователя из cookie сессии.
+
+    @returns SessionUser или None, если пользователь удален
+    """
+    user_cache.sync()
+    key = user_cache_key(id)
+    fields = user_cache.get(key)
+    if fields is None:
+        row = (db.session.query(*(getattr(User, field) for field in SESSION_USER_FIELDS))
+               .filter(User.id == id)
+               .first())
+        if row is None:
+            return None
+        fields = row._asdict()
+        user_cache.set(key, fields)
+    return SessionUser(**fields)
 
 
 class Tour(db.Model):
@@ -63,6 +97,12 @@ class Tour(db.Model):
 
     last_updated_at = db.Column(db.DateTime, nullable=False)
     archived = db.Column(db.Boolean, default=False, nullable=False)  # for reversible "deletion"
+    # номер версии блоков и свойств путеводителя, увеличивается при каждом сохранении
+    # (оптимистичная блокировка автосохранения редактора, см. logic.write_tour_blocks)
+    version = db.Column(db.Integer, default=1, server_default="1", nullable=False)
+    # номер версии уменьшенных копий изображений блоков, увеличивается фоновой задачей media.make_variants;
+    # входит в версию кэша отрисованных блоков и ETag, не меняя last_updated_at и version
+    media_version = db.Column(db.Integer, default=0, server_default="0", nullable=False)
 
     # отношения
     created_by_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
@@ -72,7 +112,16 @@ class Tour(db.Model):
 
     blocks = db.relationship("TourBlock", back_populates="tour", cascade="all, delete")
     reactions = db.relationship("TourReaction", back_populates="tour", cascade="all, delete")
-    tags = db.relationship('TourTag', secondary='tours_to_tags_association', lazy='dynamic', backref='tours')
+    rating = db.relationship("TourRating", back_populates="tour", uselist=False, cascade="all, delete")
+    # обычный (не dynamic) список, чтобы его можно было подгружать пачками через selectinload
+    tags = db.relationship('TourTag', secondary='tours_to_tags_association', backref='tours')
+
+    # индексы ленты: порядок столбцов совпадает с фильтрами и сортировкой get_feed_page (last_updated_at, id)
+    __table_args__ = (
+        db.Index("ix_tours_feed", "archived", "last_updated_at", "id"),
+        db.Index("ix_tours_moderation", "archived", "moderated_by_id", "last_updated_at", "id"),
+        db.Index("ix_tours_created_by", "created_by_id", "last_updated_at", "id"),
+    )
 
     def __init__(self, created_by_id, name, canvas_height):
         self.name = name
@@ -80,6 +129,8 @@ class Tour(db.Model):
         self.canvas_width = 4
         self.last_updated_at = datetime.datetime.now()
         self.archived = False
+        self.version = 1
+        self.media_version = 0
         self.created_by_id = created_by_id
 
 ## Тип блока: текст
@@ -106,6 +157,7 @@ class TourBlock(db.Model):
     name = db.Column(db.String(50))
     text = db.Column(db.Text)
     content_path = db.Column(db.String(50))  # path to media content
+    content_variants = db.Column(db.String(50))  # widths of resized image copies, comma separated (see media.py)
     type = db.Column(db.Integer, nullable=False, default=TOUR_BLOCK_TEXT_TYPE)  # one of TOUR_BLOCK_TYPES shown above
 
     show_on_map = db.Column(db.Boolean, nullable=False, default=False)
@@ -119,9 +171,12 @@ class TourBlock(db.Model):
     width = db.Column(db.Integer, nullable=False, default=1)
 
     # relations
-    tour_id = db.Column(db.Integer, db.ForeignKey("tours.id"))
+    tour_id = db.Column(db.Integer, db.ForeignKey("tours.id"), index=True)
     tour = db.relationship("Tour", back_populates="blocks")
 
+    # поиск блоков по файлу: создание уменьшенных копий и подсчет ссылок на файлы (см. media.py, storage.py)
+    __table_args__ = (db.Index("ix_tour_blocks_content_path", "content_path"),)
+
     def __init__(self, name, text, content_path, type_, show_on_map, latitude, longitude, column, row, height, width,
                  tour_id):
         self.name = name
@@ -152,6 +207,7 @@ tours_to_tags_association = db.Table(
     'tours_to_tags_association', db.metadata,
     db.Column('tour_id', db.Integer(), db.ForeignKey('tours.id'), primary_key=True),
     db.Column('tag_id', db.Integer(), db.ForeignKey('tour_tags.id'), primary_key=True),
+    db.Index('ix_tours_to_tags_association_tag_id', 'tag_id', 'tour_id'),
 )
 
 ## Ассоциативная таблица, разрешающая отношение "многие ко многим" между путеводителем и пользователем, модерировашим его
@@ -159,6 +215,18 @@ users_to_tags_association = db.Table(
     'users_to_tags_association', db.metadata,
     db.Column('user_id', db.Integer(), db.ForeignKey('users.id'), primary_key=True),
     db.Column('tag_id', db.Integer(), db.ForeignKey('tour_tags.id'), primary_key=True),
+    db.Index('ix_users_to_tags_association_tag_id', 'tag_id', 'user_id'),
+)
+
+## Списки путеводителей категорий для персональной ленты, упорядоченные по score (см. feed.py). Производные данные:
+# строка есть для каждой пары путеводитель-категория из tours_to_tags_association, кроме скрытых путеводителей
+tag_feed = db.Table(
+    'tag_feed', db.metadata,
+    db.Column('tag_id', db.Integer(), primary_key=True),
+    db.Column('tour_id', db.Integer(), primary_key=True),
+    db.Column('score', db.Float(), nullable=False),
+    db.Index('ix_tag_feed_score', 'tag_id', 'score', 'tour_id'),
+    db.Index('ix_tag_feed_tour_id', 'tour_id', 'tag_id'),
 )
 
 
@@ -177,11 +245,14 @@ class TourReaction(db.Model):
     overall_criteria = db.Column(db.Integer, nullable=True, default=5)
 
     # relations
-    created_by_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    created_by_id = db.Column(db.Integer, db.ForeignKey("users.id"), index=True)
     created_by = db.relationship("User", back_populates="reactions")
     tour_id = db.Column(db.Integer, db.ForeignKey("tours.id"))
     tour = db.relationship("Tour", back_populates="reactions")
 
+    # комментарии путеводителя листаются по убыванию id (см. tour_page)
+    __table_args__ = (db.Index("ix_tour_reactions_tour_id", "tour_id", "id"),)
+
     def __init__(self, text, beaty_criteria, route_smoothness_criteria, attractions_criteria, accessibility_criteria,
                  created_by_id, tour_id):
         self.text = text
@@ -192,3 +263,149 @@ class TourReaction(db.Model):
         self.created_by_id = created_by_id
         self.overall_criteria = int((self.beauty_criteria + self.attractions_criteria + self.accessibility_criteria + self.route_smoothness_criteria)/4)
         self.tour_id = tour_id
+
+
+## Критерии оценки путеводителя, по каждому в TourReaction есть столбец <критерий>_criteria
+REACTION_CRITERIA = ["beauty", "route_smoothness", "attractions", "accessibility", "overall"]
+
+
+class UserSummary(db.Model):
+    """! Класс сводки пользователя для личного кабинета и страницы его путеводителей. Счетчики обновляются при
+    создании, модерации и удалении путеводителей и комментариев к ним (logic.update_user_summary), чтобы не
+    пересчитывать их по всем путеводителям пользователя при каждом просмотре. Скрытые путеводители не учитываются."""
+    __tablename__ = "user_summaries"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    tours_count = db.Column(db.Integer, nullable=False, default=0)
+    published_count = db.Column(db.Integer, nullable=False, default=0)  # путеводители, отмеченные модератором
+    reactions_received = db.Column(db.Integer, nullable=False, default=0)  # комментарии к путеводителям пользователя
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.tours_count = 0
+        self.published_count = 0
+        self.reactions_received = 0
+
+    @property
+    def pending_count(self):
+        """! Количество путеводителей, ожидающих модерации."""
+        return self.tours_count - self.published_count
+
+
+class UserInvalidation(db.Model):
+    """! Класс записи об изменении пользователя (cache.invalidate_user). Процессы читают новые записи
+    (cache.UserCache.sync) и удаляют поля этих пользователей из своего кэша пользователей сессий."""
+    __tablename__ = "user_invalidations"
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)  # без внешнего ключа: пользователь может быть уже удален
+    created_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.created_at = datetime.datetime.now()
+
+
+class TourRating(db.Model):
+    """! Класс сводной оценки путеводителя. Суммы критериев обновляются при добавлении и удалении комментариев,
+    чтобы не пересчитывать их по всем комментариям при каждом просмотре."""
+    __tablename__ = "tour_ratings"
+    tour_id = db.Column(db.Integer, db.ForeignKey("tours.id"), primary_key=True)
+    reactions_count = db.Column(db.Integer, nullable=False, default=0)
+
+    beauty_sum = db.Column(db.Integer, nullable=False, default=0)
+    route_smoothness_sum = db.Column(db.Integer, nullable=False, default=0)
+    attractions_sum = db.Column(db.Integer, nullable=False, default=0)
+    accessibility_sum = db.Column(db.Integer, nullable=False, default=0)
+    overall_sum = db.Column(db.Integer, nullable=False, default=0)
+
+    # хранится отдельно, чтобы по нему можно было сортировать с помощью индекса
+    overall_avg = db.Column(db.Float, nullable=False, default=0)
+
+    tour = db.relationship("Tour", back_populates="rating")
+
+    __table_args__ = (db.Index("ix_tour_ratings_overall_avg", "overall_avg", "tour_id"),)
+
+    def __init__(self, tour_id):
+        self.tour_id = tour_id
+        self.reactions_count = 0
+        for criteria in REACTION_CRITERIA:
+            setattr(self, criteria + "_sum", 0)
+        self.overall_avg = 0
+
+    def average(self, criteria):
+        """! Средняя оценка по критерию или None, если оценок нет."""
+        if not self.reactions_count:
+            return None
+        return getattr(self, criteria + "_sum") / self.reactions_count
+
+
+## Состояние задачи: ожидает выполнения (в том числе повторного после ошибки)
+JOB_QUEUED = "queued"
+## Состояние задачи: выполняется
+JOB_RUNNING = "running"
+## Состояние задачи: выполнена
+JOB_DONE = "done"
+## Состояние задачи: все попытки завершились ошибкой
+JOB_FAILED = "failed"
+
+
+class Job(db.Model):
+    """! Класс фоновой задачи (см. jobs.py)"""
+    __tablename__ = "jobs"
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # имя обработчика, см. jobs.handler
+    params = db.Column(db.Text, nullable=False, default="{}")  # именованные аргументы обработчика в JSON
+    status = db.Column(db.String(10), nullable=False, default=JOB_QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    error = db.Column(db.Text)  # ошибка последней неудачной попытки
+
+    run_at = db.Column(db.DateTime, nullable=False)  # не раньше этого времени задача может быть выполнена
+    locked_until = db.Column(db.DateTime)  # окончание аренды выполняющейся задачи
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    created_by_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+
+    # выбор следующей задачи в jobs.claim: по состоянию и времени выполнения
+    __table_args__ = (db.Index("ix_jobs_queue", "status", "run_at", "id"),)
+
+    def __init__(self, kind, params, run_at, max_attempts, created_by_id=None):
+        self.kind = kind
+        self.params = params
+        self.status = JOB_QUEUED
+        self.attempts = 0
+        self.max_attempts = max_attempts
+        self.run_at = run_at
+        self.created_at = datetime.datetime.now()
+        self.created_by_id = created_by_id
+
+
+## Состояние путеводителя в очереди модерации: ожидает решения модератора
+MODERATION_PENDING = "pending"
+## Состояние путеводителя в очереди модерации: отклонен (снова ставится в очередь при сохранении автором)
+MODERATION_REJECTED = "rejected"
+
+
+class ModerationItem(db.Model):
+    """! Класс элемента очереди модерации (см. moderation.py). Строка есть у каждого не проверенного модератором
+    путеводителя; одобренный путеводитель (Tour.moderated_by_id) из очереди удаляется."""
+    __tablename__ = "moderation_queue"
+
+    tour_id = db.Column(db.Integer, db.ForeignKey("tours.id"), primary_key=True)
+    status = db.Column(db.String(10), nullable=False, default=MODERATION_PENDING)
+    queued_at = db.Column(db.DateTime, nullable=False)  # порядок очереди: первым проверяется давно ожидающий
+
+    claimed_by_id = db.Column(db.Integer, db.ForeignKey("users.id"))  # модератор, взявший путеводитель на проверку
+    claimed_until = db.Column(db.DateTime)  # окончание аренды, после него путеводитель может взять другой модератор
+    decided_by_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    decided_at = db.Column(db.DateTime)
+
+    # очередь листается и разбирается по (queued_at, tour_id) среди ожидающих путеводителей
+    __table_args__ = (db.Index("ix_moderation_queue_fifo", "status", "queued_at", "tour_id"),)
+
+    def __init__(self, tour_id, queued_at=None):
+        self.tour_id = tour_id
+        self.status = MODERATION_PENDING
+        self.queued_at = queued_at or datetime.datetime.now()
@@ -0,0 +1,159 @@
+##
+# @file
+#
+# @brief Файл очереди модерации.
+#
+# @section desctiption_moderation Description
+# Не проверенные модератором путеводители стоят в очереди moderation_queue в порядке постановки (FIFO). Модератор
+# берет из начала очереди несколько путеводителей на время аренды (claim), поэтому несколько модераторов,
+# работающих одновременно, проверяют разные путеводители. Решения по многим путеводителям применяются пакетно
+# (decide): одобренные отмечаются одним запросом UPDATE и удаляются из очереди, отклоненные остаются в очереди
+# с состоянием rejected, пока автор не сохранит путеводитель снова.
+
+import datetime
+
+from sqlalchemy import update, delete, select, or_, and_, tuple_
+
+from app import db
+from app.config import config
+from app.models import Tour, ModerationItem, MODERATION_PENDING, MODERATION_REJECTED
+
+
+def moderation_setting(key, default):
+    """! Параметр секции MODERATION файла config.ini (целое число)."""
+    return int(config["MODERATION"].get(key, default)) if config.has_section("MODERATION") else int(default)
+
+
+def submit(tour_id):
+    """! Поставить не проверенный путеводитель в очередь или вернуть в нее отклоненный. Выполняется в текущей
+    транзакции при каждом сохранении путеводителя, пока он не одобрен.
+    @param tour_id Идентификатор путеводителя.
+    """
+    item = db.session.get(ModerationItem, tour_id)
+    if item is None:
+        db.session.add(ModerationItem(tour_id))
+    elif item.status == MODERATION_REJECTED:
+        item.status = MODERATION_PENDING
+        item.queued_at = datetime.datetime.now()
+        item.claimed_by_id = item.claimed_until = item.decided_by_id = item.decided_at = None
+
+
+def remove(tour_ids):
+    """! Удалить путеводители из очереди в текущей транзакции (при скрытии и удалении путеводителей)."""
+    if tour_ids:
+        db.session.execute(delete(ModerationItem).where(ModerationItem.tour_id.in_(list(tour_ids))))
+
+
+def available_to(moderator_id, now):
+    """! Условие на строки очереди, решение по которым может принять модератор: ожидающие путеводители, которые
+    никем не взяты, взяты им самим или аренда которых истекла."""
+    return and_(ModerationItem.status == MODERATION_PENDING,
+                or_(ModerationItem.claimed_until == None, ModerationItem.claimed_until < now,
+                    ModerationItem.claimed_by_id == moderator_id))
+
+
+def claim(moderator_id, limit=None):
+    """! Взять на проверку первые в очереди путеводители, доступные модератору, на lease секунд (секция MODERATION).
+    Выбор и захват выполняются одним запросом, поэтому два модератора не получат один путеводитель.
+    Путеводители, уже взятые этим модератором, входят в результат, а их аренда продлевается.
+    @param moderator_id Идентификатор модератора.
+    @param limit Количество путеводителей, по умолчанию claim_size.
+
+    @returns список идентификаторов путеводителей в порядке очереди
+    """
+    now = datetime.datetime.now()
+    limit = limit or moderation_setting("claim_size", 20)
+    available = (select(ModerationItem.tour_id)
+                 .where(available_to(moderator_id, now))
+                 .order_by(ModerationItem.queued_at, ModerationItem.tour_id)
+                 .limit(limit))
+    claimed = db.session.execute(
+        update(ModerationItem)
+        .where(ModerationItem.tour_id.in_(available))
+        .values(claimed_by_id=moderator_id,
+                claimed_until=now + datetime.timedelta(seconds=moderation_setting("lease", 900)))
+        .returning(ModerationItem.tour_id, ModerationItem.queued_at)
+        .execution_options(synchronize_session=False)).all()
+    db.session.commit()
+    return [tour_id for tour_id, _ in sorted(claimed, key=lambda row: (row.queued_at, row.tour_id))]
+
+
+def encode_cursor(item):
+    """! Курсор списка очереди, указывающий на позицию сразу после элемента."""
+    return f"{item.queued_at.isoformat()}_{item.tour_id}"
+
+
+def decode_cursor(cursor):
+    """! Разобрать курсор из encode_cursor.
+
+    @returns кортеж (queued_at, tour_id) или None, если курсор некорректен
+    """
+    try:
+        queued_at, tour_id = cursor.rsplit("_", 1)
+        return datetime.datetime.fromisoformat(queued_at), int(tour_id)
+    except (ValueError, AttributeError):
+        return None
+
+
+def pending_page(cursor=None, page_size=20):
+    """! Получить одну страницу ожидающих путеводителей в порядке очереди, листая по (queued_at, tour_id)
+    с помощью индекса ix_moderation_queue_fifo.
+    @param cursor Курсор из encode_cursor или None для начала очереди.
+    @param page_size Количество элементов на странице.
+
+    @returns список элементов очереди, курсор следующей страницы (None, если страница последняя)
+    """
+    query = db.session.query(ModerationItem).filter(ModerationItem.status == MODERATION_PENDING)
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        query = query.filter(tuple_(ModerationItem.queued_at, ModerationItem.tour_id) > position)
+    items = query.order_by(ModerationItem.queued_at, ModerationItem.tour_id).limit(page_size + 1).all()
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = encode_cursor(items[-1])
+    return items, next_cursor
+
+
+def decide(moderator_id, approve_ids=(), reject_ids=()):
+    """! Применить решения модератора пакетно в текущей транзакции: одобрить путеводители одним запросом UPDATE
+    к tours и удалить их из очереди, отклонить - одним запросом UPDATE к очереди. Путеводители, взятые на проверку
+    другим модератором, и уже проверенные путеводители пропускаются.
+    @param moderator_id Идентификатор модератора.
+    @param approve_ids Идентификаторы одобряемых путеводителей.
+    @param reject_ids Идентификаторы отклоняемых путеводителей.
+
+    @returns словарь {"approved": [...], "rejected": [...], "skipped": [...]}
+    """
+    from app.logic import update_user_summary
+    now = datetime.datetime.now()
+    approve_ids, reject_ids = set(approve_ids), set(reject_ids) - set(approve_ids)
+    approved = []
+    if approve_ids:
+        decidable = select(ModerationItem.tour_id).where(ModerationItem.tour_id.in_(approve_ids),
+                                                         available_to(moderator_id, now))
+        approved = db.session.execute(
+            update(Tour)
+            .where(Tour.id.in_(decidable), Tour.moderated_by_id == None, Tour.archived == False)
+            .values(moderated_by_id=moderator_id)
+            .returning(Tour.id, Tour.created_by_id)
+            .execution_options(synchronize_session=False)).all()
+        remove([tour_id for tour_id, _ in approved])
+        published = {}
+        for _, author_id in approved:
+            published[author_id] = published.get(author_id, 0) + 1
+        for author_id, count in published.items():
+            update_user_summary(author_id, published_count=count)
+    rejected = []
+    if reject_ids:
+        rejected = db.session.execute(
+            update(ModerationItem)
+            .where(ModerationItem.tour_id.in_(reject_ids), available_to(moderator_id, now))
+            .values(status=MODERATION_REJECTED, decided_by_id=moderator_id, decided_at=now,
+                    claimed_by_id=None, claimed_until=None)
+            .returning(ModerationItem.tour_id)
+            .execution_options(synchronize_session=False)).scalars().all()
+    approved = sorted(tour_id for tour_id, _ in approved)
+    decided = set(approved) | set(rejected)
+    return {"approved": approved, "rejected": sorted(rejected),
+            "skipped": sorted((approve_ids | reject_ids) - decided)}
@@ -0,0 +1,202 @@
+##
+# @file
+#
+# @brief Файл профилирования запросов.
+#
+# @section desctiption_profiling Description
+# Включается параметром enabled секции PROFILING файла config.ini. Для каждого запроса считаются SQL запросы и время
+# их выполнения, самые медленные из них, время отрисовки шаблонов и размер ответа. Одинаковый запрос, выполненный
+# много раз за один запрос к серверу, считается признаком проблемы N+1 и записывается в журнал.
+# Результаты передаются в заголовке Server-Timing и накапливаются в метриках, доступных по адресу /api/metrics
+# в текстовом формате Prometheus. Метрики хранятся в памяти процесса, каждый процесс-обработчик gunicorn отдает свои.
+# Если профилирование выключено, обработчики не регистрируются и накладных расходов нет.
+
+import bisect
+import collections
+import threading
+import time
+
+from flask import g, request, has_request_context
+from jinja2 import Template
+from sqlalchemy import event
+
+from app import db
+
+## Границы интервалов гистограммы времени ответа в секундах
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def profiling_setting(config, key, default):
+    """! Получить параметр секции PROFILING файла config.ini."""
+    return config["PROFILING"].get(key, default) if config.has_section("PROFILING") else default
+
+
+class RequestProfile:
+    """! Данные профилирования одного запроса к серверу"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.statements = collections.Counter()
+        self.slowest = []  # (время, запрос), по возрастанию времени
+
+    def add_statement(self, statement, duration, keep_slowest):
+        """! Учесть выполненный SQL запрос."""
+        self.sql_count += 1
+        self.sql_time += duration
+        self.statements[statement] += 1
+        if len(self.slowest) < keep_slowest or duration > self.slowest[0][0]:
+            bisect.insort(self.slowest, (duration, statement))
+            del self.slowest[:-keep_slowest]
+
+    def repeated(self, threshold):
+        """! Запросы, выполненные не менее threshold раз (признак N+1)."""
+        return [(statement, count) for statement, count in self.statements.most_common() if count >= threshold]
+
+
+class Histogram:
+    """! Гистограмма с накоплением для формата Prometheus"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+
+    def lines(self, name, labels):
+        """! Строки гистограммы в текстовом формате Prometheus."""
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f'{name}_bucket{{{labels},le="{le}"}} {cumulative}'
+        yield f"{name}_sum{{{labels}}} {self.total}"
+        yield f"{name}_count{{{labels}}} {cumulative}"
+
+
+class Metrics:
+    """! Метрики запросов, сгруппированные по эндпоинту"""
+
+    ## Суммы по эндпоинту: имя метрики, описание
+    COUNTERS = {
+        "sql_statements": "SQL statements executed",
+        "sql_seconds": "Time spent in SQL",
+        "template_seconds": "Time spent rendering templates",
+        "response_bytes": "Response body size",
+        "n_plus_one": "Requests with repeated SQL statements (N+1)",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.counters = {name: collections.Counter() for name in self.COUNTERS}
+
+    def record(self, endpoint, status, latency, **values):
+        with self.lock:
+            key = (endpoint, status)
+            if key not in self.latency:
+                self.latency[key] = Histogram(LATENCY_BUCKETS)
+            self.latency[key].observe(latency)
+            for name, value in values.items():
+                self.counters[name][endpoint] += value
+
+    def render(self):
+        """! Все метрики в текстовом формате Prometheus."""
+        lines = ["# HELP tourspoon_request_seconds Request latency",
+                 "# TYPE tourspoon_request_seconds histogram"]
+        with self.lock:
+            for (endpoint, status), histogram in sorted(self.latency.items()):
+                lines.extend(histogram.lines("tourspoon_request_seconds", f'endpoint="{endpoint}",status="{status}"'))
+            for name, description in self.COUNTERS.items():
+                lines.append(f"# HELP tourspoon_{name}_total {description}")
+                lines.append(f"# TYPE tourspoon_{name}_total counter")
+                for endpoint, value in sorted(self.counters[name].items()):
+                    lines.append(f'tourspoon_{name}_total{{endpoint="{endpoint}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+class TimedTemplate(Template):
+    """! Шаблон Jinja, учитывающий время своей отрисовки в профиле текущего запроса"""
+
+    def render(self, *args, **kwargs):
+        profile = g.get("profile") if has_request_context() else None
+        if profile is None:
+            return super().render(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            profile.template_time += time.perf_counter() - started
+
+
+def init_profiling(app):
+    """! Включить профилирование запросов приложения, если оно включено в конфигурации.
+    @param app Приложение, созданное create_app.
+    """
+    config = app.config["INI"]
+    if profiling_setting(config, "enabled", "0") == "0":
+        return
+    keep_slowest = int(profiling_setting(config, "slowest_statements", 3))
+    n_plus_one = int(profiling_setting(config, "n_plus_one_threshold", 10))
+    metrics = app.extensions["metrics"] = Metrics()
+    app.jinja_env.template_class = TimedTemplate
+
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # время начала хранится в контексте выполнения, а не в соединении: у упавших запросов
+        # after_cursor_execute не вызывается, и запись в conn.info осталась бы навсегда
+        context._query_start = time.perf_counter()
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - context._query_start
+        profile = g.get("profile") if has_request_context() else None
+        if profile is not None:
+            profile.add_statement(statement, duration, keep_slowest)
+
+    # движков несколько, если чтение выделено в отдельный движок (см. database.py)
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    @app.before_request
+    def start_profile():
+        g.profile = RequestProfile()
+
+    @app.after_request
+    def finish_profile(response):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+        total = time.perf_counter() - profile.started
+        size = response.calculate_content_length() or 0
+        endpoint = request.endpoint or "unknown"
+        repeated = profile.repeated(n_plus_one)
+        for statement, count in repeated:
+            app.logger.warning("N+1 in %s: statement executed %d times: %s", endpoint, count, statement)
+        timings = [f'sql;dur={profile.sql_time * 1000:.2f};desc="{profile.sql_count} statements"',
+                   f"tpl;dur={profile.template_time * 1000:.2f}",
+                   f"total;dur={total * 1000:.2f}"]
+        if profile.slowest:
+            timings.append(f"sql-max;dur={profile.slowest[-1][0] * 1000:.2f}")
+        if repeated:
+            timings.append(f'n1;desc="{len(repeated)} repeated statements"')
+        response.headers.add("Server-Timing", ", ".join(timings))
+        for duration, statement in reversed(profile.slowest):
+            app.logger.debug("%s: %.2f ms: %s", endpoint, duration * 1000, statement)
+        metrics.record(endpoint, response.status_code, total, sql_statements=profile.sql_count,
+                       sql_seconds=profile.sql_time, template_seconds=profile.template_time,
+                       response_bytes=size, n_plus_one=1 if repeated else 0)
+        return response
+
+    def metrics_page():
+        """! Эндпоинт метрик в текстовом формате Prometheus"""
+        return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+    app.add_url_rule("/api/metrics", "metrics", metrics_page)
@@ -6,24 +6,39 @@
 # @section desctiption_routes Description
 # Файл содержит функции, используемые программой для получения, обработки и ответа на запросы клиента.
 
-from flask import render_template, redirect, url_for, request, flash, abort
+import mimetypes
+
+from flask import Blueprint, current_app, render_template, redirect, url_for, request, flash, abort, jsonify, make_response, send_from_directory
 from flask_login import login_user, login_required, logout_user, current_user
+from sqlalchemy.orm import joinedload
 from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.utils import secure_filename
+
 
+from app import db, manager
+from app.models import User, Tour, TourReaction, TourTag, UserSummary, ModerationItem, MODERATION_PENDING, \
+    tours_to_tags_association
+from app.logic import process_tour, save_file, get_feed_page, feed_eager_options, render_tour_canvases, invalidate_tour_canvas, \
+    tour_canvas_version, update_rating, update_user_summary, update_author_summary, FEED_SORTS
+from app import search as search_index
+from app import geo
+from app import feed
+from app import moderation
+from app.config import config
+from app.storage import is_content_addressed
+from app.cache import invalidate_user
+from app.jobs import enqueue
 
-from app import app, db, manager
-from app.models import User, Tour, TourBlock,TourReaction, TourTag
-from app.logic import process_tour, save_file
-from app import config
+bp = Blueprint("main", __name__)
 
 
 @manager.unauthorized_handler
 def unauthorized():
     """! Служебная функция для модуля flask_login, перенаправляет неавторизованных пользователей,
     попытавшихся войти на страницу, требующую авторизации, на страницу авторизации"""
-    return redirect(url_for("login_page") + f"?next={request.url}")
+    return redirect(url_for("main.login_page") + f"?next={request.url}")
 
-@app.route("/login", methods=['post', 'get'])
+@bp.route("/login", methods=['post', 'get'])
 def login_page():
     """! Эндпоинт авторизации"""
     if current_user:
@@ -38,15 +53,13 @@ def login_page():
                 flash("Неверный пароль")
             else:
                 login_user(user)
-                user.is_authenticated = True
                 next_page = request.args.get('next')
                 if not next_page:
-                    next_page = url_for('index_page')
-                db.session.commit()
+                    next_page = url_for('.index_page')
                 return redirect(next_page)
     return render_template("login.html")
 
-@app.route('/reg', methods=['post', 'get'])
+@bp.route('/reg', methods=['post', 'get'])
 def reg():
     """! Эндпоинт регистрации"""
     if request.method == 'POST':
@@ -65,13 +78,11 @@ def reg():
             db.session.commit()
             user = db.session.query(User).filter(User.login == login).one()
             login_user(user)
-            user.is_authenticated = True
-            db.session.commit()
-            return redirect(url_for("index_page"))
+            return redirect(url_for(".index_page"))
 
     return render_template("reg.html", warning="")
     
-@app.route('/', methods=['get'])
+@bp.route('/', methods=['get'])
 def index_page():
     """! Эндпоинт главной страницы.
     Отрисовывает страницу, включая туда путеводители, полученные из бд, исходя из фильтров переданных в аргументах.
@@ -79,6 +90,9 @@ def index_page():
     search = request.args.get("s")
     category_id = request.args.get("c")
     by_user_id = request.args.get("u")
+    cursor = request.args.get("after")
+    sort = request.args.get("sort") if request.args.get("sort") in FEED_SORTS else "recent"
+    personal = request.args.get("sort") == "personal"
     
     not_moderated = False    # получать ТОЛЬКО не модерированные туры, для модераторов
     user = None
@@ -93,12 +107,10 @@ def index_page():
     
     check_self = False # посмотерть свои публикации, включая не модерированные
     
-    if search:
-        query = query.filter(Tour.name.like(f"%{search}%"))
     if by_user_id:
         query = query.filter(Tour.created_by_id == by_user_id)
         if user:
-            if by_user_id == user.id:
+            if by_user_id == str(user.id):
                 check_self = True
                 
     if (moderation_enabled and not not_moderated) and (not check_self):
@@ -107,17 +119,41 @@ def index_page():
     if not_moderated:
         query = query.filter(Tour.moderated_by_id == None)
     
-    if not check_self:
-        query = query.filter(Tour.archived==False)
-    tours = query.all()
+    # archived - удаленный путеводитель, строки которого еще не удалила фоновая задача
+    query = query.filter(Tour.archived==False)
     
     if category_id:
-        category = db.session.query(TourTag).filter(TourTag.id == category_id).first()
-        tours = [tour for tour in tours if category in tour.tags]
+        query = query.join(tours_to_tags_association, tours_to_tags_association.c.tour_id == Tour.id)\
+            .filter(tours_to_tags_association.c.tag_id == category_id)
+    
+    page_size = int(config["SITE"].get("page_size", 20))
+    next_page_url = None
+    if search:
+        # результаты поиска упорядочены по релевантности, поэтому листаются по номеру страницы
+        page = request.args.get("p", 0, type=int)
+        tours, has_next = search_index.search_tours(query.options(*feed_eager_options()), search, page, page_size)
+        if has_next:
+            next_page_url = url_for(".index_page", **dict(request.args.items(), p=page + 1))
+    else:
+        # персональная лента по любимым категориям, без них - обычная лента новых путеводителей
+        tag_ids = feed.favourite_tag_ids(user.id) if personal and user else []
+        if tag_ids:
+            tours, next_cursor = feed.get_personal_feed_page(query, tag_ids, cursor, page_size)
+        else:
+            tours, next_cursor = get_feed_page(query, cursor, page_size, sort)
+        if next_cursor:
+            next_page_url = url_for(".index_page", **dict(request.args.items(), after=next_cursor))
     
     tags = db.session.query(TourTag).all()
     
-    return render_template("index.html", tours=tours, user=user, tags=tags)
+    # сводка автора для страницы его путеводителей: количество путеводителей, которые видны на этой странице
+    author_summary = db.session.get(UserSummary, int(by_user_id)) if by_user_id and by_user_id.isdigit() else None
+    author_tours_count = None
+    if author_summary:
+        author_tours_count = author_summary.published_count if moderation_enabled and not check_self \
+            else author_summary.tours_count
+    return render_template("index.html", tours=tours, user=user, tags=tags, next_page_url=next_page_url,
+                           author_summary=author_summary, author_tours_count=author_tours_count)
         
         
         
@@ -125,17 +161,20 @@ def index_page():
     
     
 
-@app.route('/tour/<tour_id>', methods=['get', 'post'])
+## Количество комментариев на одной странице путеводителя
+REACTIONS_PAGE_SIZE = 20
+
+@bp.route('/tour/<tour_id>', methods=['get', 'post'])
 def tour_page(tour_id):
     """! Эндпоинт просмотра/изменения/создания путеводителя. Для просмотра или изменения требует id, для создания id=create"""
     if tour_id != 'create':
         tour = db.session.query(Tour).filter(Tour.id == tour_id).first()
-        if not tour:
+        if not tour or tour.archived:
             abort(404)
         edit_mode = request.args.get("edit_mode")
         if edit_mode:
             if not current_user:
-                return redirect(url_for("login_page")+"?next="+request.path)
+                return redirect(url_for(".login_page")+"?next="+request.path)
             if tour.created_by_id != current_user.id:
                 abort(403)  # permission denied
             if request.method == "POST":
@@ -159,29 +198,50 @@ def tour_page(tour_id):
                     tour_id                    
                 )
                 db.session.add(reaction)
+                db.session.flush()
+                update_rating(reaction, 1)
+                update_user_summary(tour.created_by_id, reactions_received=1)
                 db.session.commit()
+            reactions_query = db.session.query(TourReaction).filter(TourReaction.tour_id == tour.id)
+            reactions_before = request.args.get("rb", type=int)
+            if reactions_before:
+                reactions_query = reactions_query.filter(TourReaction.id < reactions_before)
+            reactions = (reactions_query
+                         .options(joinedload(TourReaction.created_by))
+                         .order_by(TourReaction.id.desc())
+                         .limit(REACTIONS_PAGE_SIZE + 1)
+                         .all())
+            more_reactions_url = None
+            if len(reactions) > REACTIONS_PAGE_SIZE:
+                reactions = reactions[:REACTIONS_PAGE_SIZE]
+                more_reactions_url = url_for(".tour_page", tour_id=tour.id, rb=reactions[-1].id)
             return render_template("tour.html",
                                    tour = tour,
-                                   user = user
+                                   user = user,
+                                   reactions = reactions,
+                                   more_reactions_url = more_reactions_url
                                     )
     else:
         if not current_user:
-            return redirect(url_for("login_page")+"?next="+request.path)
+            return redirect(url_for(".login_page")+"?next="+request.path)
         if current_user.is_anonymous:
-            return redirect(url_for("login_page")+"?next="+request.path)
+            return redirect(url_for(".login_page")+"?next="+request.path)
         else:
             if request.method == "POST":
                 new_tour_id = process_tour(request.form, tour_id, current_user, request.files)
-                return redirect(url_for('tour_page', tour_id=new_tour_id))
+                return redirect(url_for('.tour_page', tour_id=new_tour_id))
             return render_template("edit_tour.html",
                                    tour=None,
                                    tags = db.session.query(TourTag).all())
             
 
-@app.route('/cab', methods=['get', 'post'])
+@bp.route('/cab', methods=['get', 'post'])
 @login_required
 def cab_page():
-    """! Эндпоинт личного кабинета"""
+    """! Эндпоинт личного кабинета. current_user содержит только поля из кэша (models.SessionUser), поэтому
+    изменяемый пользователь загружается из БД, а его запись в кэше после изменения удаляется."""
+    user = db.session.get(User, current_user.id)
+    tags = db.session.query(TourTag).all()
     if request.method == "POST":
         if current_user.is_moderator:
             grant_login = request.form.get("grant")
@@ -189,6 +249,7 @@ def cab_page():
                 grant_user = db.session.query(User).filter(User.login == grant_login).first()
                 if grant_user:
                     grant_user.is_moderator = True
+                    invalidate_user(grant_user.id)
                     db.session.commit()
                 else:
                     flash("Пользователь не найден")
@@ -198,57 +259,217 @@ def cab_page():
         password = request.form.get("password")
         repass = request.form.get("repass")
         
-        photo = request.files.get("profile_phote")
+        photo = request.files.get("profile_photo")
         
         if photo:
             profile_photo_path = save_file(photo)
-            current_user.profile_photo_path = profile_photo_path
+            user.profile_photo_path = profile_photo_path
         
         if login:
             if db.session.query(User).filter(User.login == login).first():
                 flash("Логин занят")
             else:
-                current_user.login = login
+                user.login = login
                 
         if password:
             if password != repass:
                 flash("Пароли не совпадают")
             else:
-                current_user.password_hash = generate_password_hash(password)
-        current_user.bio = bio
+                user.password_hash = generate_password_hash(password)
+        user.bio = bio
+
+        if request.form.get("favourite_tags_sent"):
+            tag_ids = {int(tag_id) for tag_id in request.form.getlist("favourite_tags") if tag_id.isdigit()}
+            user.favourite_tags = [tag for tag in tags if tag.id in tag_ids]
         
+        invalidate_user(user.id)
         db.session.commit()
-    return render_template("cab.html", user=current_user)
+    return render_template("cab.html", user=user, tags=tags, favourite_tag_ids=feed.favourite_tag_ids(user.id),
+                           summary=db.session.get(UserSummary, user.id))
             
-@app.route('/api/get_tour_canvas/<tour_id>', methods=['get'])
+@bp.route('/api/get_tour_canvas/<tour_id>', methods=['get'])
 def get_tour_canvas(tour_id):
-    """! Эндпоинт получения элементов путеводителя."""
-    tour = db.session.query(Tour).filter(Tour.id == tour_id).first()
-    return render_template("tour_canvas.html", tour=tour)
+    """! Эндпоинт получения элементов путеводителя. Поддерживает условные запросы по ETag/Last-Modified,
+    основанным на Tour.last_updated_at и Tour.media_version."""
+    row = db.session.query(Tour.id, Tour.last_updated_at, Tour.media_version).filter(Tour.id == tour_id).first()
+    if not row:
+        abort(404)
+    response = make_response("")
+    response.set_etag(f"{row.id}-{row.last_updated_at.timestamp()}-{row.media_version}")
+    response.last_modified = row.last_updated_at
+    response.cache_control.no_cache = True
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+    response.set_data(render_tour_canvases({row.id: tour_canvas_version(row)})[row.id])
+    return response
+
+
+## Максимальное количество путеводителей в одном запросе /api/tour_canvases
+MAX_CANVASES_PER_REQUEST = 100
+
+@bp.route('/api/tour_canvases', methods=['get'])
+def get_tour_canvases():
+    """! Эндпоинт пакетного получения элементов путеводителей. Принимает идентификаторы через запятую в аргументе ids,
+    возвращает JSON вида {<id>: <отрисованные блоки>}. Блоки всех путеводителей, которых нет в кэше, загружаются одним запросом."""
+    ids = [int(id_) for id_ in request.args.get("ids", "").split(",") if id_.strip().isdigit()]
+    if len(ids) > MAX_CANVASES_PER_REQUEST:
+        abort(400)
+    versions = {}
+    if ids:
+        versions = {row.id: tour_canvas_version(row) for row in
+                    db.session.query(Tour.id, Tour.last_updated_at, Tour.media_version).filter(Tour.id.in_(ids))}
+    return jsonify(render_tour_canvases(versions))
     
         
 
-@app.route('/api/delete')
+## Максимальное количество точек в ответе /api/tours/near и /api/tours/in_bbox
+MAX_MAP_POINTS = 5000
+
+def map_visibility_sql():
+    """! Условие на таблицу tours для поиска по карте: только опубликованные путеводители, если включена модерация."""
+    return "AND tours.moderated_by_id IS NOT NULL" if config["SITE"]["moderation_enabled"] != "0" else ""
+
+@bp.route('/api/tours/near', methods=['get'])
+def tours_near():
+    """! Эндпоинт поиска путеводителей с точками на карте в радиусе r километров (по умолчанию 10) от точки lat, lon.
+    Возвращает JSON вида {"tours": [{"id": <id>, "points": [{"block_id", "latitude", "longitude", "distance_km"}]}]},
+    путеводители упорядочены по расстоянию до ближайшей точки."""
+    latitude = request.args.get("lat", type=float)
+    longitude = request.args.get("lon", type=float)
+    radius = request.args.get("r", 10, type=float)
+    if latitude is None or longitude is None or radius <= 0:
+        abort(400)
+    limit = min(request.args.get("limit", 1000, type=int), MAX_MAP_POINTS)
+    points = geo.points_near(latitude, longitude, radius, map_visibility_sql(), limit)
+    return jsonify(tours=geo.group_by_tour(points))
+
+@bp.route('/api/tours/in_bbox', methods=['get'])
+def tours_in_bbox():
+    """! Эндпоинт поиска путеводителей с точками на карте внутри прямоугольника min_lat, min_lon, max_lat, max_lon.
+    Возвращает JSON того же вида, что и /api/tours/near, без расстояний."""
+    bounds = [request.args.get(name, type=float) for name in ("min_lat", "min_lon", "max_lat", "max_lon")]
+    if None in bounds or bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+        abort(400)
+    limit = min(request.args.get("limit", 1000, type=int), MAX_MAP_POINTS)
+    points = geo.points_in_bbox(*bounds, visibility_sql=map_visibility_sql(), limit=limit)
+    return jsonify(tours=geo.group_by_tour(points))
+
+
+## Время кэширования файлов с именами по хэшу содержимого (год), такие файлы никогда не меняются
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+@bp.route('/media/<filename>', methods=['get'])
+def media_file(filename):
+    """! Эндпоинт отдачи загруженных файлов. Поддерживает запросы диапазонов байт (Range) и условные запросы.
+    Если в секции MEDIA задан accel_redirect, сама передача файла поручается прокси-серверу через X-Accel-Redirect."""
+    if filename != secure_filename(filename):
+        abort(404)
+    accel_prefix = config["MEDIA"].get("accel_redirect") if config.has_section("MEDIA") else None
+    if accel_prefix:
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + filename
+        response.headers["Content-Type"] = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    else:
+        response = send_from_directory(current_app.config['UPLOAD_FOLDER'], filename, conditional=True)
+    if is_content_addressed(filename):
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
+@bp.route('/api/delete')
+@login_required
 def delete():
-    """! Эндпоинт удаления путеводителя/комментария. Требует передачи типа и идентификатора в аргументах запроса."""
+    """! Эндпоинт удаления путеводителя/комментария. Требует передачи типа и идентификатора в аргументах запроса.
+    Удалить путеводитель или комментарий может только его автор."""
     type_ = request.args.get("t")
     id_ = request.args.get("id")
     if type_ == "tour":
         tour = db.session.query(Tour).filter(Tour.id == id_).first()
-        db.session.delete(tour)
+        if not tour or tour.archived:
+            abort(404)
+        if tour.created_by_id != current_user.id:
+            abort(403)
+        # путеводитель сразу скрывается, а его строки и запись индекса поиска удаляет фоновая задача
+        # logic.delete_tour, поэтому время ответа не зависит от количества блоков и комментариев
+        tour.archived = True
+        db.session.flush()
+        update_author_summary(tour, -1)
+        feed.remove_tours([tour.id])
+        moderation.remove([tour.id])
+        enqueue("delete_tour", created_by_id=current_user.id, tour_id=tour.id)
+        invalidate_tour_canvas(tour.id)
     elif type_ == "reaction":
         reaction = db.session.query(TourReaction).filter(TourReaction.id == id_).first()
+        if not reaction:
+            abort(404)
+        if reaction.created_by_id != current_user.id:
+            abort(403)
         db.session.delete(reaction)
+        db.session.flush()
+        update_rating(reaction, -1)
+        author_id, archived = db.session.query(Tour.created_by_id, Tour.archived).filter(Tour.id == reaction.tour_id).one()
+        if not archived:
+            update_user_summary(author_id, reactions_received=-1)
     db.session.commit()
     return "ok"
     
-@app.route('/api/moderate')
+@bp.route('/moderation', methods=['get'])
+@login_required
+def moderation_page():
+    """! Эндпоинт страницы модерации: модератор берет из начала очереди путеводители, которые не проверяет другой
+    модератор (moderation.claim), и отправляет решения по всем ним одной формой в /api/moderate."""
+    if not current_user.is_moderator:
+        abort(403)
+    tour_ids = moderation.claim(current_user.id)
+    tours = {tour.id: tour for tour in db.session.query(Tour).filter(Tour.id.in_(tour_ids))
+             .options(*feed_eager_options())} if tour_ids else {}
+    pending_count = db.session.query(db.func.count(ModerationItem.tour_id))\
+        .filter(ModerationItem.status == MODERATION_PENDING).scalar()
+    return render_template("moderation.html", tours=[tours[tour_id] for tour_id in tour_ids if tour_id in tours],
+                           user=current_user, pending_count=pending_count,
+                           lease_minutes=moderation.moderation_setting("lease", 900) // 60)
+
+
+def parse_ids(values):
+    """! Преобразовать идентификаторы из запроса в целые числа; None, если среди них есть не числа."""
+    try:
+        return [int(value) for value in values]
+    except (TypeError, ValueError):
+        return None
+
+
+@bp.route('/api/moderate', methods=['get', 'post'])
 def moderate():
-    """! Эндпоинт, чтобы отметить путеводитель как модерированный, требует перадачи идентификаторов путеводителя и модератора в аргументах запроса."""
-    tour_id = request.args.get("tid")
-    moderator_id = request.args.get("mid")
-    tour = db.session.query(Tour).filter(Tour.id == tour_id).first()
-    tour.moderated_by_id = moderator_id
+    """! Эндпоинт решений модератора по путеводителям (см. moderation.decide). POST принимает JSON
+    {"approve": [<id>, ...], "reject": [<id>, ...]} или форму страницы модерации (поля decision-<id> со значением
+    approve или reject), GET - одобрение одного путеводителя tid. Возвращает JSON {"approved", "rejected", "skipped"},
+    после формы страницы модерации перенаправляет на нее же со следующими путеводителями очереди."""
+    if current_user.is_anonymous or not current_user.is_moderator:
+        abort(403)
+    from_form = False
+    if request.method == "GET":
+        approve, reject = parse_ids([request.args.get("tid")]), []
+    elif request.is_json:
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        approve, reject = parse_ids(body.get("approve", [])), parse_ids(body.get("reject", []))
+    else:
+        from_form = True
+        decisions = {key.split("-", 1)[1]: value for key, value in request.form.items()
+                     if key.startswith("decision-")}
+        approve = parse_ids([tour_id for tour_id, value in decisions.items() if value == "approve"])
+        reject = parse_ids([tour_id for tour_id, value in decisions.items() if value == "reject"])
+    if approve is None or reject is None:
+        abort(400)
+    if len(approve) + len(reject) > moderation.moderation_setting("max_decisions", 500):
+        abort(413)
+    result = moderation.decide(current_user.id, approve, reject)
     db.session.commit()
-    return "ok"
+    if from_form:
+        return redirect(url_for(".moderation_page"))
+    return jsonify(result)
     
\ No newline at end of file
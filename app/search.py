@@ -0,0 +1,116 @@
+##
+# @file
+#
+# @brief Файл полнотекстового поиска путеводителей.
+#
+# @section desctiption_search Description
+# Для SQLite поиск идет по виртуальной таблице FTS5 tour_search, в которой для каждого путеводителя (rowid = Tour.id)
+# хранятся его название, заголовки и текст блоков и названия категорий. Таблица обновляется при сохранении и удалении
+# путеводителей. Для других СУБД используется поиск через LIKE по тем же полям.
+
+import re
+
+from sqlalchemy import text, select, literal_column, or_
+
+from app import db
+from app.models import Tour, TourBlock, TourTag, tours_to_tags_association
+
+def index_rows_sql(tour_ids=None):
+    """! Запрос, вставляющий в индекс строки для путеводителей. Блоки и категории группируются одним проходом,
+    поэтому запрос годится и для заполнения индекса целиком.
+    @param tour_ids Идентификаторы путеводителей или None для всех путеводителей.
+    """
+    where = ""
+    if tour_ids is not None:
+        where = "WHERE tour_id IN ({})".format(", ".join(str(int(tour_id)) for tour_id in tour_ids))
+    return f"""
+    INSERT INTO tour_search (rowid, name, content, tags)
+    SELECT tours.id, tours.name, blocks.content, tags.names
+    FROM tours
+    LEFT JOIN (SELECT tour_id, group_concat(coalesce(name, '') || ' ' || coalesce(text, ''), ' ') AS content
+               FROM tour_blocks {where} GROUP BY tour_id) AS blocks ON blocks.tour_id = tours.id
+    LEFT JOIN (SELECT tour_id, group_concat(tour_tags.name, ' ') AS names
+               FROM tours_to_tags_association JOIN tour_tags ON tour_tags.id = tours_to_tags_association.tag_id
+               {where} GROUP BY tour_id) AS tags ON tags.tour_id = tours.id
+    {where.replace("tour_id", "tours.id")}
+    """
+
+
+def fts_enabled():
+    """! Используется ли индекс FTS5 (только для SQLite)."""
+    return db.engine.dialect.name == "sqlite"
+
+
+def create_search_index():
+    """! Создать таблицу индекса и заполнить ее всеми путеводителями, если ее еще нет."""
+    if not fts_enabled():
+        return
+    with db.engine.begin() as connection:
+        exists = connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'tour_search'")).first()
+        if not exists:
+            connection.execute(text("CREATE VIRTUAL TABLE tour_search USING fts5("
+                                    "name, content, tags, tokenize = 'unicode61 remove_diacritics 2')"))
+            connection.execute(text(index_rows_sql()))
+
+
+def index_tours(tour_ids):
+    """! Обновить строки индекса для путеводителей в текущей транзакции. Изменения блоков и категорий
+    должны быть уже отправлены в БД (db.session.flush()).
+    @param tour_ids Идентификаторы путеводителей.
+    """
+    if not fts_enabled() or not tour_ids:
+        return
+    ids = ", ".join(str(int(tour_id)) for tour_id in tour_ids)
+    db.session.execute(text(f"DELETE FROM tour_search WHERE rowid IN ({ids})"))
+    db.session.execute(text(index_rows_sql(tour_ids)))
+
+
+def remove_tours(tour_ids):
+    """! Удалить путеводители из индекса в текущей транзакции."""
+    if not fts_enabled() or not tour_ids:
+        return
+    ids = ", ".join(str(int(tour_id)) for tour_id in tour_ids)
+    db.session.execute(text(f"DELETE FROM tour_search WHERE rowid IN ({ids})"))
+
+
+def fts_query(search):
+    """! Преобразовать строку поиска пользователя в запрос FTS5: все слова должны встречаться, последнее - как префикс.
+
+    @returns строка запроса или None, если в строке нет слов
+    """
+    words = re.findall(r"\w+", search)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words[:-1]) + (" " if len(words) > 1 else "") + f'"{words[-1]}"*'
+
+
+def search_tours(query, search, page=0, page_size=20):
+    """! Отфильтровать запрос к Tour по строке поиска и получить одну страницу результатов.
+    С FTS5 результаты упорядочены по релевантности (bm25), иначе - по времени изменения.
+    @param query Запрос к Tour с уже наложенными фильтрами и опциями загрузки.
+    @param search Строка поиска пользователя.
+    @param page Номер страницы, начиная с 0.
+    @param page_size Количество путеводителей на странице.
+
+    @returns список путеводителей страницы, есть ли следующая страница
+    """
+    if fts_enabled():
+        match = fts_query(search)
+        if match is None:
+            return [], False
+        ranked = (select(literal_column("tour_search.rowid").label("tour_id"),
+                         literal_column("tour_search.rank").label("rank"))
+                  .select_from(text("tour_search"))
+                  .where(text("tour_search MATCH :match").bindparams(match=match))
+                  .subquery())
+        query = query.join(ranked, ranked.c.tour_id == Tour.id).order_by(ranked.c.rank, Tour.id.desc())
+    else:
+        pattern = f"%{search}%"
+        in_blocks = select(TourBlock.tour_id).where(or_(TourBlock.name.like(pattern), TourBlock.text.like(pattern)))
+        in_tags = (select(tours_to_tags_association.c.tour_id)
+                   .join(TourTag, TourTag.id == tours_to_tags_association.c.tag_id)
+                   .where(TourTag.name.like(pattern)))
+        query = query.filter(or_(Tour.name.like(pattern), Tour.id.in_(in_blocks), Tour.id.in_(in_tags)))\
+            .order_by(Tour.last_updated_at.desc(), Tour.id.desc())
+    tours = query.offset(page * page_size).limit(page_size + 1).all()
+    return tours[:page_size], len(tours) > page_size
@@ -0,0 +1,83 @@
+##
+# @file
+#
+# @brief Файл запуска приложения в режиме эксплуатации.
+#
+# @section desctiption_server Description
+# Приложение запускается сервером gunicorn с несколькими процессами-обработчиками. Приложение загружается один раз
+# в главном процессе (preload_app), после создания процесса-обработчика его пул соединений с БД сбрасывается,
+# чтобы процессы не использовали унаследованные соединения совместно. Потоки фоновых задач запускаются не в главном
+# процессе (fork процесса с работающими потоками может унаследовать захваченные ими блокировки), а в одном
+# процессе-обработчике - том, который захватил блокировку файла JOBS_LOCK_FILE.
+
+import fcntl
+import os
+
+from app import db
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # gunicorn - необязательная зависимость, нужна только для режима эксплуатации
+    BaseApplication = None
+
+## Файл в директории instance, блокировку которого держит процесс-обработчик, выполняющий фоновые задачи
+JOBS_LOCK_FILE = "jobs.lock"
+
+
+def server_options(app, workers=None, bind=None):
+    """! Параметры gunicorn из секции SERVER файла config.ini.
+    @param app Запускаемое приложение.
+    @param workers Количество процессов-обработчиков, переопределяет значение из конфигурации.
+    @param bind Адрес и порт, переопределяет значение из конфигурации.
+    """
+    config = app.config["INI"]
+    section = config["SERVER"] if config.has_section("SERVER") else {}
+
+    def post_fork(server, worker):
+        """! Хук gunicorn: сбросить соединения, унаследованные от главного процесса."""
+        with app.app_context():
+            for engine in db.engines.values():
+                engine.dispose(close=False)
+
+    def post_worker_init(worker):
+        """! Хук gunicorn: запустить обработчики фоновых задач, если этот процесс первым захватил блокировку
+        JOBS_LOCK_FILE. Блокировка снимается при завершении процесса и достается процессу, запущенному ему на замену."""
+        from app.jobs import start_embedded_workers
+        os.makedirs(app.instance_path, exist_ok=True)
+        lock_file = open(os.path.join(app.instance_path, JOBS_LOCK_FILE), "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return
+        # файл не закрывается до завершения процесса, чтобы блокировка сохранялась
+        worker.jobs_lock_file = lock_file
+        start_embedded_workers(app)
+
+    return {
+        "bind": bind or section.get("bind", "127.0.0.1:" + config["SITE"]["port"]),
+        "workers": workers or int(section.get("workers", 4)),
+        "threads": int(section.get("threads", 4)),
+        "timeout": int(section.get("timeout", 30)),
+        "preload_app": True,
+        "post_fork": post_fork,
+        "post_worker_init": post_worker_init,
+    }
+
+
+def run_production(app, workers=None, bind=None):
+    """! Запустить приложение сервером gunicorn. Блокирует выполнение до остановки сервера.
+    @param app Приложение, созданное create_app.
+    """
+    if BaseApplication is None:
+        raise RuntimeError("gunicorn is required for production mode: pip install gunicorn")
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in server_options(app, workers, bind).items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return app
+
+    Application().run()
@@ -231,6 +231,7 @@ function drag_n_drop(e, dragable, origin=null){
                 $(dragable).remove();
                 let id=insert_block(position);
                 mark_selected(id);
+                if (autosave) autosave.changed(id);
             }
             else{
                 let dragable_position = new Position(dragable.id);
@@ -241,6 +242,7 @@ function drag_n_drop(e, dragable, origin=null){
                 position.fix_out_of_bounds();
                 position.update_form(dragable.id);
                 mark_selected(dragable.id);
+                if (autosave) autosave.changed(dragable.id, ["row", "column"]);
             }
         } 
         else{
@@ -295,6 +297,7 @@ function resize(event){
         if (is_canvas_below(e)){
             new_position.calc_size();
             new_position.update_form(block.id);
+            if (autosave) autosave.changed(block.id, ["row", "column", "width", "height"]);
         }
         document.onmousemove = null;
         document.onmouseup = null;
@@ -311,7 +314,9 @@ function resize(event){
  * @returns 
  */
 function insert_block(position, type=0){ 
-    let new_block_id = document.getElementsByClassName("block").length;
+    // префикс "n" отличает новые блоки от сохраненных, у которых идентификатор совпадает с id в БД
+    let new_block_id = "n" + document.getElementsByClassName("block").length;
+    while (document.getElementById(new_block_id)) new_block_id += "_";
     let block = `<div class="block" id="`+new_block_id+`"
                     onmousedown=resize(event);>
                     <div onmousedown="drag_n_drop(event, this)"> 
@@ -440,6 +445,9 @@ function clear_fields(){
             $("#content_path").prop('files', null);
             $("#content_path").val('');
         }
+        else if (name == "old_content_path"){
+            $(input).val('');
+        }
     
     });
     $(block).find(".preview_name").text('');
@@ -459,7 +467,9 @@ function update_block(event){
     if (changed.id == "type_"){
         clear_fields();
         update_fields();
+        if (autosave) autosave.changed(selected_block_id, ["type", "name", "text", "content_path"]);
     }
+    else if (autosave && changed.id != "content_path") autosave.changed(selected_block_id, [changed.id]);
     if (changed.id == "show_on_map"){
         $("#latitude").attr('disabled', !changed.checked);
         $("#longitude").attr('disabled', !changed.checked);
@@ -470,10 +480,253 @@ function update_block(event){
     if (changed.id == "content_path"){
         update_media_preview(changed);
         $(`*[name="`+selected_block_id+ ":" + changed.id +`"]`).prop("files", $(changed).prop("files"));
-        console.log($(`*[name="`+selected_block_id+ ":" + changed.id +`"]`).prop("files"));  
+        if (autosave && changed.files.length) autosave.upload(selected_block_id, changed.files[0]);
     } 
 }
 
+/**
+ * Удалить выбранный блок из поля путеводителя
+ */
+function remove_selected_block(){
+    let id = selected_block_id;
+    $("#"+id).remove();
+    selected_block_id = null;
+    $(".properties>*").attr("disabled", true);
+    if (autosave) autosave.removed(id);
+}
+
+/**
+ * Автосохранение редактора (только для уже сохраненного путеводителя). Изменения блоков не отправляются сразу:
+ * запоминается, какие поля каких блоков изменились, и через delay мс после последнего изменения (но не позже
+ * max_delay мс после первого) они отправляются одним запросом PATCH с версией путеводителя. Значения полей
+ * берутся из скрытых полей блока в момент отправки, поэтому серия перемещений одного блока превращается
+ * в одну операцию. Пока запрос выполняется, новые изменения копятся и уходят следующим запросом.
+ * 
+ * @constructor
+ * @param form форма поля путеводителя с атрибутами data-version, data-autosave-url и data-upload-url
+ */
+class Autosave{
+    constructor(form){
+        this.version = parseInt(form.dataset.version);
+        this.url = form.dataset.autosaveUrl;
+        this.upload_url = form.dataset.uploadUrl;
+        this.delay = 800;
+        this.max_delay = 5000;
+        this.pending = new Map(); // идентификатор блока -> Set измененных полей или "remove"
+        this.tour_changed = false;
+        this.timer = null;
+        this.first_change = null;
+        this.in_flight = false;
+        this.stopped = false;
+    }
+
+    /**
+     * Запомнить изменение полей блока. Для нового блока (идентификатор с префиксом "n") поля не важны:
+     * он будет отправлен целиком операцией add.
+     */
+    changed(id, fields=[]){
+        let current = this.pending.get(id);
+        if (current == "remove") return;
+        if (!current) this.pending.set(id, current = new Set());
+        fields.forEach(field => current.add(field));
+        this.schedule();
+    }
+
+    /**
+     * Запомнить удаление блока. Новый блок, который еще не отправлялся, просто забывается.
+     */
+    removed(id){
+        if (is_saved_block(id) || this.in_flight) this.pending.set(id, "remove");
+        else this.pending.delete(id);
+        this.schedule();
+    }
+
+    /**
+     * Запомнить изменение названия или тэгов путеводителя
+     */
+    changed_tour(){
+        this.tour_changed = true;
+        this.schedule();
+    }
+
+    /**
+     * Загрузить файл блока; после загрузки имя файла попадает в блок как изменение content_path
+     */
+    upload(id, file){
+        let block = document.getElementById(id); // идентификатор блока может измениться во время загрузки
+        let data = new FormData();
+        data.append("file", file);
+        this.show_status("Загрузка файла...");
+        fetch(this.upload_url, {method: "POST", body: data})
+            .then(response => response.ok ? response.json() : Promise.reject(response.status))
+            .then(data => {
+                if (!$(block).find("*[name$=':old_content_path']").length){
+                    $(block).append(`<input hidden name="`+block.id+`:old_content_path">`);
+                }
+                $(block).find("*[name$=':old_content_path']").val(data.content_path);
+                $(block).find("*[name$=':content_path']").val('');
+                this.changed(block.id, ["content_path"]);
+            })
+            .catch(() => this.show_status("Не удалось загрузить файл"));
+    }
+
+    schedule(){
+        if (this.stopped) return;
+        let now = Date.now();
+        if (!this.first_change) this.first_change = now;
+        clearTimeout(this.timer);
+        let wait = Math.min(this.delay, Math.max(0, this.first_change + this.max_delay - now));
+        this.timer = setTimeout(() => this.send(), wait);
+        this.show_status("Есть несохраненные изменения");
+    }
+
+    /**
+     * Значение поля блока в типе столбца models.TourBlock
+     */
+    value(id, field){
+        let input_name = {"type": "type_", "content_path": "old_content_path"}[field] || field;
+        let input = $("*[name='" + id + ":" + input_name + "']");
+        if (field == "show_on_map") return input.prop("checked");
+        if (["type", "row", "column", "width", "height"].includes(field)) return parseInt(input.val());
+        if (field == "latitude" || field == "longitude"){
+            let number = parseFloat(input.val());
+            return isNaN(number) ? null : number;
+        }
+        return input.length ? input.val() : "";
+    }
+
+    /**
+     * Сформировать операции из накопленных изменений
+     */
+    build_ops(pending, tour_changed){
+        let ops = [];
+        if (tour_changed){
+            ops.push({op: "tour", name: $("input[name='tour_name']").val(), tags: $("#tags").val().map(Number)});
+        }
+        pending.forEach((fields, id) => {
+            let block_id = is_saved_block(id) ? parseInt(id) : id;
+            if (fields == "remove"){
+                ops.push({op: "remove", id: block_id});
+                return;
+            }
+            let op = (names, kind) => {
+                let result = {op: kind, id: block_id};
+                names.forEach(name => result[name] = this.value(id, name));
+                return result;
+            };
+            if (!is_saved_block(id)){
+                ops.push(op(BLOCK_FIELDS, "add"));
+                return;
+            }
+            let edited = BLOCK_EDIT_FIELDS.filter(name => fields.has(name));
+            if (fields.has("width") || fields.has("height")) ops.push(op(["row", "column", "width", "height"], "resize"));
+            else if (fields.has("row") || fields.has("column")) ops.push(op(["row", "column"], "move"));
+            if (edited.length) ops.push(op(edited, "edit"));
+        });
+        return ops;
+    }
+
+    send(keepalive=false){
+        clearTimeout(this.timer);
+        this.timer = null;
+        if (this.in_flight || this.stopped || (!this.pending.size && !this.tour_changed)) return;
+        let sent = this.pending, tour_changed = this.tour_changed;
+        // удаление нового блока, который не успел сохраниться, не требует запроса
+        sent.forEach((fields, id) => {if (fields == "remove" && !is_saved_block(id)) sent.delete(id);});
+        let ops = this.build_ops(sent, tour_changed);
+        this.pending = new Map();
+        this.tour_changed = false;
+        this.first_change = null;
+        if (!ops.length) return;
+        this.in_flight = true;
+        this.show_status("Сохранение...");
+        fetch(this.url, {method: "PATCH", keepalive: keepalive, headers: {"Content-Type": "application/json"},
+                         body: JSON.stringify({version: this.version, ops: ops})})
+            .then(response => response.json().then(data => [response.status, data]))
+            .then(([status, data]) => {
+                if (status == 200){
+                    this.version = data.version;
+                    Object.entries(data.ids).forEach(([key, id]) => this.rename(key, String(id)));
+                    this.show_status("Все изменения сохранены");
+                }
+                else if (status == 409){
+                    this.stopped = true;
+                    this.show_status("Путеводитель изменен в другом окне. Обновите страницу, чтобы продолжить");
+                }
+                else{
+                    this.stopped = true;
+                    this.show_status("Не удалось сохранить изменения: " + data.error);
+                }
+            })
+            .catch(() => { // ошибка сети: вернуть изменения в очередь и повторить позже
+                this.restore(sent, tour_changed);
+                this.show_status("Нет связи с сервером, изменения будут сохранены позже");
+            })
+            .finally(() => {
+                this.in_flight = false;
+                if (this.pending.size || this.tour_changed) this.schedule();
+            });
+    }
+
+    /**
+     * Вернуть в очередь изменения неотправленного запроса, объединив их с накопленными после него
+     */
+    restore(sent, tour_changed){
+        this.tour_changed = this.tour_changed || tour_changed;
+        sent.forEach((fields, id) => {
+            let current = this.pending.get(id);
+            if (fields == "remove" || current == "remove") this.pending.set(id, "remove");
+            else if (!current) this.pending.set(id, fields);
+            else fields.forEach(field => current.add(field));
+        });
+    }
+
+    /**
+     * Заменить временный идентификатор нового блока на идентификатор, полученный от сервера
+     */
+    rename(key, id){
+        let block = document.getElementById(key);
+        if (block){
+            block.id = id;
+            $(block).find("input").each(function(){
+                let name = $(this).attr("name");
+                $(this).attr("name", id + name.substring(name.indexOf(":")));
+            });
+        }
+        if (selected_block_id == key) selected_block_id = id;
+        if (this.pending.has(key)){
+            this.pending.set(id, this.pending.get(key));
+            this.pending.delete(key);
+        }
+    }
+
+    show_status(text){
+        $("#autosave-status").text(text);
+    }
+}
+
+/**
+ * Поля блока, отправляемые операцией add
+ */
+const BLOCK_FIELDS = ["name", "text", "content_path", "type", "show_on_map", "latitude", "longitude",
+                      "column", "row", "height", "width"];
+/**
+ * Поля блока, отправляемые операцией edit
+ */
+const BLOCK_EDIT_FIELDS = ["name", "text", "content_path", "type", "show_on_map", "latitude", "longitude"];
+
+/**
+ * Автосохранение редактора или null, если путеводитель еще не создан (тогда он сохраняется отправкой формы)
+ */
+let autosave = null;
+
+/**
+ * Определяет, сохранен ли блок в БД (у новых блоков временный идентификатор с префиксом "n")
+ */
+function is_saved_block(id){
+    return /^\d+$/.test(id);
+}
+
 $(document).ready(function(){ // установить ивент хэндлеры для правого сайдбара
     let input = document.getElementById("name");
     input.addEventListener('input', update_block);
@@ -501,5 +754,18 @@ $(document).ready(function(){ // установить ивент хэндлер
     input.addEventListener('propertychange', update_block);
     $(".properties>*").attr("disabled", true);
 
-
+    let form = document.getElementById("main_form");
+    if (form.dataset.autosaveUrl){
+        autosave = new Autosave(form);
+        $("input[name='tour_name']").on("input", () => autosave.changed_tour());
+        $("#tags").on("change", () => autosave.changed_tour());
+        // при уходе со страницы отправить накопленные изменения, не дожидаясь таймера
+        document.addEventListener("visibilitychange", () => {
+            if (document.visibilityState == "hidden") autosave.send(true);
+        });
+    }
+    $(document).on("keydown", function(e){
+        if (e.key != "Delete" || !selected_block_id || $(e.target).is("input, textarea, select")) return;
+        remove_selected_block();
+    });
 });
\ No newline at end of file
@@ -6,4 +6,10 @@ function get_tour_canvas(tour_id){
         false);
     req.send(null);
     return req.responseText;
-}
\ No newline at end of file
+}
+
+/**Асинхронно получить с сервера отрисованные блоки нескольких туров одним запросом.
+ * callback вызывается с объектом вида {<id>: <html>} */
+function get_tour_canvases(tour_ids, callback){
+    $.getJSON("/api/tour_canvases", {ids: tour_ids.join(",")}, callback);
+}
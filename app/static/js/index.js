@@ -1,7 +1,11 @@
 $(document).ready(function(){
     let containers = $(".for-canvas");
     containers = [].slice.call(containers);
-    containers.forEach(container => {
-        $(container).append(get_tour_canvas(container.id));
+    if (!containers.length) return;
+    let ids = containers.map(container => container.id);
+    get_tour_canvases(ids, function(canvases){
+        containers.forEach(container => {
+            if (canvases[container.id]) $(container).append(canvases[container.id]);
+        });
     });
-});
\ No newline at end of file
+});
@@ -1,9 +1,8 @@
 /**Отметить тур как модерированный*/
-function moderate(id, moder_id){
+function moderate(id){
     let req = new XMLHttpRequest();
-    req.open("GET",
-        "/api/moderate?tid="+id+"&mid=" + moder_id,
-        false);
-    req.send(null);
+    req.open("POST", "/api/moderate", false);
+    req.setRequestHeader("Content-Type", "application/json");
+    req.send(JSON.stringify({approve: [Number(id)]}));
     return req.responseText;
-}
\ No newline at end of file
+}
@@ -0,0 +1,156 @@
+##
+# @file
+#
+# @brief Файл хранилища загружаемых файлов.
+#
+# @section desctiption_storage Description
+# Файлы сохраняются в директорию UPLOAD_FOLDER под именем, составленным из хэша их содержимого, поэтому одинаковые
+# загрузки хранятся один раз. Файлы, на которые больше не ссылаются TourBlock.content_path и User.profile_photo_path,
+# удаляются периодической фоновой задачей sweep_orphans (см. jobs.py).
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from flask import current_app
+from sqlalchemy import func, union_all, select
+from werkzeug.utils import secure_filename
+
+from app import db
+from app.config import config
+from app.models import TourBlock, User
+from app.jobs import handler
+
+## Размер части файла, читаемой за один раз при сохранении
+CHUNK_SIZE = 1024 * 1024
+## Количество байт хэша в имени файла (32 символа в шестнадцатеричной записи, укладывается в String(50))
+DIGEST_SIZE = 16
+
+## Префикс временных файлов, в которые save_stream записывает загрузку до переименования
+TEMP_PREFIX = ".upload-"
+
+## Шаблон имени уменьшенной копии изображения: <исходное имя>.w<ширина>.webp
+VARIANT_NAME_PATTERN = re.compile(r"^(?P<source>.+)\.w(?P<width>\d+)\.webp$")
+
+
+## Шаблон имени файла, сохраненного save_file: <хэш>[.<расширение>], а также его уменьшенных копий
+CONTENT_ADDRESSED_PATTERN = re.compile(rf"^[0-9a-f]{{{DIGEST_SIZE * 2}}}(\.[a-z0-9]+)*$")
+
+
+def is_content_addressed(filename):
+    """! Проверить, что имя файла составлено из хэша содержимого, то есть содержимое файла никогда не меняется."""
+    return bool(CONTENT_ADDRESSED_PATTERN.match(filename))
+
+
+def variant_name(content_path, width):
+    """! Имя уменьшенной копии изображения заданной ширины."""
+    return f"{content_path}.w{width}.webp"
+
+
+def variant_source(filename):
+    """! Имя исходного файла для уменьшенной копии или None, если файл не является копией."""
+    match = VARIANT_NAME_PATTERN.match(filename)
+    return match.group("source") if match else None
+
+
+def storage_setting(key, default):
+    """! Получить числовой параметр секции STORAGE файла config.ini."""
+    if config.has_section("STORAGE"):
+        return int(config["STORAGE"].get(key, default))
+    return default
+
+
+def file_extension(filename):
+    """! Получить безопасное расширение имени загружаемого файла (без точки) или пустую строку."""
+    filename = secure_filename(filename or "")
+    if "." not in filename:
+        return ""
+    extension = filename.rsplit(".", 1)[-1].lower()
+    return extension if extension.isalnum() and len(extension) <= 8 else ""
+
+
+def save_file(file):
+    """! Сохранить файл формы, читая его частями и одновременно вычисляя хэш содержимого.
+    Если файл с таким содержимым уже есть, новая копия не создается.
+    @param file файл формы, в формате используемом Flask.
+
+    @return Имя файла в директории UPLOAD_FOLDER вида <хэш>.<расширение>
+    """
+    return save_stream(file.stream, file.filename)
+
+
+def save_stream(stream, filename):
+    """! Сохранить содержимое потока под именем из хэша содержимого (см. save_file).
+    @param stream Файловый объект, открытый для чтения в двоичном режиме.
+    @param filename Исходное имя файла, из которого берется расширение.
+
+    @return Имя файла в директории UPLOAD_FOLDER вида <хэш>.<расширение>
+    """
+    folder = current_app.config['UPLOAD_FOLDER']
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    descriptor, temp_path = tempfile.mkstemp(dir=folder, prefix=TEMP_PREFIX)
+    try:
+        with os.fdopen(descriptor, "wb") as temp_file:
+            while chunk := stream.read(CHUNK_SIZE):
+                digest.update(chunk)
+                temp_file.write(chunk)
+        extension = file_extension(filename)
+        filename = digest.hexdigest() + ("." + extension if extension else "")
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            # обновить время изменения, чтобы сборщик не удалил файл, на который вот-вот сошлются снова
+            os.utime(path)
+        else:
+            os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return filename
+
+
+def is_managed(filename):
+    """! Проверить, что файл создан хранилищем: сохраненный файл, его уменьшенная копия или временный файл загрузки.
+    Остальные файлы (например, загруженные до перехода на имена из хэша) сборщик не трогает."""
+    source = variant_source(filename)
+    return (is_content_addressed(filename) or (source is not None and is_content_addressed(source))
+            or filename.startswith(TEMP_PREFIX))
+
+
+def blob_refcounts():
+    """! Посчитать количество ссылок на каждый файл хранилища из TourBlock.content_path и User.profile_photo_path.
+
+    @returns словарь {<имя файла>: <количество ссылок>}
+    """
+    paths = union_all(
+        select(TourBlock.content_path.label("path")).where(TourBlock.content_path != None, TourBlock.content_path != ""),
+        select(User.profile_photo_path.label("path")).where(User.profile_photo_path != None),
+    ).subquery()
+    return dict(db.session.execute(select(paths.c.path, func.count()).group_by(paths.c.path)).all())
+
+
+@handler("sweep_orphans")
+def sweep_orphans(grace_seconds=None):
+    """! Удалить файлы хранилища, на которые нет ссылок. Файлы, измененные менее grace_seconds секунд назад, не
+    удаляются, так как на них могут сослаться транзакции, которые еще не завершены. Уменьшенные копии изображений
+    удаляются вместе с исходным файлом. Удаляются только файлы, созданные хранилищем (is_managed).
+    @param grace_seconds Минимальный возраст удаляемого файла в секундах.
+
+    @returns список удаленных имен файлов
+    """
+    if grace_seconds is None:
+        grace_seconds = storage_setting("orphan_grace", 3600)
+    folder = current_app.config['UPLOAD_FOLDER']
+    referenced = blob_refcounts()
+    deadline = time.time() - grace_seconds
+    removed = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if not entry.is_file() or not is_managed(entry.name) or entry.name in referenced \
+                    or variant_source(entry.name) in referenced:
+                continue
+            if entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+                removed.append(entry.name)
+    return removed
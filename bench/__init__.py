@@ -0,0 +1,7 @@
+##
+# @file
+#
+# @brief Пакет бенчмарков.
+#
+# @section description_bench Description
+# Скрипты запускаются из корня репозитория как модули, например: python -m bench.feed
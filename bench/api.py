@@ -0,0 +1,116 @@
+##
+# @file
+#
+# @brief Бенчмарк JSON API путеводителей (/api/v1/tours/<id>) в сравнении с формой редактора.
+#
+# @section description_bench_api Description
+# Для путеводителей с 10, 100 и 1000 блоками сравнивает разбор тела запроса сохранения (форма редактора
+# и logic.process_flask_form против JSON и api.parse_tour_patch), размеры тела запроса сохранения и ответов
+# (HTML блоков /api/get_tour_canvas против JSON, с gzip и без), а также время сохранения одного измененного блока
+# формой редактора, частичным изменением PUT /api/v1/tours/<id> и операцией автосохранения PATCH /api/v1/tours/<id>
+# (перемещение блока). Серия из 20 перемещений одного блока сравнивается с теми же перемещениями, объединенными
+# в один запрос, как их отправляет автосохранение редактора.
+# Запуск: python -m bench.api [количество блоков ...]
+
+import gzip
+import json
+import sys
+import urllib.parse
+
+from werkzeug.datastructures import MultiDict
+from werkzeug.security import generate_password_hash
+
+from bench.common import make_app, timed
+from bench.save import tour_form, new_block, saved_blocks
+
+
+def run(sizes):
+    app, db, _ = make_app()
+    results = []
+    with app.app_context():
+        from flask import request
+        from app.models import User, TourTag
+        from app.logic import process_tour, process_flask_form, block_form_values
+        from app.api import parse_tour_patch
+        user = User("bench", generate_password_hash("bench"))
+        db.session.add(user)
+        db.session.commit()
+        client = app.test_client()
+        client.post("/login", data={"login": "bench", "password": "bench"})
+        tag_ids = [tag.id for tag in db.session.query(TourTag).limit(2)]
+        for size in sizes:
+            tour_id = process_tour(tour_form([new_block(f"n{i}", i + 1) for i in range(size)], tag_ids),
+                                   "create", user, MultiDict())
+            blocks = saved_blocks(db, tour_id)
+            form = tour_form(blocks, tag_ids)
+            form_body = urllib.parse.urlencode(list(form.items(multi=True))).encode()
+            tour_json = client.get(f"/api/v1/tours/{tour_id}").data
+            payload = json.loads(tour_json)
+            # полное сохранение в JSON: все блоки, только изменяемые столбцы
+            del payload["blocks"]["content_variants"]
+            full_patch = json.dumps({"name": payload["name"], "tags": payload["tags"], "blocks": payload["blocks"]},
+                                    ensure_ascii=False, separators=(",", ":")).encode()
+
+            def parse_form():
+                with app.test_request_context(method="POST", data=form_body,
+                                              content_type="application/x-www-form-urlencoded"):
+                    parsed, _ = process_flask_form(request.form, ["show_on_map"])
+                    return [block_form_values(block, block.get("old_content_path", ""), tour_id)
+                            for block in parsed.values()]
+
+            def parse_json():
+                with app.test_request_context(method="PUT", data=full_patch, content_type="application/json"):
+                    return parse_tour_patch(request.get_json())
+
+            changed_form = form.copy()
+            one_block = {"blocks": {"id": [int(blocks[0]["key"])], "text": ["Новый текст"]}}
+
+            def save_form():
+                changed_form[f"{blocks[0]['key']}:text"] = f"Новый текст {len(results)}"
+                assert client.post(f"/tour/{tour_id}?edit_mode=1", data=changed_form).status_code < 400
+
+            def save_patch():
+                assert client.put(f"/api/v1/tours/{tour_id}", json=one_block).status_code == 200
+
+            def move_ops(count):
+                return [{"op": "move", "id": int(blocks[0]["key"]), "row": row % size + 1, "column": 1}
+                        for row in range(count)]
+
+            version = [None]
+
+            def save_ops(ops):
+                if version[0] is None:
+                    version[0] = client.get(f"/api/v1/tours/{tour_id}").json["version"]
+                response = client.patch(f"/api/v1/tours/{tour_id}", json={"version": version[0], "ops": ops})
+                assert response.status_code == 200
+                version[0] = response.json["version"]
+
+            def save_ops_separately(ops):
+                for op in ops:
+                    save_ops([op])
+
+            canvas = client.get(f"/api/get_tour_canvas/{tour_id}").data
+            results.append({
+                "blocks": size,
+                "parse_form_ms": round(timed(parse_form), 3),
+                "parse_json_ms": round(timed(parse_json), 3),
+                "form_body_bytes": len(form_body),
+                "json_body_bytes": len(full_patch),
+                "json_one_block_bytes": len(json.dumps(one_block, ensure_ascii=False).encode()),
+                "html_canvas_bytes": len(canvas),
+                "html_canvas_gzip_bytes": len(gzip.compress(canvas)),
+                "json_tour_bytes": len(tour_json),
+                "json_tour_gzip_bytes": len(client.get(f"/api/v1/tours/{tour_id}",
+                                                       headers={"Accept-Encoding": "gzip"}).data),
+                "save_form_ms": round(timed(save_form), 2),
+                "save_patch_ms": round(timed(save_patch), 2),
+                "save_move_op_ms": round(timed(lambda: save_ops(move_ops(1))), 2),
+                "moves_20_separate_ms": round(timed(lambda: save_ops_separately(move_ops(20)), repeat=3), 2),
+                "moves_20_coalesced_ms": round(timed(lambda: save_ops(move_ops(20))), 2),
+            })
+            print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000])
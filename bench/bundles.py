@@ -0,0 +1,89 @@
+##
+# @file
+#
+# @brief Бенчмарк экспорта и импорта архивов путеводителей.
+#
+# @section description_bench_bundles Description
+# Заполняет базу путеводителями с блоками, создает в хранилище MEDIA_FILES файлов, на которые ссылаются блоки,
+# и экспортирует все путеводители архивом tar.gz (см. bundles.py), затем импортирует его в пустую базу. Выводит размер
+# архива, время экспорта и импорта, пиковую память Python каждой операции и количество сохраненных файлов. Память
+# измеряется tracemalloc при повторном выполнении, так как трассировка замедляет выполнение в несколько раз; повторный
+# импорт того же архива заодно проверяет, что файлы не дублируются в хранилище.
+# Запуск: python -m bench.bundles [количество туров], по умолчанию 10000.
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+from bench.common import make_app
+from bench.generate import generate
+
+## Количество блоков на путеводитель
+BLOCKS_PER_TOUR = 10
+## Количество файлов в хранилище, на которые ссылаются блоки
+MEDIA_FILES = 200
+## Размер каждого файла
+MEDIA_SIZE = 64 * 1024
+
+
+def measure(func):
+    """! Выполнить функцию дважды: без трассировки, измеряя время, и с tracemalloc, измеряя пиковую память Python.
+
+    @returns результат первого выполнения, миллисекунды, мегабайты
+    """
+    started = time.perf_counter()
+    result = func()
+    elapsed = (time.perf_counter() - started) * 1000
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, round(elapsed, 2), round(peak / 2 ** 20, 2)
+
+
+def run(size):
+    app, db, workdir = make_app()
+    archive_path = os.path.join(workdir, "tours.tar.gz")
+    with app.app_context():
+        from app.models import Tour, TourBlock
+        from app.bundles import export_tours
+        generate(db, size, BLOCKS_PER_TOUR, 0, users=10, seed=size)
+        names = [row[0] for row in db.session.query(TourBlock.content_path).distinct()
+                 .filter(TourBlock.content_path != None).limit(MEDIA_FILES)]
+        for name in names:
+            with open(os.path.join(app.config["UPLOAD_FOLDER"], name), "wb") as file:
+                file.write(os.urandom(MEDIA_SIZE))
+        tour_ids = [row[0] for row in db.session.query(Tour.id)]
+
+        def export():
+            written = 0
+            with open(archive_path, "wb") as file:
+                for chunk in export_tours(tour_ids):
+                    file.write(chunk)
+                    written += len(chunk)
+            return written
+
+        written, export_ms, export_mb = measure(export)
+    results = {"tours": size, "blocks": size * BLOCKS_PER_TOUR, "media": len(names),
+               "archive_mb": round(written / 2 ** 20, 2), "export_ms": export_ms, "export_peak_mb": export_mb}
+
+    target, target_db, _ = make_app()
+    with target.app_context():
+        from app.bundles import import_archive
+        generate(target_db, 1, 0, 0, users=1, seed=1)
+
+        def load():
+            with open(archive_path, "rb") as file:
+                return import_archive(file, owner_id=1, moderator_id=1)
+
+        imported, import_ms, import_mb = measure(load)
+        results.update({"imported_tours": len(imported["tours"]), "import_ms": import_ms, "import_peak_mb": import_mb})
+        results["stored_files_after_two_imports"] = len(os.listdir(target.config["UPLOAD_FOLDER"]))
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,41 @@
+##
+# @file
+#
+# @brief Бенчмарк пакетного получения блоков путеводителей (/api/tour_canvases).
+#
+# @section description_bench_canvases Description
+# Проверяет, что количество SQL запросов не зависит от количества запрошенных путеводителей,
+# и сравнивает время ответа с последовательными запросами /api/get_tour_canvas/<id>.
+# Запуск: python -m bench.canvases
+
+import json
+
+from bench.common import make_app, seed_tours, count_queries, timed
+
+
+def run(batch_sizes=(1, 10, 50, 100), blocks_per_tour=10):
+    app, db, _ = make_app()
+    client = app.test_client()
+    results = []
+    with app.app_context():
+        seed_tours(db, max(batch_sizes), blocks_per_tour=blocks_per_tour)
+        from app.models import Tour
+        ids = [row[0] for row in db.session.query(Tour.id).order_by(Tour.id).all()]
+        query_counts = set()
+        for size in batch_sizes:
+            url = "/api/tour_canvases?ids=" + ",".join(map(str, ids[:size]))
+            with count_queries(db) as statements:
+                response = client.get(url)
+            assert response.status_code == 200 and len(response.json) == size
+            query_counts.add(len(statements))
+            single = lambda: [client.get(f"/api/get_tour_canvas/{id_}") for id_ in ids[:size]]
+            results.append({"tours": size, "queries": len(statements),
+                            "batch_ms": round(timed(lambda: client.get(url)), 2),
+                            "sequential_ms": round(timed(single), 2)})
+            print(json.dumps(results[-1]))
+        assert len(query_counts) == 1, f"query count depends on batch size: {sorted(query_counts)}"
+    return results
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,169 @@
+##
+# @file
+#
+# @brief Общие функции бенчмарков.
+#
+# @section description_bench_common Description
+# Создание одноразовой базы данных, быстрое заполнение ее синтетическими данными и подсчет SQL запросов.
+
+import contextlib
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import event, insert, text
+
+from app.config import PROJECT_ROOT, load_config
+
+## Скрипт запуска приложения, используемый бенчмарками сервера
+MAIN_SCRIPT = os.path.join(PROJECT_ROOT, "main.py")
+
+
+def make_app(workdir=None, **sections):
+    """! Создать приложение, настроенное на одноразовую базу данных во временной директории, создать схему БД
+    и заполнить начальные данные.
+    @param workdir Директория для базы данных и загружаемых файлов. Если не задана, создается временная.
+    @param sections Дополнительные секции/значения конфигурации вида SECTION={"key": "value"}.
+
+    @returns приложение, объект базы данных, рабочая директория
+    """
+    workdir = workdir or tempfile.mkdtemp(prefix="tourspoon_bench_")
+    config = load_config(os.path.join(PROJECT_ROOT, "config.ini"))
+    config["DATABASE"]["uri"] = "sqlite:///" + os.path.join(os.path.abspath(workdir), "bench.db")
+    upload_folder = os.path.join(workdir, "contents")
+    os.makedirs(upload_folder, exist_ok=True)
+    config["SITE"]["upload_folder"] = upload_folder
+    for section, values in sections.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for key, value in values.items():
+            config[section][key] = str(value)
+    ini_path = os.path.join(workdir, "config.ini")
+    with open(ini_path, "w") as file:
+        config.write(file)
+
+    from app import create_app, db
+    from app.migrations import upgrade
+    from app.logic import init_db
+    app = create_app(ini_path)
+    with app.app_context():
+        upgrade()
+        init_db()
+    return app, db, workdir
+
+
+def server_env(workdir):
+    """! Переменные окружения для процессов приложения (MAIN_SCRIPT), использующих конфигурацию make_app.
+    @param workdir Рабочая директория, возвращенная make_app.
+    """
+    return dict(os.environ, TOURSPOON_CONFIG=os.path.join(workdir, "config.ini"),
+                PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_ROOT, os.environ.get("PYTHONPATH")])))
+
+
+## Словарь для генерации названий и текстов
+VOCABULARY = ("музей собор парк набережная озеро гора водопад рынок кафе ресторан мост площадь крепость усадьба "
+              "театр галерея пляж лес тропа монастырь маяк порт вокзал сад фонтан башня дворец улица квартал "
+              "река остров пещера заповедник ферма винодельня сыроварня пекарня кофейня бар").split()
+
+
+def random_text(rnd, words):
+    """! Сгенерировать текст из words случайных слов словаря VOCABULARY."""
+    return " ".join(rnd.choices(VOCABULARY, k=words))
+
+
+def seed_tours(db, tours_count, users_count=None, blocks_per_tour=0, batch_size=50000, seed=0):
+    """! Заполнить базу путеводителями с помощью пакетных INSERT.
+    @param db Объект базы данных.
+    @param tours_count Количество путеводителей.
+    @param users_count Количество авторов, по умолчанию один на 10 путеводителей.
+    @param blocks_per_tour Количество текстовых блоков в каждом путеводителе.
+    @param batch_size Размер пакета вставки.
+    @param seed Зерно генератора случайных чисел.
+
+    @returns список идентификаторов категорий
+    """
+    from app.models import User, Tour, TourBlock, TourTag, tours_to_tags_association
+
+    rnd = random.Random(seed)
+    users_count = users_count or max(1, tours_count // 10)
+    now = datetime.datetime.now()
+    db.session.execute(insert(User), [
+        {"login": f"user{i}", "password_hash": "-", "is_moderator": False, "created_at": now}
+        for i in range(users_count)
+    ])
+    user_ids = [row[0] for row in db.session.query(User.id).all()]
+    tag_ids = [row[0] for row in db.session.query(TourTag.id).all()]
+
+    first_id = (db.session.query(db.func.max(Tour.id)).scalar() or 0) + 1
+    for start in range(0, tours_count, batch_size):
+        stop = min(start + batch_size, tours_count)
+        db.session.execute(insert(Tour), [
+            {"id": first_id + i, "name": f"{random_text(rnd, 2)} {i}", "canvas_height": 8, "canvas_width": 4,
+             "last_updated_at": now - datetime.timedelta(minutes=i), "archived": False,
+             "created_by_id": rnd.choice(user_ids), "moderated_by_id": user_ids[0]}
+            for i in range(start, stop)
+        ])
+        db.session.execute(insert(tours_to_tags_association), [
+            {"tour_id": first_id + i, "tag_id": tag_id}
+            for i in range(start, stop)
+            for tag_id in rnd.sample(tag_ids, rnd.randint(1, 2))
+        ])
+        if blocks_per_tour:
+            db.session.execute(insert(TourBlock), [
+                {"name": random_text(rnd, 2), "text": random_text(rnd, 12), "content_path": "", "type": 0,
+                 "show_on_map": False, "column": 1, "row": j + 1, "height": 1, "width": 4,
+                 "tour_id": first_id + i}
+                for i in range(start, stop)
+                for j in range(blocks_per_tour)
+            ])
+    rebuild_derived(db)
+    return tag_ids
+
+
+def rebuild_derived(db):
+    """! Пересчитать данные, производные от вставленных пакетами строк: сводные оценки путеводителей и пользователей
+    и индекс поиска."""
+    from app.logic import rebuild_ratings, rebuild_user_summaries
+    rebuild_ratings()
+    rebuild_user_summaries()
+    db.session.commit()
+    from app import search
+    with db.engine.begin() as connection:
+        if search.fts_enabled():
+            # индекс поиска перестраивается целиком: это быстрее, чем обновлять его для каждого пакета
+            connection.execute(text("DELETE FROM tour_search"))
+            connection.execute(text(search.index_rows_sql()))
+
+
+@contextlib.contextmanager
+def count_queries(db):
+    """! Контекстный менеджер, подсчитывающий SQL запросы, выполненные внутри него.
+
+    @returns список выполненных запросов (заполняется по ходу выполнения)
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engines = list(db.engines.values())
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def timed(func, repeat=5):
+    """! Выполнить функцию несколько раз и вернуть медианное время выполнения в миллисекундах."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2]
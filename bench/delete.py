@@ -0,0 +1,78 @@
+##
+# @file
+#
+# @brief Бенчмарк удаления пользователей вместе с их путеводителями.
+#
+# @section description_bench_delete Description
+# Заполняет две одинаковые базы пользователями, каждый из которых владеет TOURS_PER_USER путеводителями с блоками
+# и комментариями, и удаляет этих пользователей двумя способами: каскадным удалением через ORM
+# (db.session.delete(user), загружает и удаляет каждую строку отдельно) и logic.delete_users (наборные запросы
+# DELETE частями). Выводит время и количество SQL запросов.
+# Запуск: python -m bench.delete [пользователей] [блоков на путеводитель]
+
+import json
+import sys
+import time
+
+from sqlalchemy import update
+
+from bench.common import make_app, count_queries
+from bench.generate import generate
+
+## Количество путеводителей каждого удаляемого пользователя
+TOURS_PER_USER = 1000
+
+
+def fill(db, users, blocks):
+    """! Заполнить базу: первый пользователь - модератор, остальные users пользователей владеют путеводителями.
+
+    @returns идентификаторы удаляемых пользователей
+    """
+    from app.models import Tour
+    generate(db, users * TOURS_PER_USER, blocks, 2, users=users + 1, seed=users)
+    first_user = db.session.query(db.func.min(Tour.created_by_id)).scalar()
+    owner_ids = [first_user + 1 + index for index in range(users)]
+    db.session.execute(update(Tour).values(created_by_id=first_user + 1 + Tour.id % users))
+    db.session.commit()
+    return owner_ids
+
+
+def measure(func):
+    """! Выполнить функцию и вернуть время в миллисекундах и количество SQL запросов."""
+    from app import db
+    with count_queries(db) as statements:
+        started = time.perf_counter()
+        func()
+        elapsed = (time.perf_counter() - started) * 1000
+    return round(elapsed, 2), len(statements)
+
+
+def run(users=2, blocks=10):
+    results = {"users": users, "tours": users * TOURS_PER_USER, "blocks_per_tour": blocks}
+
+    app, db, _ = make_app()
+    with app.app_context():
+        from app.models import User, Tour
+        owner_ids = fill(db, users, blocks)
+
+        def delete_orm():
+            for user_id in owner_ids:
+                db.session.delete(db.session.get(User, user_id))
+            db.session.commit()
+
+        results["orm_ms"], results["orm_queries"] = measure(delete_orm)
+        results["orm_tours_left"] = db.session.query(Tour).count()
+
+    app, db, _ = make_app()
+    with app.app_context():
+        from app.models import Tour
+        from app.logic import delete_users
+        owner_ids = fill(db, users, blocks)
+        results["bulk_ms"], results["bulk_queries"] = measure(lambda: delete_users(owner_ids))
+        results["bulk_tours_left"] = db.session.query(Tour).count()
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,153 @@
+##
+# @file
+#
+# @brief Проверка планов SQL запросов эндпоинтов.
+#
+# @section description_bench_explain Description
+# Заполняет базу синтетическими данными, выполняет запросы к основным эндпоинтам и для каждого выполненного SELECT
+# получает план (EXPLAIN QUERY PLAN). Запрос считается плохим, если он полностью просматривает таблицу, которая
+# растет вместе с данными. Выводит планы плохих запросов и завершается с ошибкой, если такие есть.
+# Запуск: python -m bench.explain [количество туров], по умолчанию 20000.
+
+import contextlib
+import json
+import re
+import sys
+
+from sqlalchemy import event
+
+from bench.common import make_app, seed_tours
+
+## Таблицы, полный просмотр которых допустим: справочники фиксированного размера
+SMALL_TABLES = {"tour_tags"}
+## Строка плана с полным просмотром таблицы (без индекса)
+FULL_SCAN_PATTERN = re.compile(r"^SCAN (\w+)$")
+
+
+@contextlib.contextmanager
+def capture_selects(engines):
+    """! Контекстный менеджер, собирающий SELECT запросы вместе с параметрами.
+
+    @returns список (запрос, параметры), заполняется по ходу выполнения
+    """
+    captured = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and not executemany:
+            captured.append((statement, parameters))
+
+    for engine in engines:
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield captured
+    finally:
+        for engine in engines:
+            event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+def full_scans(connection, statement, parameters):
+    """! Таблицы, которые запрос просматривает полностью, и его план.
+
+    @returns (список таблиц, строки плана)
+    """
+    plan = [row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+    tables = [match.group(1) for match in map(FULL_SCAN_PATTERN.match, plan)
+              if match and match.group(1) not in SMALL_TABLES]
+    return tables, plan
+
+
+def prepare(db, tours):
+    """! Заполнить базу: путеводители с блоками, пользователь-модератор с собственными путеводителями,
+    точки на карте и комментарии."""
+    from sqlalchemy import insert, update
+    from app.models import Tour, TourBlock, TourReaction, TOUR_BLOCK_MAP_POINT_TYPE
+    from app.logic import rebuild_ratings
+    from app.migrations import fill_moderation_queue
+
+    tag_ids = seed_tours(db, tours, blocks_per_tour=3)
+    db.session.execute(insert(TourBlock), [
+        {"name": "Точка", "text": "", "content_path": "", "type": TOUR_BLOCK_MAP_POINT_TYPE, "show_on_map": True,
+         "latitude": 50 + tour_id % 100 / 10, "longitude": 10 + tour_id % 70 / 10, "column": 1, "row": 4,
+         "height": 1, "width": 1, "tour_id": tour_id}
+        for tour_id in range(1, tours + 1)
+    ])
+    db.session.execute(insert(TourReaction), [
+        {"text": "Комментарий", "beauty_criteria": 5, "route_smoothness_criteria": 5, "attractions_criteria": 5,
+         "accessibility_criteria": 5, "overall_criteria": 5, "created_by_id": 1 + i % 100, "tour_id": 1 + i % 50}
+        for i in range(tours)
+    ])
+    rebuild_ratings()
+    db.session.execute(update(Tour).where(Tour.id % 7 == 0).values(moderated_by_id=None))
+    db.session.commit()
+    fill_moderation_queue()
+    return tag_ids
+
+
+def run(tours=20000):
+    app, db, _ = make_app()
+    client = app.test_client()
+    with app.app_context():
+        tag_ids = prepare(db, tours)
+        from app.models import User, Tour
+        from app.cache import invalidate_user
+        client.post("/reg", data={"login": "explain", "password": "explain", "repass": "explain"})
+        user = db.session.query(User).filter(User.login == "explain").one()
+        user.is_moderator = True
+        db.session.query(Tour).filter(Tour.id <= 30).update({"created_by_id": user.id})
+        db.session.commit()
+        user_id = user.id
+        invalidate_user(user_id)
+        first, second = db.session.query(Tour.id).order_by(Tour.id).limit(2).all()
+
+    cursor_page = client.get("/").get_data(as_text=True)
+    cursor = re.search(r"after=([^\"&]+)", cursor_page).group(1)
+    cases = [
+        ("GET", "/", None),
+        ("GET", f"/?after={cursor}", None),
+        ("GET", "/?sort=top", None),
+        ("GET", f"/?c={tag_ids[0]}", None),
+        ("GET", f"/?u={user_id}", None),
+        ("GET", f"/?u={user_id + 1}", None),
+        ("GET", "/?nm=true", None),
+        ("GET", "/moderation", None),
+        ("GET", "/api/v1/moderation", None),
+        ("GET", "/api/v1/moderation?cursor=2000-01-01T00:00:00_1", None),
+        ("POST", "/api/moderate", {f"decision-{tours // 7 * 7}": "approve", f"decision-{tours // 7 * 7 - 7}": "reject"}),
+        ("GET", "/?s=музей", None),
+        ("GET", f"/tour/{first[0]}", None),
+        ("GET", f"/tour/{first[0]}?rb=1000", None),
+        ("POST", f"/tour/{second[0]}", {"text": "Проверка", "beauty_criteria": 5, "route_smoothness_criteria": 5,
+                                        "attractions_criteria": 5, "accessibility_criteria": 5}),
+        ("GET", f"/tour/{first[0]}?edit_mode=1", None),
+        ("GET", f"/api/get_tour_canvas/{first[0]}", None),
+        ("GET", f"/api/tour_canvases?ids={first[0]},{second[0]}", None),
+        ("GET", "/api/tours/near?lat=52&lon=12&r=20", None),
+        ("GET", "/api/tours/in_bbox?min_lat=50&min_lon=10&max_lat=51&max_lon=11", None),
+        ("POST", "/cab", {"login": "user1", "bio": "", "password": ""}),
+        ("GET", "/cab", None),
+        ("POST", "/reg", {"login": "explain", "password": "x", "repass": "x"}),
+        ("POST", "/login", {"login": "explain", "password": "explain"}),
+    ]
+    failures = 0
+    with app.app_context():
+        connection = db.engine.connect()
+        for method, url, data in cases:
+            with capture_selects(db.engines.values()) as captured:
+                response = client.open(url, method=method, data=data)
+            bad = []
+            for statement, parameters in captured:
+                tables, plan = full_scans(connection, statement, parameters)
+                if tables:
+                    bad.append({"tables": tables, "statement": " ".join(statement.split()), "plan": plan})
+            failures += len(bad)
+            print(json.dumps({"request": f"{method} {url}", "status": response.status_code,
+                              "selects": len(captured), "full_scans": len(bad)}, ensure_ascii=False))
+            for item in bad:
+                print(json.dumps(item, ensure_ascii=False, indent=2))
+        connection.close()
+    if failures:
+        sys.exit(f"{failures} queries scan whole tables")
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,43 @@
+##
+# @file
+#
+# @brief Бенчмарк ленты путеводителей (index_page).
+#
+# @section description_bench_feed Description
+# Для каждого размера базы измеряет количество SQL запросов и время ответа первой страницы ленты,
+# страницы далеко от начала (по курсору) и ленты, отфильтрованной по категории.
+# Запуск: python -m bench.feed [количество туров ...], по умолчанию 10000 100000 1000000.
+
+import json
+import sys
+
+from bench.common import make_app, seed_tours, count_queries, timed
+
+
+def run(sizes):
+    app, db, _ = make_app()
+    client = app.test_client()
+    results = []
+    seeded = 0
+    with app.app_context():
+        for size in sizes:
+            tag_ids = seed_tours(db, size - seeded, seed=size)
+            seeded = size
+            from app.models import Tour
+            from app.logic import encode_feed_cursor
+            middle = db.session.query(Tour).order_by(Tour.last_updated_at.desc(), Tour.id.desc())\
+                .offset(size // 2).first()
+            cursor = encode_feed_cursor(middle)
+            for name, url in [("first_page", "/"),
+                              ("deep_page", f"/?after={cursor}"),
+                              ("category", f"/?c={tag_ids[0]}")]:
+                with count_queries(db) as statements:
+                    assert client.get(url).status_code == 200
+                results.append({"tours": size, "case": name, "queries": len(statements),
+                                "latency_ms": round(timed(lambda: client.get(url)), 2)})
+                print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000])
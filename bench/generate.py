@@ -0,0 +1,176 @@
+##
+# @file
+#
+# @brief Генератор синтетических данных.
+#
+# @section description_bench_generate Description
+# Заполняет одноразовую базу пользователями, путеводителями с блоками всех семи типов (точки и отмеченные на карте
+# блоки - с координатами), категориями путеводителей и комментариями. Строки вставляются пакетами напрямую через
+# курсор DBAPI (ORM вставляет строки без id по одной), индексы на время вставки удаляются, поэтому миллион блоков
+# вставляется за секунды. Пароль всех пользователей - PASSWORD, первый пользователь - модератор, все путеводители
+# отмечены им как модерированные.
+# Запуск: python -m bench.generate [путеводителей] [блоков на путеводитель] [комментариев на путеводитель]
+
+import contextlib
+import datetime
+import json
+import random
+import sys
+import time
+
+from werkzeug.security import generate_password_hash
+
+from app import models, geo
+from app.models import User, Tour, TourBlock, TourTag, TourReaction, tours_to_tags_association, \
+    users_to_tags_association
+from bench.common import make_app, random_text, rebuild_derived
+
+## Пароль всех сгенерированных пользователей
+PASSWORD = "bench"
+## Ширина сетки путеводителя, каждый блок занимает строку целиком
+GRID_COLUMNS = 4
+## Количество заранее сгенерированных текстов каждого вида, из которых выбираются значения полей
+TEXT_POOL_SIZE = 1000
+
+
+def insert_rows(db, table, columns, rows):
+    """! Вставить строки пакетом через курсор DBAPI, минуя построение параметров SQLAlchemy для каждой строки.
+    @param table Таблица SQLAlchemy.
+    @param columns Имена столбцов.
+    @param rows Список кортежей значений в порядке columns.
+    """
+    if rows:
+        placeholders = ", ".join("?" for _ in columns)
+        db.session.connection().exec_driver_sql(
+            f"INSERT INTO {table.name} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+
+
+## Расширения файлов блоков с медиа по типу блока
+MEDIA_EXTENSIONS = {models.TOUR_BLOCK_IMAGE_TYPE: "jpg", models.TOUR_BLOCK_VIDEO_TYPE: "mp4",
+                    models.TOUR_BLOCK_SOUND_TYPE: "mp3"}
+## Столбцы блоков, вставляемых generate
+BLOCK_COLUMNS = ("name", "text", "content_path", "type", "show_on_map", "latitude", "longitude",
+                 "column", "row", "height", "width", "tour_id")
+## Возможные оценки по критерию
+CRITERIA_VALUES = range(1, 11)
+## Столбцы комментариев, вставляемых generate
+REACTION_COLUMNS = ("text", "beauty_criteria", "route_smoothness_criteria", "attractions_criteria",
+                    "accessibility_criteria", "overall_criteria", "created_by_id", "tour_id")
+
+
+@contextlib.contextmanager
+def bulk_load(db, tables):
+    """! Контекстный менеджер массовой вставки: на время вставки удаляет вторичные индексы таблиц и индекс точек
+    на карте, после вставки создает их заново (построить индекс по готовой таблице быстрее, чем обновлять его
+    для каждой строки).
+    @param tables Имена таблиц, индексы которых удаляются.
+    """
+    if db.engine.dialect.name != "sqlite":
+        yield
+        return
+    connection = db.session.connection()
+    indexes = connection.exec_driver_sql(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({})"
+        .format(", ".join("?" for _ in tables)), tuple(tables)).all()
+    for name, _ in indexes:
+        connection.exec_driver_sql(f"DROP INDEX {name}")
+    db.session.commit()
+    geo.drop_geo_index()
+    try:
+        yield
+    finally:
+        db.session.commit()
+        connection = db.session.connection()
+        for _, sql in indexes:
+            connection.exec_driver_sql(sql)
+        db.session.commit()
+        geo.create_geo_index()
+
+
+def block_row(rnd, texts, block_type, tour_id, row):
+    """! Сгенерировать значения столбцов BLOCK_COLUMNS для блока заданного типа в строке row сетки путеводителя."""
+    text = content_path = latitude = longitude = None
+    if block_type in (models.TOUR_BLOCK_TEXT_TYPE, models.TOUR_BLOCK_MAP_POINT_TYPE):
+        text = texts["long"][int(rnd.random() * TEXT_POOL_SIZE)]
+    elif block_type == models.TOUR_BLOCK_LINK_TYPE:
+        text = f"https://example.com/{rnd.getrandbits(20)}"
+    elif block_type in MEDIA_EXTENSIONS:
+        content_path = f"{rnd.getrandbits(128):032x}.{MEDIA_EXTENSIONS[block_type]}"
+    show_on_map = block_type == models.TOUR_BLOCK_MAP_POINT_TYPE or rnd.random() < 0.05
+    if show_on_map:
+        latitude, longitude = rnd.uniform(35, 70), rnd.uniform(-10, 40)
+    return (texts["short"][int(rnd.random() * TEXT_POOL_SIZE)], text, content_path, block_type, show_on_map, latitude, longitude,
+            1, row, 1, GRID_COLUMNS, tour_id)
+
+
+def generate(db, tours=10000, blocks_per_tour=10, reactions_per_tour=5, users=None, batch_size=100000, seed=0):
+    """! Заполнить базу синтетическими данными.
+    @param db Объект базы данных (вызывается в контексте приложения).
+    @param tours Количество путеводителей.
+    @param blocks_per_tour Количество блоков в каждом путеводителе, типы блоков чередуются.
+    @param reactions_per_tour Среднее количество комментариев к путеводителю.
+    @param users Количество пользователей, по умолчанию один на 10 путеводителей.
+    @param batch_size Размер пакета вставки.
+    @param seed Зерно генератора случайных чисел.
+
+    @returns словарь с количеством вставленных строк и временем заполнения в секундах
+    """
+    started = time.perf_counter()
+    rnd = random.Random(seed)
+    texts = {kind: [random_text(rnd, words) for _ in range(TEXT_POOL_SIZE)]
+             for kind, words in (("short", 2), ("medium", 8), ("long", 12))}
+    users = users or max(1, tours // 10)
+    now = datetime.datetime.now()
+    password_hash = generate_password_hash(PASSWORD)
+    first_user = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+    user_ids = list(range(first_user, first_user + users))
+    insert_rows(db, User.__table__, ("id", "login", "password_hash", "is_moderator", "created_at", "bio"), [
+        (user_id, f"user{user_id}", password_hash, user_id == first_user, now, rnd.choice(texts["medium"]))
+        for user_id in user_ids
+    ])
+    tag_ids = [row[0] for row in db.session.query(TourTag.id)]
+    insert_rows(db, users_to_tags_association, ("user_id", "tag_id"), [
+        (user_id, tag_id) for user_id in user_ids for tag_id in rnd.sample(tag_ids, 2)
+    ])
+
+    first_tour = (db.session.query(db.func.max(Tour.id)).scalar() or 0) + 1
+    counts = {"users": users, "tours": 0, "blocks": 0, "reactions": 0}
+    tours_per_batch = max(1, batch_size // max(1, blocks_per_tour, reactions_per_tour))
+    with bulk_load(db, ["tours", "tour_blocks", "tour_reactions", "tours_to_tags_association"]):
+        for start in range(first_tour, first_tour + tours, tours_per_batch):
+            tour_ids = range(start, min(start + tours_per_batch, first_tour + tours))
+            insert_rows(db, Tour.__table__, ("id", "name", "canvas_height", "canvas_width", "last_updated_at",
+                                             "archived", "created_by_id", "moderated_by_id"), [
+                (tour_id, f"{rnd.choice(texts['short'])} {tour_id}", max(8, blocks_per_tour), GRID_COLUMNS,
+                 now - datetime.timedelta(minutes=tour_id), False, rnd.choice(user_ids), first_user)
+                for tour_id in tour_ids
+            ])
+            insert_rows(db, tours_to_tags_association, ("tour_id", "tag_id"), [
+                (tour_id, tag_id) for tour_id in tour_ids for tag_id in rnd.sample(tag_ids, rnd.randint(1, 2))
+            ])
+            blocks = [block_row(rnd, texts, (tour_id + j) % 7, tour_id, j + 1)
+                      for tour_id in tour_ids for j in range(blocks_per_tour)]
+            insert_rows(db, TourBlock.__table__, BLOCK_COLUMNS, blocks)
+            reactions = []
+            for tour_id in tour_ids:
+                for _ in range(int(rnd.random() * (2 * reactions_per_tour + 1))):
+                    criteria = rnd.choices(CRITERIA_VALUES, k=4)
+                    reactions.append((texts["medium"][int(rnd.random() * TEXT_POOL_SIZE)], *criteria,
+                                      sum(criteria) // 4, user_ids[int(rnd.random() * users)], tour_id))
+            insert_rows(db, TourReaction.__table__, REACTION_COLUMNS, reactions)
+            counts["tours"] += len(tour_ids)
+            counts["blocks"] += len(blocks)
+            counts["reactions"] += len(reactions)
+    inserted = time.perf_counter()
+    rebuild_derived(db)
+    counts["insert_s"] = round(inserted - started, 2)
+    counts["derived_s"] = round(time.perf_counter() - inserted, 2)
+    return counts
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    app, db, workdir = make_app()
+    with app.app_context():
+        result = generate(db, *args)
+    print(json.dumps(dict(result, database=app.config["SQLALCHEMY_DATABASE_URI"])))
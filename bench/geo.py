@@ -0,0 +1,67 @@
+##
+# @file
+#
+# @brief Бенчмарк поиска путеводителей по карте.
+#
+# @section description_bench_geo Description
+# Заполняет базу точками маршрутов (по умолчанию миллион точек в 100000 путеводителях, равномерно по Европе)
+# и сравнивает запросы /api/tours/in_bbox и /api/tours/near с полным перебором блоков по широте/долготе.
+# Запуск: python -m bench.geo [количество точек] [точек на путеводитель]
+
+import json
+import random
+import sys
+
+from sqlalchemy import insert
+
+from bench.common import make_app, seed_tours, count_queries, timed
+
+
+def run(points=1000000, points_per_tour=10, batch_size=100000):
+    app, db, _ = make_app()
+    client = app.test_client()
+    rnd = random.Random(0)
+    results = []
+    with app.app_context():
+        from app.models import Tour, TourBlock, TOUR_BLOCK_MAP_POINT_TYPE
+        seed_tours(db, points // points_per_tour)
+        tour_ids = [row[0] for row in db.session.query(Tour.id)]
+        rows = ({"name": "Точка", "text": "", "content_path": "", "type": TOUR_BLOCK_MAP_POINT_TYPE,
+                 "show_on_map": True, "latitude": rnd.uniform(35, 70), "longitude": rnd.uniform(-10, 40),
+                 "column": 1, "row": j + 1, "height": 1, "width": 1, "tour_id": tour_id}
+                for tour_id in tour_ids for j in range(points_per_tour))
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == batch_size:
+                db.session.execute(insert(TourBlock), batch)
+                batch = []
+        if batch:
+            db.session.execute(insert(TourBlock), batch)
+        db.session.commit()
+
+        cases = {
+            "in_bbox": "/api/tours/in_bbox?min_lat=55.5&min_lon=37.3&max_lat=55.9&max_lon=37.9",
+            "near_5km": "/api/tours/near?lat=55.75&lon=37.6&r=5",
+            "near_50km": "/api/tours/near?lat=55.75&lon=37.6&r=50",
+        }
+        for name, url in cases.items():
+            with count_queries(db) as statements:
+                response = client.get(url)
+            assert response.status_code == 200
+            results.append({"points": points, "case": name, "queries": len(statements),
+                            "tours": len(response.json["tours"]),
+                            "latency_ms": round(timed(lambda: client.get(url)), 2)})
+            print(json.dumps(results[-1]))
+
+        def full_scan():
+            return db.session.query(TourBlock.tour_id, TourBlock.id)\
+                .filter(TourBlock.show_on_map == True,
+                        TourBlock.latitude.between(55.5, 55.9), TourBlock.longitude.between(37.3, 37.9)).all()
+        results.append({"points": points, "case": "full_scan_bbox", "latency_ms": round(timed(full_scan), 2)})
+        print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,64 @@
+##
+# @file
+#
+# @brief Бенчмарк удаления путеводителей через очередь фоновых задач.
+#
+# @section description_bench_jobs Description
+# Для путеводителей с 10, 100, 1000 и 5000 блоками (и комментариями, по одному на 10 блоков) сравнивает удаление
+# в обработке запроса (logic.delete_tour, как раньше делал /api/delete) с запросом /api/delete, который только
+# скрывает путеводитель и ставит задачу в очередь, а также измеряет время выполнения самой задачи.
+# Время запроса не должно зависеть от размера путеводителя.
+# Запуск: python -m bench.jobs [количество блоков ...]
+
+import json
+import sys
+import time
+
+from sqlalchemy import update
+
+from bench.common import make_app, timed
+from bench.generate import generate, PASSWORD
+
+## Количество путеводителей каждого размера: половина удаляется в запросе, половина - задачами
+TOURS_PER_SIZE = 10
+
+
+def run(sizes):
+    results = []
+    for size in sizes:
+        app, db, _ = make_app()
+        with app.app_context():
+            from app.models import Tour, User
+            from app.logic import delete_tour, rebuild_user_summaries
+            from app import jobs
+            generate(db, TOURS_PER_SIZE, size, max(1, size // 10), users=2, seed=size)
+            tour_ids = [row[0] for row in db.session.query(Tour.id).order_by(Tour.id)]
+            user_id, login = db.session.query(User.id, User.login).order_by(User.id).first()
+            # удалить путеводитель может только автор
+            db.session.execute(update(Tour).values(created_by_id=user_id))
+            rebuild_user_summaries()
+            db.session.commit()
+            inline_ids, queued_ids = tour_ids[::2], tour_ids[1::2]
+
+            def delete_inline():
+                delete_tour(inline_ids.pop())
+
+            inline_ms = timed(delete_inline, repeat=len(inline_ids))
+        client = app.test_client()
+        client.post("/login", data={"login": login, "password": PASSWORD})
+        request_ms = timed(lambda: client.get(f"/api/delete?t=tour&id={queued_ids.pop()}"), repeat=len(queued_ids))
+        with app.app_context():
+            started = time.perf_counter()
+            executed = 0
+            while jobs.run_next(app.logger):
+                executed += 1
+            job_ms = (time.perf_counter() - started) * 1000 / max(1, executed)
+            remaining = db.session.query(Tour).count()
+        results.append({"blocks": size, "inline_delete_ms": round(inline_ms, 2), "request_ms": round(request_ms, 2),
+                        "job_ms": round(job_ms, 2), "jobs": executed, "tours_left": remaining})
+        print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000, 5000])
@@ -0,0 +1,118 @@
+##
+# @file
+#
+# @brief Нагрузочный тест приложения в режиме эксплуатации (main.py --prod).
+#
+# @section description_bench_load Description
+# Для каждого количества процессов-обработчиков запускает сервер gunicorn на одноразовой базе данных и нагружает его
+# смешанными запросами: чтение ленты, страниц и блоков путеводителей и добавление комментариев.
+# Выводит количество запросов в секунду, p50/p99 задержки и количество ошибок.
+# Запуск: python -m bench.load [количество процессов ...], по умолчанию 1 4 8.
+
+import http.cookiejar
+import json
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from bench.common import make_app, server_env, MAIN_SCRIPT, seed_tours
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server did not start on port {port}")
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def client(base_url, tour_ids, deadline, write_ratio, seed, samples):
+    """! Один клиент: регистрируется и до deadline выполняет случайные запросы, записывая (вид, задержка, ошибка)."""
+    rnd = random.Random(seed)
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    login = f"load{seed}_{time.time_ns()}"
+    opener.open(base_url + "/reg", urllib.parse.urlencode(
+        {"login": login, "password": "password", "repass": "password"}).encode()).read()
+    while time.time() < deadline:
+        tour_id = rnd.choice(tour_ids)
+        if rnd.random() < write_ratio:
+            kind = "write"
+            criteria = {name: rnd.randint(1, 10) for name in
+                        ("beauty_criteria", "route_smoothness_criteria", "attractions_criteria", "accessibility_criteria")}
+            request = urllib.request.Request(base_url + f"/tour/{tour_id}",
+                                             urllib.parse.urlencode(dict(criteria, text="Нагрузка")).encode())
+        else:
+            kind = "read"
+            request = base_url + rnd.choice(["/", f"/tour/{tour_id}", f"/api/get_tour_canvas/{tour_id}"])
+        started = time.perf_counter()
+        error = False
+        try:
+            opener.open(request, timeout=30).read()
+        except (urllib.error.URLError, OSError):
+            error = True
+        samples.append((kind, (time.perf_counter() - started) * 1000, error))
+
+
+def run(worker_counts, clients=32, duration=15, write_ratio=0.2, tours=5000):
+    results = []
+    app, db, workdir = make_app()
+    with app.app_context():
+        seed_tours(db, tours, blocks_per_tour=5)
+        tour_ids = list(range(1, tours + 1))
+        db.engine.dispose()
+    for workers in worker_counts:
+        port = free_port()
+        server = subprocess.Popen([sys.executable, MAIN_SCRIPT, "--prod", "--workers", str(workers),
+                                   "--bind", f"127.0.0.1:{port}"],
+                                  env=server_env(workdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            samples = []
+            deadline = time.time() + duration
+            threads = [threading.Thread(target=client, args=(f"http://127.0.0.1:{port}", tour_ids, deadline,
+                                                             write_ratio, seed, samples))
+                       for seed in range(clients)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+        for kind in ("read", "write", "all"):
+            latencies = [sample[1] for sample in samples if kind in ("all", sample[0])]
+            results.append({
+                "workers": workers, "kind": kind, "requests": len(latencies),
+                "rps": round(len(latencies) / duration, 1),
+                "p50_ms": round(percentile(latencies, 0.5) or 0, 2),
+                "p99_ms": round(percentile(latencies, 0.99) or 0, 2),
+                "errors": sum(1 for sample in samples if sample[2] and kind in ("all", sample[0])),
+            })
+            print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or [1, 4, 8])
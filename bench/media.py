@@ -0,0 +1,94 @@
+##
+# @file
+#
+# @brief Проверка и бенчмарк отдачи медиафайлов (/media/<filename>).
+#
+# @section description_bench_media Description
+# Запускает локальный многопоточный сервер, проверяет корректность ответов на запросы диапазонов байт и условные
+# запросы, затем измеряет пропускную способность при одновременном чтении диапазонов несколькими клиентами.
+# Запуск: python -m bench.media [размер файла в МБ] [количество клиентов]
+
+import http.client
+import io
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.serving import make_server
+
+from bench.common import make_app
+
+
+def fetch(port, path, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    connection.request("GET", path, headers=headers or {})
+    response = connection.getresponse()
+    body = response.read()
+    connection.close()
+    return response, body
+
+
+def check_responses(port, path, data):
+    """! Проверить частичные, полные и условные ответы, завершается AssertionError при ошибке."""
+    response, body = fetch(port, path, {"Range": "bytes=100-199"})
+    assert response.status == 206 and body == data[100:200], response.status
+    assert response.getheader("Content-Range") == f"bytes 100-199/{len(data)}"
+    response, body = fetch(port, path, {"Range": "bytes=-50"})
+    assert response.status == 206 and body == data[-50:]
+    response, body = fetch(port, path, {"Range": f"bytes={len(data)}-"})
+    assert response.status == 416
+    response, body = fetch(port, path)
+    assert response.status == 200 and body == data
+    assert "immutable" in response.getheader("Cache-Control")
+    response, _ = fetch(port, path, {"If-None-Match": response.getheader("ETag")})
+    assert response.status == 304
+
+
+def run(size_mb=32, readers=8, requests_per_reader=50, range_size=256 * 1024):
+    app, db, _ = make_app()
+    data = random.Random(0).randbytes(size_mb * 1024 * 1024)
+    with app.app_context():
+        from app.storage import save_file
+        filename = save_file(FileStorage(io.BytesIO(data), filename="video.mp4"))
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    port = server.server_port
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    path = f"/media/{filename}"
+    try:
+        check_responses(port, path, data)
+        errors = []
+
+        def reader(seed):
+            rnd = random.Random(seed)
+            for _ in range(requests_per_reader):
+                start = rnd.randrange(0, len(data) - range_size)
+                response, body = fetch(port, path, {"Range": f"bytes={start}-{start + range_size - 1}"})
+                if response.status != 206 or body != data[start:start + range_size]:
+                    errors.append(start)
+
+        threads = [threading.Thread(target=reader, args=(seed,)) for seed in range(readers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        assert not errors, f"{len(errors)} incorrect partial responses"
+        transferred = readers * requests_per_reader * range_size
+        result = {"file_mb": size_mb, "readers": readers, "requests": readers * requests_per_reader,
+                  "throughput_mb_s": round(transferred / elapsed / 1024 / 1024, 2),
+                  "requests_per_s": round(readers * requests_per_reader / elapsed, 2)}
+        print(json.dumps(result))
+        return result
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:]]
+    run(*args)
@@ -0,0 +1,108 @@
+##
+# @file
+#
+# @brief Бенчмарк очереди модерации.
+#
+# @section description_bench_moderation Description
+# Заполняет базу путеводителями, часть которых (PENDING_SHARE) не проверена модератором, и измеряет:
+# время страницы модерации (/moderation) и прежнего списка не проверенных путеводителей (/?nm=true), время одобрения
+# DECISIONS (не больше четверти очереди) путеводителей по одному (GET /api/moderate?tid=) и одним запросом
+# POST /api/moderate, а также разбор оставшейся очереди MODERATORS модераторами в параллельных потоках (claim, затем
+# решения по взятым путеводителям): сколько решений пропущено из-за того, что путеводитель уже проверил другой
+# модератор.
+# Запуск: python -m bench.moderation [количество туров], по умолчанию 200000.
+
+import json
+import sys
+import threading
+import time
+
+from sqlalchemy import update
+
+from bench.common import make_app, timed
+from bench.generate import generate, PASSWORD
+
+## Доля не проверенных путеводителей
+PENDING_SHARE = 20
+## Количество решений при сравнении одобрения по одному и одним запросом
+DECISIONS = 200
+## Количество модераторов, разбирающих очередь одновременно
+MODERATORS = 4
+## Количество путеводителей, разбираемых модераторами одновременно
+PARALLEL_TOURS = 2000
+
+
+def login(app, login_name):
+    client = app.test_client()
+    client.post("/login", data={"login": login_name, "password": PASSWORD})
+    return client
+
+
+def work_queue(app, login_name, stats, lock):
+    """! Разбирать очередь, пока в ней есть доступные путеводители: взять claim_size путеводителей и одобрить их."""
+    client = login(app, login_name)
+    while True:
+        tour_ids = client.post("/api/v1/moderation/claim", json={}).get_json()["tours"]
+        if not tour_ids:
+            return
+        result = client.post("/api/moderate", json={"approve": tour_ids}).get_json()
+        with lock:
+            stats["approved"] += len(result["approved"])
+            stats["skipped"] += len(result["skipped"])
+
+
+def run(size):
+    app, db, _ = make_app()
+    with app.app_context():
+        from app.models import Tour, User
+        from app.migrations import fill_moderation_queue
+        generate(db, size, 0, 1, users=MODERATORS + 1, seed=size)
+        db.session.execute(update(Tour).where(Tour.id % PENDING_SHARE == 0).values(moderated_by_id=None))
+        db.session.execute(update(User).values(is_moderator=True))
+        db.session.commit()
+        fill_moderation_queue()
+        logins = [row[0] for row in db.session.query(User.login).order_by(User.id)]
+        pending = db.session.query(Tour).filter(Tour.moderated_by_id == None).count()
+    results = {"tours": size, "pending": pending}
+    client = login(app, logins[0])
+    results["moderation_page_ms"] = round(timed(lambda: client.get("/moderation")), 2)
+    results["nm_page_ms"] = round(timed(lambda: client.get("/?nm=true")), 2)
+
+    # половина очереди остается для параллельного разбора, даже если путеводителей немного
+    decisions = max(1, min(DECISIONS, pending // 4))
+    one_by_one = client.post("/api/v1/moderation/claim", json={"limit": decisions}).get_json()["tours"]
+    started = time.perf_counter()
+    for tour_id in one_by_one:
+        client.get(f"/api/moderate?tid={tour_id}")
+    results["approve_one_by_one_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    bulk = client.post("/api/v1/moderation/claim", json={"limit": decisions}).get_json()["tours"]
+    started = time.perf_counter()
+    approved = client.post("/api/moderate", json={"approve": bulk}).get_json()["approved"]
+    results["approve_bulk_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    results["decisions"] = len(approved)
+
+    with app.app_context():
+        # для параллельного разбора в очереди остаются только PARALLEL_TOURS путеводителей
+        from app.models import ModerationItem
+        kept = [row[0] for row in db.session.query(ModerationItem.tour_id)
+                .order_by(ModerationItem.queued_at, ModerationItem.tour_id).limit(PARALLEL_TOURS)]
+        db.session.query(ModerationItem).filter(ModerationItem.tour_id.notin_(kept)).delete()
+        db.session.commit()
+    stats, lock = {"approved": 0, "skipped": 0}, threading.Lock()
+    threads = [threading.Thread(target=work_queue, args=(app, login_name, stats, lock))
+               for login_name in logins[1:MODERATORS + 1]]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results["parallel_moderators"] = MODERATORS
+    results["parallel_s"] = round(time.perf_counter() - started, 2)
+    results["parallel_approved"] = stats["approved"]
+    results["parallel_skipped"] = stats["skipped"]
+    print(json.dumps(results))
+    return results
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,87 @@
+##
+# @file
+#
+# @brief Бенчмарк персональной ленты путеводителей (index_page?sort=personal).
+#
+# @section description_bench_personal_feed Description
+# Заполняет базу путеводителями с TAGS категориями и для пользователей с 1, 5, 20 и TAGS любимыми категориями
+# измеряет время ответа первой страницы персональной ленты и страницы номер PAGES_DEEP (по курсору; последней
+# страницы, если лента короче), а также время того же ранжирования одним запросом по всем путеводителям любимых
+# категорий без tag_feed.
+# Запуск: python -m bench.personal_feed [количество туров], по умолчанию 1000000.
+
+import json
+import sys
+import time
+
+from sqlalchemy import text
+
+from bench.common import make_app, timed
+from bench.generate import generate, PASSWORD
+
+## Количество категорий путеводителей
+TAGS = 50
+## Количество любимых категорий пользователей
+FAVOURITE_COUNTS = (1, 5, 20, TAGS)
+## Номер страницы ленты, время ответа которой измеряется как "далекой" страницы
+PAGES_DEEP = 10
+
+
+def scan_ranking(db, tag_ids, page_size):
+    """! Ранжирование без tag_feed: ранг считается для каждого путеводителя любимых категорий."""
+    from app import feed
+    ids = ", ".join(str(tag_id) for tag_id in tag_ids)
+    return db.session.execute(text(f"""
+        SELECT tours.id, {feed.score_sql()} + {feed.feed_setting('tag_weight', 3)} * count(*) AS rank
+        FROM tours_to_tags_association
+        JOIN tours ON tours.id = tours_to_tags_association.tour_id
+        LEFT JOIN tour_ratings ON tour_ratings.tour_id = tours.id
+        WHERE tours_to_tags_association.tag_id IN ({ids}) AND NOT tours.archived
+        GROUP BY tours.id ORDER BY rank DESC, tours.id DESC LIMIT {page_size + 1}""")).all()
+
+
+def run(size):
+    app, db, _ = make_app()
+    with app.app_context():
+        from app.models import TourTag, User, users_to_tags_association
+        for index in range(TAGS - db.session.query(TourTag).count()):
+            db.session.add(TourTag(f"Категория {index}"))
+        db.session.commit()
+        started = time.perf_counter()
+        generate(db, size, 0, 1, users=len(FAVOURITE_COUNTS) + 1, seed=size)
+        generated_s = round(time.perf_counter() - started, 1)
+        tag_ids = [row[0] for row in db.session.query(TourTag.id).order_by(TourTag.id)]
+        users = [row for row in db.session.query(User.id, User.login).order_by(User.id)][1:]
+        db.session.execute(users_to_tags_association.delete())
+        for (user_id, _), count in zip(users, FAVOURITE_COUNTS):
+            db.session.execute(users_to_tags_association.insert(),
+                               [{"user_id": user_id, "tag_id": tag_id} for tag_id in tag_ids[:count]])
+        db.session.commit()
+        postings = db.session.execute(text("SELECT count(*) FROM tag_feed")).scalar()
+        page_size = int(app.config["INI"]["SITE"].get("page_size", 20))
+        scan_ms = {count: round(timed(lambda: scan_ranking(db, tag_ids[:count], page_size), repeat=3), 2)
+                   for count in FAVOURITE_COUNTS}
+    print(json.dumps({"tours": size, "tags": TAGS, "postings": postings, "generate_s": generated_s}))
+    results = []
+    for (user_id, login), count in zip(users, FAVOURITE_COUNTS):
+        client = app.test_client()
+        client.post("/login", data={"login": login, "password": PASSWORD})
+        url, pages = "/?sort=personal", 1
+        # при небольшом количестве путеводителей лента может закончиться раньше PAGES_DEEP страниц
+        while pages < PAGES_DEEP:
+            page = client.get(url).get_data(as_text=True)
+            if 'class="next-page"' not in page:
+                break
+            pages += 1
+            url = page.split('class="next-page" href="', 1)[1].split('"', 1)[0].replace("&amp;", "&")
+        results.append({"favourite_tags": count, "deep_page": pages,
+                        "first_page_ms": round(timed(lambda: client.get("/?sort=personal")), 2),
+                        "deep_page_ms": round(timed(lambda: client.get(url)), 2),
+                        "recent_page_ms": round(timed(lambda: client.get("/")), 2),
+                        "scan_ranking_ms": scan_ms[count]})
+        print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,129 @@
+##
+# @file
+#
+# @brief Бенчмарк чтения во время тяжелых сохранений редактора с выделенным движком чтения и без него.
+#
+# @section description_bench_read_routing Description
+# Для read_routing = 0 и 1 (секция DATABASE) запускает сервер gunicorn на одноразовой базе данных. READERS клиентов
+# читают ленту, страницы и блоки путеводителей, а WRITERS авторов все это время сохраняют свои путеводители через
+# PUT /api/v1/tours/<id>, каждый раз заменяя SAVE_BLOCKS блоков. Выводит количество чтений в секунду, p50/p99
+# задержки чтений, количество сохранений и ошибок.
+# Запуск: python -m bench.read_routing [секунд на режим], по умолчанию 15.
+
+import http.cookiejar
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from bench.common import make_app, server_env, MAIN_SCRIPT
+from bench.generate import generate, PASSWORD
+from bench.load import free_port, wait_for_port, percentile
+
+## Количество читающих клиентов
+READERS = 16
+## Количество одновременно сохраняющих авторов
+WRITERS = 4
+## Количество блоков, заменяемых одним сохранением
+SAVE_BLOCKS = 300
+## Количество путеводителей
+TOURS = 5000
+## Количество процессов-обработчиков gunicorn
+WORKERS = 4
+
+
+def opener_for(base_url, login):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    opener.open(base_url + "/login", urllib.parse.urlencode({"login": login, "password": PASSWORD}).encode()).read()
+    return opener
+
+
+def reader(base_url, tour_ids, deadline, seed, samples):
+    """! Читающий клиент: до deadline запрашивает ленту, страницы и блоки случайных путеводителей."""
+    rnd = random.Random(seed)
+    opener = urllib.request.build_opener()
+    while time.time() < deadline:
+        tour_id = rnd.choice(tour_ids)
+        url = base_url + rnd.choice(["/", f"/tour/{tour_id}", f"/api/get_tour_canvas/{tour_id}"])
+        started = time.perf_counter()
+        error = False
+        try:
+            opener.open(url, timeout=30).read()
+        except (urllib.error.URLError, OSError):
+            error = True
+        samples.append(("read", (time.perf_counter() - started) * 1000, error))
+
+
+def writer(base_url, login, tour_id, deadline, samples):
+    """! Автор: до deadline сохраняет путеводитель, удаляя блоки прошлого сохранения и вставляя SAVE_BLOCKS новых."""
+    opener = opener_for(base_url, login)
+    inserted = []
+    while time.time() < deadline:
+        blocks = {"id": [None] * SAVE_BLOCKS, "name": ["Блок"] * SAVE_BLOCKS, "text": ["Сохранение"] * SAVE_BLOCKS,
+                  "content_path": [""] * SAVE_BLOCKS, "type": [0] * SAVE_BLOCKS, "show_on_map": [False] * SAVE_BLOCKS,
+                  "column": [1] * SAVE_BLOCKS, "row": list(range(100, 100 + SAVE_BLOCKS)),
+                  "height": [1] * SAVE_BLOCKS, "width": [4] * SAVE_BLOCKS}
+        request = urllib.request.Request(base_url + f"/api/v1/tours/{tour_id}", method="PUT",
+                                         data=json.dumps({"blocks": blocks, "deleted": inserted}).encode(),
+                                         headers={"Content-Type": "application/json"})
+        started = time.perf_counter()
+        error = False
+        try:
+            inserted = json.loads(opener.open(request, timeout=30).read())["inserted"]
+        except (urllib.error.URLError, OSError, ValueError):
+            error = True
+        samples.append(("write", (time.perf_counter() - started) * 1000, error))
+
+
+def run(duration=15):
+    results = []
+    for routing in (0, 1):
+        app, db, workdir = make_app(DATABASE={"read_routing": routing})
+        with app.app_context():
+            from app.models import Tour, User
+            generate(db, TOURS, 5, 1, users=WRITERS + 1, seed=TOURS)
+            writers = [(login, db.session.query(Tour.id).filter(Tour.created_by_id == user_id).limit(1).scalar())
+                       for user_id, login in db.session.query(User.id, User.login).order_by(User.id)][1:]
+            tour_ids = list(range(1, TOURS + 1))
+            for engine in db.engines.values():
+                engine.dispose()
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen([sys.executable, MAIN_SCRIPT, "--prod", "--workers", str(WORKERS),
+                                   "--bind", f"127.0.0.1:{port}"],
+                                  env=server_env(workdir), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(port)
+            samples = []
+            deadline = time.time() + duration
+            threads = [threading.Thread(target=reader, args=(base_url, tour_ids, deadline, seed, samples))
+                       for seed in range(READERS)]
+            threads += [threading.Thread(target=writer, args=(base_url, login, tour_id, deadline, samples))
+                        for login, tour_id in writers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+        reads = [sample[1] for sample in samples if sample[0] == "read"]
+        results.append({
+            "read_routing": routing, "readers": READERS, "writers": WRITERS,
+            "read_rps": round(len(reads) / duration, 1),
+            "read_p50_ms": round(percentile(reads, 0.5) or 0, 2),
+            "read_p99_ms": round(percentile(reads, 0.99) or 0, 2),
+            "saves": sum(1 for sample in samples if sample[0] == "write"),
+            "errors": sum(1 for sample in samples if sample[2]),
+        })
+        print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 15)
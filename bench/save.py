@@ -0,0 +1,75 @@
+##
+# @file
+#
+# @brief Бенчмарк сохранения путеводителя в редакторе (logic.process_tour).
+#
+# @section description_bench_save Description
+# Для путеводителей с 10, 100 и 1000 блоками измеряет время и количество SQL запросов при повторном сохранении
+# без изменений, с одним измененным блоком, а также с одним добавленным и одним удаленным блоком.
+# Запуск: python -m bench.save [количество блоков ...]
+
+import json
+import sys
+
+from werkzeug.datastructures import MultiDict
+
+from bench.common import make_app, count_queries, timed
+
+
+def tour_form(blocks, tag_ids):
+    """! Сформировать форму редактора из списка словарей полей блоков (ключ "key" - идентификатор блока в форме)."""
+    form = MultiDict([("tour_name", "Путеводитель")] + [("tags", str(tag_id)) for tag_id in tag_ids])
+    for block in blocks:
+        for field, value in block.items():
+            if field != "key" and value is not None and not (field == "show_on_map" and not value):
+                form.add(f"{block['key']}:{field}", str(value))
+    return form
+
+
+def new_block(key, row):
+    return {"key": key, "name": f"Блок {row}", "text": "Текст блока", "type_": 0, "show_on_map": False,
+            "latitude": 0, "longitude": 0, "column": 1, "row": row, "height": 1, "width": 4}
+
+
+def saved_blocks(db, tour_id):
+    from app.models import TourBlock
+    return [{"key": str(block.id), "name": block.name, "text": block.text, "type_": block.type,
+             "show_on_map": block.show_on_map, "latitude": block.latitude, "longitude": block.longitude,
+             "column": block.column, "row": block.row, "height": block.height, "width": block.width,
+             "old_content_path": block.content_path}
+            for block in db.session.query(TourBlock).filter(TourBlock.tour_id == tour_id).order_by(TourBlock.id)]
+
+
+def run(sizes):
+    app, db, _ = make_app()
+    results = []
+    with app.app_context():
+        from app.models import User, TourTag
+        from app.logic import process_tour
+        user = User("bench", "-")
+        db.session.add(user)
+        db.session.commit()
+        tag_ids = [tag.id for tag in db.session.query(TourTag).limit(2)]
+        for size in sizes:
+            tour_id = process_tour(tour_form([new_block(f"n{i}", i + 1) for i in range(size)], tag_ids),
+                                   "create", user, MultiDict())
+            blocks = saved_blocks(db, tour_id)
+            changed = [dict(block) for block in blocks]
+            changed[0]["text"] = "Новый текст"
+            added_removed = [dict(block) for block in blocks[1:]] + [new_block("n0", size + 1)]
+            cases = [("unchanged", blocks), ("one_changed", changed), ("one_added_one_removed", added_removed)]
+            for name, case_blocks in cases:
+                form = tour_form(case_blocks, tag_ids)
+                with count_queries(db) as statements:
+                    process_tour(form, str(tour_id), user, MultiDict())
+                # форма снова соответствует сохраненному состоянию, поэтому повторные сохранения - без изменений блоков
+                form = tour_form(saved_blocks(db, tour_id), tag_ids)
+                latency = timed(lambda: process_tour(form, str(tour_id), user, MultiDict()))
+                results.append({"blocks": size, "case": name, "statements": len(statements),
+                                "latency_ms": round(latency, 2)})
+                print(json.dumps(results[-1]))
+    return results
+
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or [10, 100, 1000])
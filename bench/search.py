@@ -0,0 +1,43 @@
+##
+# @file
+#
+# @brief Бенчмарк поиска путеводителей.
+#
+# @section description_bench_search Description
+# Сравнивает поиск через индекс FTS5 (search.search_tours) с прежним поиском Tour.name LIKE '%s%' и с поиском LIKE
+# по названиям и текстам блоков на корпусе синтетических путеводителей.
+# Запуск: python -m bench.search [количество туров], по умолчанию 100000.
+
+import json
+import sys
+
+from sqlalchemy import or_
+
+from bench.common import make_app, seed_tours, timed
+
+
+def run(size=100000, blocks_per_tour=3, terms=("музей", "водопад маяк", "сыровар")):
+    app, db, _ = make_app()
+    results = []
+    with app.app_context():
+        seed_tours(db, size, blocks_per_tour=blocks_per_tour)
+        from app.models import Tour, TourBlock
+        from app.search import search_tours
+        for term in terms:
+            pattern = f"%{term}%"
+            cases = {
+                "fts": lambda: search_tours(db.session.query(Tour), term),
+                "like_name": lambda: db.session.query(Tour).filter(Tour.name.like(pattern)).limit(21).all(),
+                "like_blocks": lambda: db.session.query(Tour).filter(or_(
+                    Tour.name.like(pattern),
+                    Tour.id.in_(db.session.query(TourBlock.tour_id).filter(TourBlock.text.like(pattern)))))
+                    .order_by(Tour.last_updated_at.desc()).limit(21).all(),
+            }
+            for name, func in cases.items():
+                results.append({"tours": size, "term": term, "case": name, "latency_ms": round(timed(func), 2)})
+                print(json.dumps(results[-1], ensure_ascii=False))
+    return results
+
+
+if __name__ == "__main__":
+    run(*[int(arg) for arg in sys.argv[1:]])
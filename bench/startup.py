@@ -0,0 +1,87 @@
+##
+# @file
+#
+# @brief Бенчмарк времени запуска приложения.
+#
+# @section description_bench_startup Description
+# Измеряет в отдельных процессах: время импорта пакета app (python -X importtime), время create_app и время до ответа
+# на первый запрос ленты. Выводит самые долгие импорты. Если заданы пороги, завершается с ошибкой при их превышении.
+# Запуск: python -m bench.startup [порог импорта, мс] [порог первого запроса, мс]
+
+import json
+import subprocess
+import sys
+
+from bench.common import make_app, server_env
+
+## Код, выполняемый в отдельном процессе для измерения времени до первого запроса
+FIRST_REQUEST_CODE = """
+import json, time
+started = time.perf_counter()
+from app import create_app
+imported = time.perf_counter()
+app = create_app()
+created = time.perf_counter()
+response = app.test_client().get("/")
+answered = time.perf_counter()
+assert response.status_code == 200, response.status_code
+print(json.dumps({"import_ms": (imported - started) * 1000, "create_app_ms": (created - imported) * 1000,
+                  "first_request_ms": (answered - created) * 1000, "total_ms": (answered - started) * 1000}))
+"""
+
+
+def import_times(env, module="app"):
+    """! Время импорта модулей по выводу python -X importtime.
+
+    @param env Переменные окружения процесса (server_env).
+    @param module Импортируемый модуль.
+    @returns (накопленное время импорта module в мс, список (накопленное время в мс, модуль) по убыванию)
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True, env=env)
+    rows = []
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        rows.append((int(cumulative) / 1000, name.strip()))
+        if name.strip() == module:
+            total = int(cumulative) / 1000
+    rows.sort(reverse=True)
+    return total, rows
+
+
+def first_request(env, repeat=3):
+    """! Медианные времена импорта, create_app и первого запроса в новом процессе, мс.
+    @param env Переменные окружения процесса (server_env).
+    """
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", FIRST_REQUEST_CODE], capture_output=True, text=True,
+                                check=True, env=env)
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return {key: round(sorted(run[key] for run in runs)[len(runs) // 2], 1) for key in runs[0]}
+
+
+def run(import_limit=None, request_limit=None, top=10):
+    # одноразовая БД со схемой, путь к конфигурации передается процессам через TOURSPOON_CONFIG
+    env = server_env(make_app()[2])
+    total, rows = import_times(env)
+    print(json.dumps({"import_app_ms": round(total, 1)}))
+    for cumulative, name in rows[:top]:
+        print(f"{cumulative:9.1f} ms  {name}")
+    timings = first_request(env)
+    print(json.dumps(timings))
+    failed = []
+    if import_limit is not None and total > import_limit:
+        failed.append(f"import app took {total:.1f} ms > {import_limit} ms")
+    if request_limit is not None and timings["total_ms"] > request_limit:
+        failed.append(f"time to first request {timings['total_ms']} ms > {request_limit} ms")
+    if failed:
+        sys.exit("; ".join(failed))
+
+
+if __name__ == "__main__":
+    limits = [float(arg) for arg in sys.argv[1:3]]
+    run(*limits)
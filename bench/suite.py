@@ -0,0 +1,271 @@
+##
+# @file
+#
+# @brief Набор бенчмарков основных сценариев сайта.
+#
+# @section description_bench_suite Description
+# Заполняет одноразовую базу генератором bench.generate и выполняет сценарии через настоящие эндпоинты: лента,
+# просмотр путеводителя, получение блоков путеводителя, сохранение в редакторе и добавление комментария.
+# По умолчанию запросы выполняются последовательно через тестовый клиент Flask (задержка без учета сети),
+# с параметром --server - параллельно несколькими клиентами к серверу gunicorn (main.py --prod).
+# Результаты выводятся в формате JSON и могут быть сохранены в файл (--output) для сравнения между запусками:
+#   python -m bench.suite --tours 100000 --output before.json
+#   python -m bench.suite --tours 100000 --output after.json
+#   python -m bench.suite compare before.json after.json
+
+import argparse
+import datetime
+import http.cookiejar
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from werkzeug.datastructures import MultiDict
+
+from bench.common import make_app, server_env, MAIN_SCRIPT
+from bench.generate import generate, PASSWORD
+from bench.load import free_port, wait_for_port, percentile
+from bench.save import tour_form, saved_blocks
+
+
+class TestClient:
+    """! Клиент, выполняющий запросы в том же процессе через тестовый клиент Flask"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        """! Выполнить запрос и вернуть код ответа."""
+        return self.client.open(path, method=method, data=data).status_code
+
+
+class HttpClient:
+    """! Клиент, выполняющий запросы к запущенному серверу, со своими cookie"""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def request(self, method, path, data=None):
+        body = None
+        if data is not None:
+            pairs = data.items(multi=True) if isinstance(data, MultiDict) else data.items()
+            body = urllib.parse.urlencode(list(pairs)).encode()
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, body, method=method),
+                                  timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+        except (urllib.error.URLError, OSError):
+            return 0
+
+
+class Fixture:
+    """! Данные заполненной базы, из которых сценарии выбирают параметры запросов"""
+
+    def __init__(self, db, tours):
+        from app.models import Tour, User, TourTag
+        from app.logic import encode_feed_cursor
+        self.tour_ids = [row[0] for row in db.session.query(Tour.id)]
+        self.tag_ids = [row[0] for row in db.session.query(TourTag.id)]
+        ordered = db.session.query(Tour).order_by(Tour.last_updated_at.desc(), Tour.id.desc())
+        self.cursors = [encode_feed_cursor(ordered.offset(offset).first())
+                        for offset in sorted({tours // 4, tours // 2, tours * 3 // 4}) if offset < tours]
+        # автор, сохраняющий путеводитель в редакторе, и форма этого путеводителя
+        self.own_tour_id = self.tour_ids[0]
+        owner_id = db.session.query(Tour.created_by_id).filter(Tour.id == self.own_tour_id).scalar()
+        self.owner_login = db.session.query(User.login).filter(User.id == owner_id).scalar()
+        tour = db.session.get(Tour, self.own_tour_id)
+        self.form = tour_form(saved_blocks(db, self.own_tour_id), [tag.id for tag in tour.tags])
+        self.form["tour_name"] = tour.name
+
+
+def feed_request(rnd, fixture):
+    path = rnd.choice(["/", "/?sort=top", f"/?c={rnd.choice(fixture.tag_ids)}"]
+                      + [f"/?after={urllib.parse.quote(cursor)}" for cursor in fixture.cursors])
+    return "GET", path, None
+
+
+def tour_view_request(rnd, fixture):
+    return "GET", f"/tour/{rnd.choice(fixture.tour_ids)}", None
+
+
+def canvas_request(rnd, fixture):
+    return "GET", f"/api/get_tour_canvas/{rnd.choice(fixture.tour_ids)}", None
+
+
+def canvases_request(rnd, fixture):
+    ids = ",".join(str(tour_id) for tour_id in rnd.sample(fixture.tour_ids, min(20, len(fixture.tour_ids))))
+    return "GET", f"/api/tour_canvases?ids={ids}", None
+
+
+def editor_save_request(rnd, fixture):
+    form = fixture.form.copy()
+    text_keys = [key for key in form if key.endswith(":text")]
+    if text_keys:
+        form[rnd.choice(text_keys)] = f"Измененный текст {rnd.random()}"
+    return "POST", f"/tour/{fixture.own_tour_id}?edit_mode=1", form
+
+
+def reaction_request(rnd, fixture):
+    data = {name: rnd.randint(1, 10) for name in ("beauty_criteria", "route_smoothness_criteria",
+                                                  "attractions_criteria", "accessibility_criteria")}
+    data["text"] = "Комментарий"
+    return "POST", f"/tour/{rnd.choice(fixture.tour_ids)}", data
+
+
+## Сценарии в порядке выполнения: имя, функция, возвращающая (метод, путь, данные формы)
+SCENARIOS = {
+    "feed": feed_request,
+    "tour_view": tour_view_request,
+    "canvas": canvas_request,
+    "canvases_batch": canvases_request,
+    "editor_save": editor_save_request,
+    "reaction_post": reaction_request,
+}
+
+
+def run_scenario(clients, make_request, fixture, requests, seed):
+    """! Выполнить requests запросов сценария, распределив их между клиентами (каждый клиент - в своем потоке).
+
+    @returns словарь с количеством запросов, ошибок, запросами в секунду и задержками в миллисекундах
+    """
+    latencies = []
+    errors = []
+
+    def worker(index, client):
+        rnd = random.Random(seed * 1000 + index)
+        for _ in range(index, requests, len(clients)):
+            method, path, data = make_request(rnd, fixture)
+            started = time.perf_counter()
+            status = client.request(method, path, data)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if not 200 <= status < 400:
+                errors.append(status)
+
+    started = time.perf_counter()
+    if len(clients) == 1:
+        worker(0, clients[0])
+    else:
+        threads = [threading.Thread(target=worker, args=(index, client)) for index, client in enumerate(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(sum(latencies) / max(1, len(latencies)), 2),
+        "p50_ms": round(percentile(latencies, 0.5) or 0, 2),
+        "p90_ms": round(percentile(latencies, 0.9) or 0, 2),
+        "p99_ms": round(percentile(latencies, 0.99) or 0, 2),
+    }
+
+
+def environment():
+    """! Описание окружения, в котором выполнялись бенчмарки."""
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                  check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {"date": datetime.datetime.now().isoformat(timespec="seconds"), "revision": revision,
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "cpus": os.cpu_count()}
+
+
+def run(tours=10000, blocks=10, reactions=5, requests=200, server=False, workers=4, clients=16,
+        scenarios=None, output=None):
+    app, db, workdir = make_app()
+    with app.app_context():
+        seeded = generate(db, tours, blocks, reactions)
+        fixture = Fixture(db, tours)
+        db.engine.dispose()
+    report = {"environment": environment(),
+              "parameters": {"tours": tours, "blocks_per_tour": blocks, "reactions_per_tour": reactions,
+                             "requests": requests, "mode": "server" if server else "test_client",
+                             "workers": workers if server else None, "clients": clients if server else 1},
+              "seed": seeded, "results": []}
+    print(json.dumps({"seed": seeded}))
+    process = None
+    try:
+        if server:
+            port = free_port()
+            process = subprocess.Popen([sys.executable, MAIN_SCRIPT, "--prod", "--workers", str(workers),
+                                        "--bind", f"127.0.0.1:{port}"], env=server_env(workdir),
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            wait_for_port(port)
+            client_list = [HttpClient(f"http://127.0.0.1:{port}") for _ in range(clients)]
+        else:
+            client_list = [TestClient(app)]
+        for client in client_list:
+            client.request("POST", "/login", {"login": fixture.owner_login, "password": PASSWORD})
+        for seed, name in enumerate(scenarios or SCENARIOS):
+            result = dict(scenario=name, **run_scenario(client_list, SCENARIOS[name], fixture, requests, seed))
+            report["results"].append(result)
+            print(json.dumps(result))
+    finally:
+        if process:
+            process.terminate()
+            process.wait(timeout=30)
+    if output:
+        with open(output, "w") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+    return report
+
+
+def compare(before_path, after_path):
+    """! Вывести изменение задержки и пропускной способности по сценариям между двумя сохраненными запусками."""
+    with open(before_path) as file:
+        before = {result["scenario"]: result for result in json.load(file)["results"]}
+    with open(after_path) as file:
+        after = {result["scenario"]: result for result in json.load(file)["results"]}
+    for name in before.keys() & after.keys():
+        old, new = before[name], after[name]
+        print(json.dumps({
+            "scenario": name,
+            "p50_ms": [old["p50_ms"], new["p50_ms"]],
+            "p99_ms": [old["p99_ms"], new["p99_ms"]],
+            "rps": [old["rps"], new["rps"]],
+            "speedup": round(old["p50_ms"] / new["p50_ms"], 2) if new["p50_ms"] else None,
+            "errors": [old["errors"], new["errors"]],
+        }))
+
+
+def main():
+    if sys.argv[1:2] == ["compare"]:
+        parser = argparse.ArgumentParser(prog="python -m bench.suite compare")
+        parser.add_argument("before")
+        parser.add_argument("after")
+        args = parser.parse_args(sys.argv[2:])
+        compare(args.before, args.after)
+        return
+    parser = argparse.ArgumentParser(prog="python -m bench.suite", description="TourSpoon benchmark suite")
+    parser.add_argument("--tours", type=int, default=10000, help="number of generated tours")
+    parser.add_argument("--blocks", type=int, default=10, help="blocks per tour")
+    parser.add_argument("--reactions", type=int, default=5, help="average reactions per tour")
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--server", action="store_true", help="run against gunicorn (main.py --prod)")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers in --server mode")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients in --server mode")
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="run only these scenarios")
+    parser.add_argument("--output", help="save the report as JSON to this file")
+    args = parser.parse_args()
+    run(args.tours, args.blocks, args.reactions, args.requests, args.server, args.workers, args.clients,
+        args.scenario, args.output)
+
+
+if __name__ == "__main__":
+    main()
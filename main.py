@@ -1,4 +1,20 @@
-from app import app, config
+import argparse
+
+from app import create_app
+
+## Приложение для `flask --app main <команда>` (migrate, seed, worker, run)
+app = create_app()
 
 if __name__ == '__main__':
-    app.run(port=int(config["SITE"]["PORT"]))
+    parser = argparse.ArgumentParser(description="TourSpoon")
+    parser.add_argument("--prod", action="store_true", help="run with gunicorn and several worker processes")
+    parser.add_argument("--workers", type=int, help="number of worker processes (see SERVER section of config.ini)")
+    parser.add_argument("--bind", help="address:port to listen on in production mode")
+    args = parser.parse_args()
+    if args.prod:
+        from app.server import run_production
+        run_production(app, args.workers, args.bind)
+    else:
+        from app.jobs import start_embedded_workers
+        start_embedded_workers(app)
+        app.run(port=int(app.config["INI"]["SITE"]["PORT"]))
@@ -0,0 +1,35 @@
+##
+# @file
+#
+# @brief Общие фикстуры тестов.
+#
+# @section description_tests_conftest Description
+# Каждый тест получает приложение с одноразовой базой данных во временной директории (см. bench.common.make_app).
+# Запуск: python -m pytest -q
+
+import pytest
+
+from bench.common import make_app
+from bench.generate import PASSWORD
+
+
+@pytest.fixture
+def app(tmp_path):
+    """! Приложение с пустой базой данных во временной директории теста."""
+    app, _, _ = make_app(str(tmp_path))
+    yield app
+    from app import db
+    with app.app_context():
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+
+
+@pytest.fixture
+def login(app):
+    """! Функция, возвращающая тестовый клиент, вошедший под пользователем из bench.generate.generate (по логину)."""
+    def make_client(login_name):
+        client = app.test_client()
+        client.post("/login", data={"login": login_name, "password": PASSWORD})
+        return client
+    return make_client
@@ -0,0 +1,112 @@
+##
+# @file
+#
+# @brief Тесты очереди модерации: модераторы не получают и не проверяют путеводители, взятые другим модератором.
+
+import datetime
+import threading
+
+import pytest
+from sqlalchemy import update
+
+from bench.generate import generate
+
+## Количество путеводителей в очереди
+PENDING = 60
+
+
+@pytest.fixture
+def moderators(app):
+    """! Очередь из PENDING не проверенных путеводителей и три модератора.
+
+    @returns логины модераторов
+    """
+    from app import db
+    from app.migrations import fill_moderation_queue
+    from app.models import Tour, User
+    with app.app_context():
+        generate(db, PENDING, 0, 0, users=3)
+        db.session.execute(update(Tour).values(moderated_by_id=None))
+        db.session.execute(update(User).values(is_moderator=True))
+        db.session.commit()
+        fill_moderation_queue()
+        return [row[0] for row in db.session.query(User.login).order_by(User.id)]
+
+
+def claim(client, limit):
+    response = client.post("/api/v1/moderation/claim", json={"limit": limit})
+    assert response.status_code == 200
+    return response.get_json()["tours"]
+
+
+def moderated_by(app):
+    """! Словарь {id путеводителя: id проверившего модератора} для проверенных путеводителей."""
+    from app import db
+    from app.models import Tour
+    with app.app_context():
+        return dict(db.session.query(Tour.id, Tour.moderated_by_id).filter(Tour.moderated_by_id != None))
+
+
+def test_claims_are_disjoint(login, moderators):
+    first, second = login(moderators[1]), login(moderators[2])
+    claimed_first = claim(first, 10)
+    claimed_second = claim(second, 10)
+    assert len(claimed_first) == len(claimed_second) == 10
+    assert not set(claimed_first) & set(claimed_second)
+    # повторный claim продлевает аренду уже взятых путеводителей, а не выдает чужие
+    assert set(claimed_first) <= set(claim(first, 20))
+
+
+def test_decide_skips_tours_claimed_by_other(app, login, moderators):
+    first, second = login(moderators[1]), login(moderators[2])
+    claimed = claim(first, 4)
+    result = second.post("/api/moderate", json={"approve": claimed[:2], "reject": claimed[2:]}).get_json()
+    assert result == {"approved": [], "rejected": [], "skipped": sorted(claimed)}
+    assert moderated_by(app) == {}
+
+    result = first.post("/api/moderate", json={"approve": claimed[:2], "reject": claimed[2:]}).get_json()
+    assert result == {"approved": sorted(claimed[:2]), "rejected": sorted(claimed[2:]), "skipped": []}
+
+
+def test_expired_lease_passes_to_other_moderator(app, login, moderators):
+    from app import db
+    from app.models import ModerationItem
+    first, second = login(moderators[1]), login(moderators[2])
+    claimed = claim(first, 5)
+    with app.app_context():
+        db.session.execute(update(ModerationItem).where(ModerationItem.tour_id.in_(claimed))
+                           .values(claimed_until=datetime.datetime.now() - datetime.timedelta(seconds=1)))
+        db.session.commit()
+    assert claim(second, 5) == claimed
+    assert second.post("/api/moderate", json={"approve": claimed}).get_json()["approved"] == sorted(claimed)
+    assert first.post("/api/moderate", json={"approve": claimed}).get_json()["skipped"] == sorted(claimed)
+
+
+def test_parallel_moderators_decide_each_tour_once(app, login, moderators):
+    approved = {login_name: [] for login_name in moderators}
+    errors = []
+
+    def work_queue(login_name):
+        client = login(login_name)
+        try:
+            while True:
+                tour_ids = claim(client, 7)
+                if not tour_ids:
+                    return
+                result = client.post("/api/moderate", json={"approve": tour_ids}).get_json()
+                assert result["skipped"] == []
+                approved[login_name] += result["approved"]
+        except Exception as error:  # исключение в потоке не прерывает тест, поэтому передается в основной поток
+            errors.append(error)
+
+    threads = [threading.Thread(target=work_queue, args=(login_name,)) for login_name in moderators]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    decided = [tour_id for tour_ids in approved.values() for tour_id in tour_ids]
+    assert len(decided) == len(set(decided)) == PENDING
+    user_ids = {login_name: int(login_name.removeprefix("user")) for login_name in moderators}
+    assert moderated_by(app) == {tour_id: user_ids[login_name]
+                                 for login_name, tour_ids in approved.items() for tour_id in tour_ids}
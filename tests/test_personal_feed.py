@@ -0,0 +1,69 @@
+##
+# @file
+#
+# @brief Тесты персональной ленты: страницы get_personal_feed_page сравниваются с ранжированием всех путеводителей.
+
+import pytest
+from sqlalchemy import text
+
+from bench.generate import generate
+
+## Количество категорий путеводителей
+TAGS = 6
+## Количество любимых категорий пользователя
+FAVOURITES = 3
+
+
+def brute_force_ranking(db, query, tag_ids):
+    """! Идентификаторы путеводителей любимых категорий, проходящих фильтры query, по убыванию ранга: ранг
+    считается для каждого путеводителя по его категориям и оценке, без tag_feed."""
+    from app import feed
+    tag_weight = feed.feed_setting("tag_weight", 3)
+    max_bonus = int(feed.feed_setting("max_tag_bonus", 3))
+    visible = {tour.id for tour in query}
+    rows = db.session.execute(text(f"""
+        SELECT tours.id, {feed.score_sql()},
+               (SELECT count(*) FROM tours_to_tags_association AS link
+                WHERE link.tour_id = tours.id AND link.tag_id IN ({", ".join(map(str, tag_ids))}))
+        FROM tours LEFT JOIN tour_ratings ON tour_ratings.tour_id = tours.id""")).all()
+    ranked = sorted(((score + tag_weight * min(overlap, max_bonus), tour_id)
+                     for tour_id, score, overlap in rows if overlap and tour_id in visible), reverse=True)
+    return [tour_id for _, tour_id in ranked]
+
+
+@pytest.fixture(params=[1, 3], ids=["max_tag_bonus=1", "max_tag_bonus=3"])
+def feed_app(request, tmp_path):
+    """! Приложение с путеводителями TAGS категорий (по одной-две на путеводитель) и комментариями."""
+    from bench.common import make_app
+    app, db, _ = make_app(str(tmp_path), FEED={"max_tag_bonus": request.param})
+    from app.models import TourTag
+    with app.app_context():
+        for index in range(TAGS - db.session.query(TourTag).count()):
+            db.session.add(TourTag(f"Категория {index}"))
+        db.session.commit()
+        generate(db, 300, 0, 3, users=2, seed=1)
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.mark.parametrize("page_size", [1, 7, 20])
+def test_pages_match_brute_force(feed_app, page_size):
+    from app import db, feed
+    from app.models import Tour, TourTag
+    with feed_app.app_context():
+        tag_ids = [row[0] for row in db.session.query(TourTag.id).order_by(TourTag.id)][:FAVOURITES]
+        # часть путеводителей не проходит фильтры ленты, как не проверенные модератором
+        query = db.session.query(Tour).filter(Tour.archived == False, Tour.id % 5 != 0)
+        expected = brute_force_ranking(db, query, tag_ids)
+        assert len(expected) > 3 * page_size
+
+        shown, cursor = [], None
+        while True:
+            tours, cursor = feed.get_personal_feed_page(query, tag_ids, cursor, page_size)
+            assert len(tours) <= page_size
+            shown += [tour.id for tour in tours]
+            if cursor is None:
+                break
+        assert shown == expected
@@ -0,0 +1,93 @@
+##
+# @file
+#
+# @brief Тесты автосохранения редактора (PATCH /api/v1/tours/<id>).
+
+import pytest
+
+from bench.generate import generate
+
+
+@pytest.fixture
+def tour(app):
+    """! Путеводитель с тремя блоками; автор - единственный пользователь user1.
+
+    @returns идентификатор путеводителя, его версия, идентификаторы блоков
+    """
+    from app import db
+    from app.models import Tour, TourBlock
+    with app.app_context():
+        generate(db, 1, 3, 0, users=1)
+        tour_obj = db.session.query(Tour).one()
+        block_ids = [row[0] for row in db.session.query(TourBlock.id).order_by(TourBlock.id)]
+        return tour_obj.id, tour_obj.version, block_ids
+
+
+def get_blocks(client, tour_id):
+    """! Блоки путеводителя из GET /api/v1/tours/<id> в виде {id: {столбец: значение}}."""
+    data = client.get(f"/api/v1/tours/{tour_id}").get_json()
+    columns = data["blocks"]
+    return data["version"], {block["id"]: block for block in
+                             (dict(zip(columns, values)) for values in zip(*columns.values()))}
+
+
+def test_stale_version_conflict(login, tour):
+    tour_id, version, block_ids = tour
+    client = login("user1")
+    response = client.patch(f"/api/v1/tours/{tour_id}", json={
+        "version": version, "ops": [{"op": "edit", "id": block_ids[0], "text": "первое окно"}]})
+    assert response.status_code == 200
+    assert response.get_json()["version"] == version + 1
+
+    response = client.patch(f"/api/v1/tours/{tour_id}", json={
+        "version": version, "ops": [{"op": "edit", "id": block_ids[0], "text": "второе окно"},
+                                    {"op": "add", "id": "new", "text": "новый блок"}]})
+    assert response.status_code == 409
+    assert response.get_json()["version"] == version + 1
+    current_version, blocks = get_blocks(client, tour_id)
+    assert current_version == version + 1
+    assert sorted(blocks) == block_ids
+    assert blocks[block_ids[0]]["text"] == "первое окно"
+
+
+def test_ops_on_one_block_are_folded(login, tour):
+    tour_id, version, block_ids = tour
+    client = login("user1")
+    response = client.patch(f"/api/v1/tours/{tour_id}", json={"version": version, "ops": [
+        {"op": "add", "id": "a", "name": "новый", "text": "черновик"},
+        {"op": "edit", "id": "a", "text": "текст"},
+        {"op": "resize", "id": "a", "row": 9, "column": 1, "height": 2, "width": 3},
+        {"op": "add", "id": "b", "text": "удаленный сразу"},
+        {"op": "remove", "id": "b"},
+        {"op": "edit", "id": block_ids[0], "name": "старый"},
+        {"op": "move", "id": block_ids[0], "row": 12, "column": 2},
+        {"op": "edit", "id": block_ids[0], "text": "изменен"},
+        {"op": "edit", "id": block_ids[1], "text": "будет удален"},
+        {"op": "remove", "id": block_ids[1]},
+    ]})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["version"] == version + 1
+    assert list(body["ids"]) == ["a"]
+
+    current_version, blocks = get_blocks(client, tour_id)
+    assert current_version == version + 1
+    assert set(blocks) == {block_ids[0], block_ids[2], body["ids"]["a"]}
+    added = blocks[body["ids"]["a"]]
+    assert (added["name"], added["text"], added["row"], added["column"], added["height"], added["width"]) == \
+        ("новый", "текст", 9, 1, 2, 3)
+    edited = blocks[block_ids[0]]
+    assert (edited["name"], edited["text"], edited["row"], edited["column"]) == ("старый", "изменен", 12, 2)
+
+
+def test_ops_on_foreign_block_are_rejected(login, tour):
+    tour_id, version, block_ids = tour
+    client = login("user1")
+    response = client.patch(f"/api/v1/tours/{tour_id}", json={"version": version, "ops": [
+        {"op": "edit", "id": block_ids[0], "text": "не сохранится"},
+        {"op": "move", "id": "missing", "row": 1, "column": 1},
+    ]})
+    assert response.status_code == 400
+    current_version, blocks = get_blocks(client, tour_id)
+    assert current_version == version
+    assert blocks[block_ids[0]]["text"] != "не сохранится"